@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+#-
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# Copyright (c) 2018 A. Theodore Markettos
+# All rights reserved.
+#
+# This software was developed by SRI International and the University of
+# Cambridge Computer Laboratory (Department of Computer Science and
+# Technology) under DARPA contract HR0011-18-C-0016 ("ECATS"), as part of the
+# DARPA SSITH research programme.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+# A store for the downloaded artifacts (Ubuntu images, toolchains) shared by
+# the builds. Files are kept by their SHA-256, an index maps each URL to its
+# hash, and archives are kept extracted so that a toolchain is unpacked once.
+#
+#   artifact_cache.py fetch <url>      prints the path of the cached file
+#   artifact_cache.py extract <url>    prints the directory it is extracted in
+#
+# The store is $ARTIFACT_CACHE (default ~/.cache/socfpga-artifacts). Files
+# found in $ARTIFACT_MIRROR (by name) are used instead of downloading them,
+# and nothing is ever downloaded when $ARTIFACT_OFFLINE is set.
+
+import os
+import sys
+import argparse
+import subprocess
+import hashlib
+import json
+import fcntl
+import shutil
+import tempfile
+import time
+
+DEFAULT_STORE = os.path.join(os.path.expanduser("~"), ".cache",
+                             "socfpga-artifacts")
+HASH_BLOCK_SIZE = 4*1024*1024
+
+#==============================================================================
+# messages go to stderr, stdout only carries the resulting path
+def info(*msg):
+
+    sys.stderr.write("info: " + " ".join([str(m) for m in msg]) + "\n")
+
+def error(*msg):
+
+    sys.stderr.write("error: " + " ".join([str(m) for m in msg]) + "\n")
+    sys.exit(-1)
+
+#==============================================================================
+# sha256 of a file, as hex
+def hash_file(path):
+
+    h = hashlib.sha256()
+    f = open(path, 'rb')
+    try:
+        while True:
+            block = f.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            h.update(block)
+    finally:
+        f.close()
+
+    return h.hexdigest()
+
+#==============================================================================
+# the artifact store, on disk:
+#!   index.json          url -> {'sha256', 'size', 'name', 'time'}
+#!   blobs/<sha256>      the files
+#!   trees/<sha256>/     the archives, extracted
+#!   tmp/                downloads (locked per url) and extractions in progress
+#! The index is only changed under index.lock, files appear by rename()
+class ArtifactStore(object):
+
+    def __init__(self, path):
+        self.path = path
+        for d in ["blobs", "trees", "tmp"]:
+            try:
+                os.makedirs(os.path.join(path, d))
+            except OSError:
+                pass
+
+    def blob(self, sha256):
+        return os.path.join(self.path, "blobs", sha256)
+
+    def tree(self, sha256):
+        return os.path.join(self.path, "trees", sha256)
+
+    def lock(self):
+        f = open(os.path.join(self.path, "index.lock"), 'a')
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+    def read_index(self):
+        try:
+            return json.load(open(os.path.join(self.path, "index.json")))
+        except (IOError, ValueError):
+            return {}
+
+    def write_index(self, index):
+        name = os.path.join(self.path, "index.json")
+        f = open(name+".tmp", 'w')
+        json.dump(index, f, indent=1, sort_keys=True)
+        f.close()
+        os.rename(name+".tmp", name)
+
+    # the cached copy of 'url', checked against its hash, or None
+    def lookup(self, url, sha256=None):
+        entry = self.read_index().get(url)
+        if entry is None or (sha256 and entry['sha256'] != sha256):
+            return None
+        blob = self.blob(entry['sha256'])
+        if not os.path.isfile(blob) or \
+           os.path.getsize(blob) != entry['size']:
+            return None
+        return blob
+
+    # moves a file into the store and records it as 'url'
+    def add(self, url, path, sha256=None):
+        digest = hash_file(path)
+        if sha256 and digest != sha256:
+            os.unlink(path)
+            error(url, ": sha256 mismatch, expected", sha256, "got", digest)
+        blob = self.blob(digest)
+        lock = self.lock()
+        try:
+            if os.path.exists(blob):
+                os.unlink(path)
+            else:
+                os.chmod(path, 0444)
+                os.rename(path, blob)
+            index = self.read_index()
+            index[url] = {'sha256': digest, 'size': os.path.getsize(blob),
+                          'name': os.path.basename(url), 'time': time.time()}
+            self.write_index(index)
+        finally:
+            lock.close()
+        return blob
+
+    # makes 'url' available in the store, from the mirror or the network
+    # returns the path of the cached file
+    def fetch(self, url, sha256=None, mirror=None, offline=False):
+        blob = self.lookup(url, sha256)
+        if blob:
+            return blob
+
+        name = os.path.basename(url)
+        # partial downloads are kept, wget -c resumes them
+        tmp = os.path.join(self.path, "tmp",
+                           hashlib.sha256(url).hexdigest()[:16]+"-"+name)
+        # builds fetching the same url wait for each other, the first one
+        # downloads it and the others find it in the store
+        lock = open(tmp+".lock", 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            blob = self.lookup(url, sha256)
+            if blob:
+                return blob
+            return self.download(url, tmp, sha256, mirror, offline)
+        finally:
+            lock.close()
+
+    # gets 'url' into 'tmp' and adds it to the store, under the url's lock
+    def download(self, url, tmp, sha256, mirror, offline):
+        name = os.path.basename(url)
+        if mirror and os.path.isfile(os.path.join(mirror, name)):
+            info("importing", name, "from", mirror)
+            shutil.copyfile(os.path.join(mirror, name), tmp)
+        elif offline:
+            error(url, ": not in the store and offline")
+        else:
+            info("downloading", url)
+            if subprocess.call(["wget", "-c", "-nv", "-O", tmp, url],
+                               stdout=sys.stderr) != 0:
+                error(url, ": download failed")
+
+        return self.add(url, tmp, sha256)
+
+    # extracts a cached archive once, in a directory named after its hash
+    # returns the directory
+    def extract(self, url, blob):
+        digest = os.path.basename(blob)
+        tree = self.tree(digest)
+        if os.path.isdir(tree):
+            return tree
+
+        info("extracting", os.path.basename(url))
+        tmp = tempfile.mkdtemp(dir=os.path.join(self.path, "tmp"))
+        if subprocess.call(["tar", "-x", "-f", blob, "-C", tmp],
+                           stdout=sys.stderr) != 0:
+            shutil.rmtree(tmp, ignore_errors=True)
+            error(url, ": extraction failed")
+        try:
+            os.rename(tmp, tree)
+        except OSError:
+            # extracted meanwhile by another build
+            shutil.rmtree(tmp, ignore_errors=True)
+        return tree
+
+#==============================================================================
+# main
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='''Shared store for downloaded
+                                     artifacts, indexed by SHA-256''')
+    parser.add_argument('command', choices=['fetch', 'extract'],
+                        help='''fetch: prints the path of the cached file,
+                                extract: prints the directory the archive is
+                                extracted in''')
+    parser.add_argument('url', help='where to download the artifact from')
+    parser.add_argument('--sha256', dest='sha256', action='store',
+                        default=None, help='expected hash of the artifact')
+    parser.add_argument('--store', dest='store', action='store',
+                        default=os.environ.get('ARTIFACT_CACHE', DEFAULT_STORE),
+                        help='the store directory (default: $ARTIFACT_CACHE)')
+    parser.add_argument('--mirror', dest='mirror', action='store',
+                        default=os.environ.get('ARTIFACT_MIRROR'),
+                        help='''a directory of artifacts, looked up by file name
+                                before downloading (default: $ARTIFACT_MIRROR)''')
+    parser.add_argument('--offline', dest='offline', action='store_true',
+                        default=bool(os.environ.get('ARTIFACT_OFFLINE')),
+                        help='never download (default: set if $ARTIFACT_OFFLINE)')
+    args = parser.parse_args()
+
+    store = ArtifactStore(args.store)
+    blob = store.fetch(args.url, args.sha256, args.mirror, args.offline)
+    if args.command == 'extract':
+        print store.extract(args.url, blob)
+    else:
+        print blob
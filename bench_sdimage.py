@@ -0,0 +1,441 @@
+#!/usr/bin/env python
+#-
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# Copyright (c) 2018 A. Theodore Markettos
+# All rights reserved.
+#
+# This software was developed by SRI International and the University of
+# Cambridge Computer Laboratory (Department of Computer Science and
+# Technology) under DARPA contract HR0011-18-C-0016 ("ECATS"), as part of the
+# DARPA SSITH research programme.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+# Benchmarks make_sdimage.py.
+#
+# Compares the backends on an image of your own: the same image is built with
+# each of them, a few times, and the best run of each is reported.
+#
+#   bench_sdimage.py -s 256M -P tree,num=1,format=ext4,size=128M [-P ...]
+#
+# Or runs the suite: synthetic inputs (many small files, a few large files,
+# raw blobs) built into every file system format by every backend.
+#
+#   bench_sdimage.py --suite [--json results.json] [--baseline old.json]
+#
+# Every run reports MB/s and files/s of payload, the peak RSS of the build
+# and the time of each of its stages. Backends and formats that can't run
+# here (no root, no libguestfs, no mkfs.xfs...) are skipped.
+
+import os
+import sys
+import argparse
+import subprocess
+import json
+import shutil
+import tempfile
+import random
+import struct
+import time
+import platform
+
+from make_sdimage import BACKENDS, parse_all_parts_args, expand_sources, \
+                         get_tarball, align_up, DEFAULT_ALIGN, \
+                         FIRST_PARTITION_MIN_START
+
+SCRIPT_PATH = os.path.dirname(os.path.abspath(__file__))
+MAKE_SDIMAGE = os.path.join(SCRIPT_PATH, "make_sdimage.py")
+
+MiB = 1024*1024
+# the synthetic inputs of the suite, at scale 1: trees of 'files' files of
+#! 'size' bytes, or a single raw blob
+SUITE_INPUTS = {'small-files': {'kind': 'tree', 'files': 2000, 'size': 4096},
+                'large-files': {'kind': 'tree', 'files': 4, 'size': 32*MiB},
+                'raw-1M': {'kind': 'blob', 'size': 1*MiB},
+                'raw-64M': {'kind': 'blob', 'size': 64*MiB}}
+SUITE_FORMATS = ["ext2", "ext3", "ext4", "xfs", "vfat", "fat32", "raw"]
+# room for the file system around the payload
+PARTITION_SLACK = 48*MiB
+# fat32 needs at least 32MB, and mkfs.xfs 300MB
+MIN_PARTITION_SIZE = {'fat32': 64*MiB, 'xfs': 320*MiB}
+# the first partition starts on the first alignment boundary past 1MB, and
+#! an alignment unit is left spare after it
+IMAGE_SLACK = align_up(FIRST_PARTITION_MIN_START, DEFAULT_ALIGN) + \
+              DEFAULT_ALIGN
+# the seed of the synthetic data, which is the same on every machine
+DATA_SEED = 2018
+# a run this much slower than the baseline is a regression (%)
+MAX_REGRESSION = 10.0
+
+#==============================================================================
+# the bytes and files a partition spec copies into the image
+def get_payload(part_args):
+
+    nbytes = 0
+    nfiles = 0
+    part_entries = parse_all_parts_args(part_args)
+    for part in part_entries.keys():
+        pentry = part_entries[part]
+        if get_tarball(pentry):
+            sources = [s for s in pentry['files'] if s != "-"]
+        else:
+            sources = expand_sources(pentry)
+        for source in sources:
+            if not os.path.isdir(source):
+                nbytes = nbytes + os.path.getsize(source)
+                nfiles = nfiles + 1
+                continue
+            for (root, dirs, files) in os.walk(source):
+                for name in files:
+                    path = os.path.join(root, name)
+                    if os.path.isfile(path) and not os.path.islink(path):
+                        nbytes = nbytes + os.path.getsize(path)
+                    nfiles = nfiles + 1
+
+    return (nbytes, nfiles)
+
+#==============================================================================
+# builds the image once with a backend
+# returns the report of make_sdimage.py, with the peak RSS of the build
+#! added, None if the backend can't run here
+def run_backend(backend, part_args, size, workdir):
+
+    image_name = os.path.join(workdir, "bench-"+backend+".img")
+    report_name = image_name+".json"
+    cmd = [sys.executable, MAKE_SDIMAGE, "-f", "--no-bmap", "-n", image_name,
+           "-s", size, "--backend", backend, "--report", report_name]
+    for part in part_args:
+        cmd.append("-P"+part)
+
+    log = tempfile.TemporaryFile()
+    p = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT)
+    # the peak RSS of make_sdimage.py, or of the largest tool it ran
+    (pid, status, rusage) = os.wait4(p.pid, 0)
+    # as Popen would have decoded it
+    if os.WIFSIGNALED(status):
+        p.returncode = -os.WTERMSIG(status)
+    else:
+        p.returncode = os.WEXITSTATUS(status)
+    log.seek(0)
+    output = log.read()
+    log.close()
+    try:
+        if p.returncode != 0:
+            if "no backend can build this image" in output:
+                return None
+            print "error:", backend, ": the build failed (", p.returncode, ")"
+            print output.rstrip()
+            sys.exit(-1)
+        report = json.load(open(report_name))
+        report['max_rss'] = rusage.ru_maxrss * 1024
+        return report
+    finally:
+        for name in [image_name, report_name, image_name+".manifest"]:
+            if os.path.exists(name):
+                os.remove(name)
+
+#==============================================================================
+# the wall time of the stages of a report, summed by stage name
+def get_stage_times(report):
+
+    times = {}
+    for record in report['stages']:
+        times[record['stage']] = times.get(record['stage'], 0) + \
+                                 record['wall']
+
+    return times
+
+#==============================================================================
+# builds an image with a backend, 'runs' times
+# returns the result of the best run, None if the backend can't run here
+def bench_backend(backend, part_args, size, runs, workdir):
+
+    (nbytes, nfiles) = get_payload(part_args)
+    best = None
+    for i in range(runs):
+        report = run_backend(backend, part_args, size, workdir)
+        if report is None:
+            return None
+        if best is None or report['wall'] < best['wall']:
+            best = report
+
+    return {'wall': best['wall'],
+            'payload_bytes': nbytes,
+            'payload_files': nfiles,
+            'mb_per_s': float(nbytes) / best['wall'] / MiB,
+            'files_per_s': nfiles / best['wall'],
+            'max_rss': best['max_rss'],
+            'image_allocated': best['image_allocated'],
+            'stages': get_stage_times(best)}
+
+#==============================================================================
+# builds the image with every backend
+# returns {backend: result}
+def compare_backends(backends, part_args, size, runs, workdir):
+
+    results = {}
+    for backend in backends:
+        result = bench_backend(backend, part_args, size, runs, workdir)
+        if result is None:
+            print "info:", backend, ": not available here"
+        else:
+            results[backend] = result
+
+    return results
+
+#==============================================================================
+# one MB of pseudo random data, the same on every machine
+def get_data_block():
+
+    rand = random.Random(DATA_SEED)
+    return struct.pack("<%dQ" % (MiB/8),
+                       *[rand.getrandbits(64) for i in range(MiB/8)])
+
+#==============================================================================
+# writes a file of synthetic data, its number stamped in every MB so that
+#! no two files are the same
+def write_data_file(path, size, number, block):
+
+    f = open(path, 'wb')
+    try:
+        pos = 0
+        while pos < size:
+            chunk = struct.pack("<QQ", number, pos) + block[16:]
+            f.write(chunk[:size - pos])
+            pos = pos + len(chunk)
+    finally:
+        f.close()
+
+    return
+
+#==============================================================================
+# generates the inputs of the suite under 'inputs_dir', unless they are
+#! there already at this scale
+# returns {input name: path}
+def make_suite_inputs(inputs_dir, scale):
+
+    paths = {}
+    for name in SUITE_INPUTS.keys():
+        paths[name] = os.path.join(inputs_dir, name)
+
+    stamp = os.path.join(inputs_dir, "scale")
+    try:
+        if float(open(stamp).read()) == scale:
+            return paths
+    except (IOError, ValueError):
+        pass
+
+    print "info: generating the inputs in", inputs_dir
+    shutil.rmtree(inputs_dir, ignore_errors=True)
+    os.makedirs(inputs_dir)
+    block = get_data_block()
+    for name in sorted(SUITE_INPUTS.keys()):
+        spec = SUITE_INPUTS[name]
+        if spec['kind'] == 'blob':
+            write_data_file(paths[name], int(spec['size'] * scale), 0, block)
+            continue
+        os.makedirs(paths[name])
+        nfiles = max(1, int(spec['files'] * scale))
+        for i in range(nfiles):
+            # 100 files per directory
+            d = os.path.join(paths[name], "d%03d" % (i / 100))
+            if not os.path.isdir(d):
+                os.makedirs(d)
+            write_data_file(os.path.join(d, "f%05d" % i), spec['size'], i,
+                            block)
+    open(stamp, 'w').write(str(scale))
+
+    return paths
+
+#==============================================================================
+# the partition and image sizes for a payload, in bytes
+def get_suite_sizes(pformat, nbytes, nfiles):
+
+    if pformat == "raw":
+        size = nbytes
+    else:
+        # a block (cluster, inode...) or two per file
+        size = nbytes + nfiles * 8192 + PARTITION_SLACK
+    size = max(size, MIN_PARTITION_SIZE.get(pformat, 0))
+    size = (size + MiB - 1) / MiB * MiB
+
+    return (size, size + IMAGE_SLACK)
+
+#==============================================================================
+# runs the suite: every input into every format it fits, with every backend
+# returns {"format/input/backend": result}, what can't run here is left out
+def run_suite(backends, formats, scale, runs, workdir):
+
+    inputs = make_suite_inputs(os.path.join(workdir, "inputs"), scale)
+    results = {}
+    for pformat in formats:
+        for name in sorted(inputs.keys()):
+            # blobs go in raw partitions only, trees in file systems
+            if (SUITE_INPUTS[name]['kind'] == 'blob') != (pformat == "raw"):
+                continue
+            part = inputs[name]+",num=1,format="+pformat
+            if pformat == "raw":
+                part = part + ",type=A2"
+            (nbytes, nfiles) = get_payload([part+",size=1M"])
+            (size, image_size) = get_suite_sizes(pformat, nbytes, nfiles)
+            part_args = [part+",size="+str(size/MiB)+"M"]
+            for backend in backends:
+                case = pformat+"/"+name+"/"+backend
+                result = bench_backend(backend, part_args,
+                                       str(image_size/MiB)+"M", runs, workdir)
+                if result is None:
+                    print "info:", case, ": can't run here"
+                    continue
+                print "info: %s: %.3f s, %.1f MB/s, %.0f files/s" % \
+                      (case, result['wall'], result['mb_per_s'],
+                       result['files_per_s'])
+                results[case] = result
+
+    return results
+
+#==============================================================================
+# compares results with a baseline (the results of an earlier --json)
+# returns the cases that got more than 'max_regression' percent slower
+def compare_baseline(results, baseline, max_regression):
+
+    regressions = []
+    print "%-36s %10s %10s %8s" % ("case", "base (s)", "now (s)", "change")
+    for case in sorted(results.keys()):
+        if case not in baseline:
+            continue
+        old = baseline[case]['wall']
+        new = results[case]['wall']
+        change = (new - old) / old * 100
+        flag = ""
+        if change > max_regression:
+            flag = "  slower"
+            regressions.append(case)
+        print "%-36s %10.3f %10.3f %+7.1f%%%s" % (case, old, new, change, flag)
+
+    return regressions
+
+#==============================================================================
+# prints the results as a table, fastest first
+def print_results(results):
+
+    print "%-36s %10s %10s %12s %10s" % ("case", "wall (s)", "MB/s",
+                                         "files/s", "RSS (MB)")
+    for case in sorted(results.keys(), key=lambda c: results[c]['wall']):
+        r = results[case]
+        print "%-36s %10.3f %10.1f %12.1f %10.1f" % \
+              (case, r['wall'], r['mb_per_s'], r['files_per_s'],
+               float(r['max_rss']) / MiB)
+
+    return
+
+#==============================================================================
+# main
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='''Benchmarks make_sdimage.py:
+                                     builds an image with each backend, or runs
+                                     the suite of synthetic inputs''')
+    parser.add_argument('-P', dest='part_args', action='append', default=None,
+                        help='a partition, as given to make_sdimage.py')
+    parser.add_argument('-s', dest='size', action='store', default='8G',
+                        help='the size of the image (default: 8G)')
+    parser.add_argument('--suite', dest='suite', action='store_true',
+                        default=False, help='''runs the suite instead of building
+                                the image given by -P''')
+    parser.add_argument('--formats', dest='formats', action='store',
+                        default=",".join(SUITE_FORMATS),
+                        help='''the formats of the suite, separated by commas
+                                (default: all)''')
+    parser.add_argument('--scale', dest='scale', action='store', type=float,
+                        default=1.0, help='''scales the number and size of the
+                                files of the suite (default: 1)''')
+    parser.add_argument('-b', dest='backends', action='store',
+                        default=",".join(sorted(BACKENDS.keys())),
+                        help='''the backends to compare, separated by commas
+                                (default: all)''')
+    parser.add_argument('-r', dest='runs', action='store', type=int, default=3,
+                        help='runs per backend, the best one counts (default: 3)')
+    parser.add_argument('-d', dest='workdir', action='store', default=None,
+                        help='''where to build the images, and keep the inputs of
+                                the suite (default: a temporary directory)''')
+    parser.add_argument('--json', dest='json', action='store', default=None,
+                        help='also writes the results to this JSON file')
+    parser.add_argument('--baseline', dest='baseline', action='store',
+                        default=None, help='''compares the results with this JSON
+                                file, written by --json earlier. Exits with an
+                                error if some case got slower''')
+    parser.add_argument('--max-regression', dest='max_regression',
+                        action='store', type=float, default=MAX_REGRESSION,
+                        help='''how much slower than the baseline a case may get,
+                                in percent (default: %.0f)''' % MAX_REGRESSION)
+    args = parser.parse_args()
+
+    backends = args.backends.split(",")
+    for backend in backends:
+        if backend not in BACKENDS:
+            print "error:", backend, ": no such backend"
+            sys.exit(-1)
+    formats = args.formats.split(",")
+    for pformat in formats:
+        if pformat not in SUITE_FORMATS:
+            print "error:", pformat, ": no such format"
+            sys.exit(-1)
+    if not args.suite and not args.part_args:
+        print "error: give the partitions (-P) or run the suite (--suite)"
+        sys.exit(-1)
+
+    baseline = None
+    if args.baseline:
+        try:
+            baseline = json.load(open(args.baseline))['results']
+        except (IOError, ValueError, KeyError) as e:
+            print "error:", args.baseline, ":", e
+            sys.exit(-1)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bench_sdimage_")
+    try:
+        if args.suite:
+            results = run_suite(backends, formats, args.scale,
+                                max(1, args.runs), workdir)
+        else:
+            results = compare_backends(backends, args.part_args, args.size,
+                                       max(1, args.runs), workdir)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if not results:
+        print "error: nothing could run"
+        sys.exit(-1)
+    print_results(results)
+    if args.json:
+        json.dump({'date': time.strftime("%Y-%m-%dT%H:%M:%S"),
+                   'host': platform.node(),
+                   'cpus': os.sysconf("SC_NPROCESSORS_ONLN"),
+                   'argv': sys.argv,
+                   'results': results},
+                  open(args.json, 'w'), indent=1, sort_keys=True)
+    if baseline is not None:
+        if compare_baseline(results, baseline, args.max_regression):
+            sys.exit(1)
@@ -36,34 +36,100 @@
 COMPILER_FILE="gcc-linaro-7.2.1-2017.11-x86_64_arm-linux-gnueabihf"
 COMPILER_URL="https://releases.linaro.org/components/toolchain/binaries/7.2-2017.11/arm-linux-gnueabihf/${COMPILER_FILE}.tar.xz"
 CWD=$(pwd)
-CPUS=8
+SCRIPT_NAME=$(readlink -f "$0")
+SCRIPT_PATH=$(dirname "$SCRIPT_NAME")
 
+KERNEL_REPO="https://github.com/altera-opensource/linux-socfpga"
 KERNEL_BRANCH="socfpga-5.1"
+# the commit to build, pin it to a hash for reproducible builds
+KERNEL_COMMIT=${KERNEL_COMMIT:-origin/$KERNEL_BRANCH}
+KERNEL_DEFCONFIG="socfpga_defconfig"
+# config fragments merged over the defconfig, separated by spaces
+KERNEL_CONFIG_FRAGMENTS=${KERNEL_CONFIG_FRAGMENTS:-}
+# the objects are kept out of the tree, between builds
+KERNEL_BUILD_DIR=${KERNEL_BUILD_DIR:-$CWD/linux-build}
+CCACHE_DIR=${CCACHE_DIR:-$HOME/.cache/socfpga-ccache}
+
+# one job per core, as long as each gets 512MB of memory
+if [ -z "$JOBS" ] ; then
+	JOBS=$(nproc)
+	MEM_JOBS=$(awk '/^MemAvailable:/ { print int($2 / (512 * 1024)) }' /proc/meminfo)
+	if [ -n "$MEM_JOBS" ] && [ "$MEM_JOBS" -lt "$JOBS" ] ; then
+		JOBS=$MEM_JOBS
+	fi
+	if [ "$JOBS" -lt 1 ] ; then
+		JOBS=1
+	fi
+fi
 
 echo "Fetching compiler..."
-wget -c $COMPILER_URL
-echo "Untarring compiler..."
-tar xJf $COMPILER_FILE.tar.xz
-export CROSS_COMPILE=$CWD/$COMPILER_FILE/bin/arm-linux-gnueabihf-
+# downloaded and untarred once, in the shared artifact store
+COMPILER_TREE=$($SCRIPT_PATH/artifact_cache.py extract $COMPILER_URL)
+export CROSS_COMPILE=$COMPILER_TREE/$COMPILER_FILE/bin/arm-linux-gnueabihf-
 
 if [ -d linux-socfpga ] ; then
-	echo "Cleaning and updating to upstream Linux source..."
+	echo "Updating Linux source..."
 	cd linux-socfpga
 	git fetch origin
-	git reset --hard origin/master
 else
 	echo "Fetching Linux source..."
-	git clone https://github.com/altera-opensource/linux-socfpga
+	git clone $KERNEL_REPO
 	cd linux-socfpga
-	git checkout $KERNEL_BRANCH
 fi
+# a detached checkout leaves the untouched files, and their objects, alone
+git checkout -q --detach $KERNEL_COMMIT
+COMMIT=$(git rev-parse HEAD)
 
+FRAGMENTS=""
+for FRAGMENT in $KERNEL_CONFIG_FRAGMENTS ; do
+	case $FRAGMENT in
+		/*) ;;
+		*) FRAGMENT=$CWD/$FRAGMENT ;;
+	esac
+	if [ ! -f "$FRAGMENT" ] ; then
+		echo "Config fragment $FRAGMENT not found"
+		exit 1
+	fi
+	FRAGMENTS="$FRAGMENTS $FRAGMENT"
+done
+
+# the build is redone only when the source, the config or the compiler change
+STAMP=$( (echo $COMMIT $KERNEL_DEFCONFIG $CROSS_COMPILE
+	  for FRAGMENT in $FRAGMENTS ; do cat $FRAGMENT ; done) | sha256sum | cut -d' ' -f1)
+if [ -f "$KERNEL_BUILD_DIR/.socfpga-stamp" ] && \
+   [ "$(cat $KERNEL_BUILD_DIR/.socfpga-stamp)" = "$STAMP" ] && \
+   [ -f "$KERNEL_BUILD_DIR/arch/arm/boot/zImage" ] ; then
+	echo "Linux $COMMIT already built, config unchanged"
+	cp -a $KERNEL_BUILD_DIR/arch/arm/boot/zImage $CWD/
+	exit 0
+fi
 
 export ARCH=arm
+MAKE="make O=$KERNEL_BUILD_DIR -j$JOBS"
+if [ "$CCACHE" != "0" ] && command -v ccache > /dev/null ; then
+	echo "Using ccache in $CCACHE_DIR"
+	export CCACHE_DIR
+	MAKE="$MAKE CC=ccache\ ${CROSS_COMPILE}gcc"
+fi
+
+# O= builds refuse a source tree configured in place
+if [ -f .config ] ; then
+	make mrproper
+fi
+mkdir -p $KERNEL_BUILD_DIR
+rm -f $KERNEL_BUILD_DIR/.socfpga-stamp
+
 echo "Configuring Linux source..."
 # may need to install ncurses-devel or ncurses-dev package for this step
-make socfpga_defconfig
+eval $MAKE $KERNEL_DEFCONFIG
+if [ -n "$FRAGMENTS" ] ; then
+	scripts/kconfig/merge_config.sh -m -O $KERNEL_BUILD_DIR \
+		$KERNEL_BUILD_DIR/.config $FRAGMENTS
+	eval $MAKE olddefconfig
+fi
 # change any options here
-#make menuconfig
-make zImage -j$CPUS
-cp -a arch/arm/boot/zImage ../
\ No newline at end of file
+#make O=$KERNEL_BUILD_DIR menuconfig
+echo "Building Linux $COMMIT with $JOBS jobs..."
+eval $MAKE zImage
+echo $STAMP > $KERNEL_BUILD_DIR/.socfpga-stamp
+cp -a $KERNEL_BUILD_DIR/arch/arm/boot/zImage $CWD/
@@ -0,0 +1,594 @@
+#!/usr/bin/env python
+#-
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# Copyright (c) 2018 A. Theodore Markettos
+# All rights reserved.
+#
+# This software was developed by SRI International and the University of
+# Cambridge Computer Laboratory (Department of Computer Science and
+# Technology) under DARPA contract HR0011-18-C-0016 ("ECATS"), as part of the
+# DARPA SSITH research programme.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+# Runs the stages of build_ubuntu_sdcard.sh as a dependency graph: stages
+# that don't depend on each other run concurrently, and each one starts as
+# soon as the stages it needs are done. Every stage logs to its own file and
+# is timed; the critical path of the build is reported at the end.
+#
+# Each stage is fingerprinted by hashing its inputs (source trees, FPGA
+# outputs, package list, the scripts it runs, the fingerprints of the stages
+# it depends on). A stage whose fingerprint is the one of its last good run
+# is skipped, and its outputs are reused.
+#
+#   build_sdcard.py <FPGA dir> <Quartus project> <Qsys project> [payload] [packages...]
+
+import os
+import sys
+import re
+import glob
+import shutil
+import hashlib
+import argparse
+import subprocess
+import json
+import threading
+import time
+import Queue
+
+from make_sdimage import Popen, StageTimer, report_stages, stage_records, \
+                         stage_records_lock
+from artifact_cache import hash_file
+
+SCRIPT_PATH = os.path.dirname(os.path.abspath(__file__))
+BUILD_SCRIPT = os.path.join(SCRIPT_PATH, "build_ubuntu_sdcard.sh")
+DTB = "socfpga_arria10_socdk_sdmmc.dtb"
+SD_IMAGE = "sdimage.img"
+
+# fingerprints of the last good run of each stage, and copies of what they
+#! built
+FINGERPRINTS = ".build-fingerprints.json"
+ARTIFACT_DIR = ".build-artifacts"
+
+#==============================================================================
+# the value of a variable set in one of our shell scripts
+def script_var(script, name):
+
+    m = re.search("^"+name+"=\"?([^\"\n]*)\"?$",
+                  open(os.path.join(SCRIPT_PATH, script)).read(), re.M)
+    if m is None:
+        print "error:", script, ": no", name
+        sys.exit(-1)
+
+    return m.group(1)
+
+# as named by fetch_ubuntu.sh
+ROOTFS_IMAGE = script_var("fetch_ubuntu.sh", "UBUNTU_FILE")+".rootfs.img"
+# where it is mounted from the ubuntu stage until the tidy stage
+ROOTFS_MOUNT = "mnt/2"
+
+# the stages, as run by build_ubuntu_sdcard.sh:
+#!   deps     the stages it needs
+#!   outputs  the files it produces in the working directory, kept in
+#!            ARTIFACT_DIR if 'keep' is set
+#!   inputs   what its fingerprint is made of, given the build arguments:
+#!            ('file'|'tree'|'glob', path), ('text', value) or
+#!            ('git', repository, branch). None: the stage always runs
+#!   scripts  the scripts it runs, part of its fingerprint
+#!   on_skip  the stage run instead when it is skipped
+#!   sudo     asks for a password, which is done once, up front
+STAGES = {
+    'ubuntu':     {'deps': [], 'outputs': [ROOTFS_IMAGE], 'on_skip': 'rootfs',
+                   'inputs': lambda b: [('text', " ".join(b['packages'])),
+                                        ('tree', b['payload']),
+                                        ('text', os.environ.get(
+                                                    'GROW_ROOTFS', "")),
+                                        ('text', os.environ.get(
+                                                    'UBUNTU_SHA256', "")),
+                                        ('text', os.environ.get(
+                                                    'NATIVE_UNPACK', "")),
+                                        ('text', os.environ.get(
+                                                    'LOCAL_REPO', ""))],
+                   'scripts': ["fetch_ubuntu.sh", "ingest_ubuntu.py",
+                               "configure_system.sh",
+                               "configure_networking.sh",
+                               "ubuntu_packages.sh", "native_install.sh",
+                               "make_local_repo.sh"],
+                   'sudo': True},
+    'kernel':     {'deps': [], 'outputs': ["zImage"], 'keep': True,
+                   'inputs': lambda b: [('git',
+                                         script_var("build_linux.sh",
+                                                    "KERNEL_REPO"),
+                                         script_var("build_linux.sh",
+                                                    "KERNEL_BRANCH")),
+                                        ('text', os.environ.get(
+                                                    'KERNEL_COMMIT', ""))] +
+                                       [('file', f) for f in os.environ.get(
+                                        'KERNEL_CONFIG_FRAGMENTS', "").split()],
+                   'scripts': ["build_linux.sh"]},
+    'uboot':      {'deps': [], 'outputs': ["uboot_w_dtb-mkpimage.bin"],
+                   'keep': True,
+                   'inputs': lambda b: [('tree', os.path.join(b['fpga_dir'],
+                                                 "hps_isw_handoff"))],
+                   'scripts': ["make_uboot.sh"]},
+    'devicetree': {'deps': [], 'outputs': [DTB], 'keep': True,
+                   'inputs': lambda b: [('file', os.path.join(b['fpga_dir'],
+                                                 b['qsys']+".sopcinfo")),
+                                        ('glob', os.path.join(b['fpga_dir'],
+                                                 "*.dtsi")),
+                                        ('glob', os.path.join(b['fpga_dir'],
+                                                 "*_board_info.xml"))],
+                   'scripts': ["make_device_tree.sh"]},
+    'bitfile':    {'deps': [], 'outputs': ["socfpga.rbf"], 'keep': True,
+                   'inputs': lambda b: [('file', os.path.join(b['fpga_dir'],
+                                         "output_files",
+                                         b['project']+".rbf"))],
+                   'scripts': []},
+    'sdimage':    {'deps': ['ubuntu', 'kernel', 'uboot', 'devicetree',
+                            'bitfile'],
+                   'outputs': [SD_IMAGE],
+                   'inputs': lambda b: [], 'scripts': ["make_sdimage.py",
+                                                       "sdcard_layout.json"],
+                   'sudo': True},
+    'tidy':       {'deps': ['sdimage'], 'outputs': [], 'inputs': None,
+                   'sudo': True},
+}
+
+# fingerprints, and a lock as the stages run in threads
+fingerprints = {}
+fingerprints_lock = threading.Lock()
+# stages skipped as unchanged
+skipped_stages = []
+
+#==============================================================================
+# returns the stages to run, with their dependencies, in a runnable order
+#! dependencies not selected are taken as already built
+def select_stages(names):
+
+    for name in names:
+        if name not in STAGES:
+            print "error:", name, ": unknown stage, choose from", \
+                  " ".join(sorted(STAGES.keys()))
+            sys.exit(-1)
+
+    order = []
+    def visit(name, path):
+        if name in path:
+            print "error: dependency loop:", " -> ".join(path + [name])
+            sys.exit(-1)
+        if name in order:
+            return
+        for dep in STAGES[name]['deps']:
+            if dep in names:
+                visit(dep, path + [name])
+        order.append(name)
+    for name in names:
+        visit(name, [])
+
+    return order
+
+#==============================================================================
+# the build arguments, by name, as build_ubuntu_sdcard.sh takes them
+def get_build_inputs(build_args):
+
+    build_args = build_args + [""] * (4 - len(build_args))
+    return {'fpga_dir': build_args[0], 'project': build_args[1],
+            'qsys': build_args[2], 'payload': build_args[3],
+            'packages': build_args[4:]}
+
+#==============================================================================
+# the commit a branch of a repository is at: asked to the repository, or
+#! taken from our clone when offline. None if unknown
+def get_branch_commit(repository, branch):
+
+    try:
+        p = Popen(["git", "ls-remote", repository, "refs/heads/"+branch],
+                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output = p.communicate()[0]
+        if p.returncode == 0 and output.split():
+            return output.split()[0]
+        clone = os.path.basename(repository)
+        p = Popen(["git", "-C", clone, "rev-parse", "origin/"+branch],
+                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output = p.communicate()[0]
+        if p.returncode == 0:
+            return output.strip()
+    except OSError:
+        pass
+
+    return None
+
+#==============================================================================
+# adds one input to a fingerprint
+# returns False if the input can't be fingerprinted
+def hash_input(h, item):
+
+    kind = item[0]
+    h.update(kind+"\0"+"\0".join(item[1:])+"\0")
+    if kind == 'text':
+        pass
+    elif kind == 'git':
+        commit = get_branch_commit(item[1], item[2])
+        if commit is None:
+            return False
+        h.update(commit)
+    elif kind == 'file':
+        if os.path.isfile(item[1]):
+            h.update(hash_file(item[1]))
+    elif kind == 'glob':
+        for path in sorted(glob.glob(item[1])):
+            h.update(os.path.basename(path)+"\0"+hash_file(path))
+    elif kind == 'tree':
+        if not item[1]:
+            return True
+        for (root, dirs, files) in os.walk(item[1]):
+            dirs.sort()
+            for name in sorted(files + [d for d in dirs
+                                        if os.path.islink(os.path.join(root,
+                                                                       d))]):
+                path = os.path.join(root, name)
+                st = os.lstat(path)
+                h.update(os.path.relpath(path, item[1])+"\0%o\0" % st.st_mode)
+                if os.path.islink(path):
+                    h.update(os.readlink(path))
+                elif os.path.isfile(path):
+                    h.update(hash_file(path))
+
+    return True
+
+#==============================================================================
+# the fingerprint of a stage: its inputs, its scripts, and the fingerprints
+#! of the stages it depends on
+# returns None when the stage must run anyway
+def stage_fingerprint(name, build):
+
+    stage = STAGES[name]
+    if stage['inputs'] is None:
+        return None
+
+    h = hashlib.sha256()
+    for item in stage['inputs'](build):
+        if not hash_input(h, item):
+            return None
+    for script in ["build_ubuntu_sdcard.sh"] + stage['scripts']:
+        h.update(hash_file(os.path.join(SCRIPT_PATH, script)))
+    for dep in stage['deps']:
+        with fingerprints_lock:
+            dep_fingerprint = fingerprints.get(dep, {}).get('fingerprint')
+        if dep_fingerprint is None:
+            return None
+        h.update(dep+"\0"+dep_fingerprint)
+
+    return h.hexdigest()
+
+#==============================================================================
+# a file's signature, to tell whether it was changed
+def file_signature(path):
+
+    st = os.stat(path)
+    return [st.st_size, int(st.st_mtime)]
+
+#==============================================================================
+# true if the outputs of the last good run of a stage are there, or could
+#! be put back from ARTIFACT_DIR (which is done)
+def restore_outputs(name):
+
+    stage = STAGES[name]
+    with fingerprints_lock:
+        recorded = dict(fingerprints[name].get('outputs', {}))
+
+    for output in stage['outputs']:
+        if output not in recorded:
+            return False
+        if not stage.get('keep'):
+            if not os.path.exists(output):
+                return False
+            continue
+        if os.path.exists(output) and file_signature(output) == recorded[output]:
+            continue
+        kept = os.path.join(ARTIFACT_DIR, name, os.path.basename(output))
+        if not os.path.exists(kept) or file_signature(kept) != recorded[output]:
+            return False
+        shutil.copy2(kept, output)
+
+    return True
+
+#==============================================================================
+# records a good run of a stage, keeping a copy of its outputs
+def record_outputs(name, fingerprint):
+
+    stage = STAGES[name]
+    outputs = {}
+    for output in stage['outputs']:
+        if stage.get('keep'):
+            kept_dir = os.path.join(ARTIFACT_DIR, name)
+            try:
+                os.makedirs(kept_dir)
+            except OSError:
+                pass
+            shutil.copy2(output, os.path.join(kept_dir,
+                                              os.path.basename(output)))
+        outputs[output] = file_signature(output)
+
+    with fingerprints_lock:
+        fingerprints[name] = {'fingerprint': fingerprint, 'outputs': outputs,
+                              'time': time.time()}
+        f = open(FINGERPRINTS+".tmp", 'w')
+        json.dump(fingerprints, f, indent=1, sort_keys=True)
+        f.close()
+        os.rename(FINGERPRINTS+".tmp", FINGERPRINTS)
+
+    return
+
+#==============================================================================
+# runs one stage of build_ubuntu_sdcard.sh, its output going to its log
+# returns the exit code
+def run_stage(name, build_args, log_dir, procs, force=False):
+
+    log_name = os.path.join(log_dir, name+".log")
+    fingerprint = stage_fingerprint(name, get_build_inputs(build_args))
+    with fingerprints_lock:
+        last = fingerprints.get(name, {}).get('fingerprint')
+    if not force and fingerprint is not None and fingerprint == last and \
+       restore_outputs(name):
+        skipped_stages.append(name)
+        # one write, as other stages print meanwhile
+        sys.stdout.write("info: stage "+name+" unchanged, skipped\n")
+        open(log_name, 'w').write("unchanged ("+fingerprint+"), skipped\n")
+        if 'on_skip' not in STAGES[name]:
+            return 0
+        name = STAGES[name]['on_skip']
+        log_name = os.path.join(log_dir, name+".log")
+        fingerprint = None
+
+    env = dict(os.environ)
+    env['BUILD_STAGES'] = name
+    log = open(log_name, 'w')
+    try:
+        p = Popen([BUILD_SCRIPT] + build_args, env=env, stdin=open(os.devnull),
+                  stdout=log, stderr=subprocess.STDOUT)
+        procs[name] = p
+        returncode = p.wait()
+    finally:
+        log.close()
+
+    if returncode == 0 and name in STAGES:
+        for output in STAGES[name]['outputs']:
+            if not os.path.exists(output):
+                log = open(log_name, 'a')
+                log.write("error: "+output+" was not built\n")
+                log.close()
+                returncode = -1
+        if returncode == 0 and fingerprint is not None:
+            record_outputs(name, fingerprint)
+
+    return returncode
+
+#==============================================================================
+# thread running a stage, reports its end on 'done'
+def stage_worker(name, build_args, log_dir, procs, force, done):
+
+    returncode = -1
+    try:
+        with StageTimer(name):
+            returncode = run_stage(name, build_args, log_dir, procs, force)
+            if returncode != 0:
+                raise RuntimeError(name)
+    except Exception as e:
+        if not isinstance(e, RuntimeError):
+            print "error: stage", name, ":", e
+    finally:
+        done.put((name, returncode))
+
+#==============================================================================
+# the last lines of a log, to show why a stage failed
+def log_tail(log_name, lines=20):
+
+    try:
+        return "".join(open(log_name).readlines()[-lines:])
+    except IOError:
+        return ""
+
+#==============================================================================
+# runs the stages, at most 'jobs' at a time
+# returns the list of the stages that failed
+def run_graph(order, build_args, log_dir, jobs, force=False):
+
+    pending = list(order)
+    running = []
+    finished = []
+    failed = []
+    procs = {}
+    done = Queue.Queue()
+
+    try:
+        while pending or running:
+            # start what can be started, unless something already failed
+            for name in list(pending):
+                if failed or len(running) >= jobs:
+                    break
+                if [d for d in STAGES[name]['deps']
+                      if d in order and d not in finished]:
+                    continue
+                print "info: stage", name, "started"
+                pending.remove(name)
+                running.append(name)
+                t = threading.Thread(target=stage_worker,
+                                     args=(name, build_args, log_dir, procs,
+                                           force, done))
+                t.daemon = True
+                t.start()
+
+            if not running:
+                # left over: stages that depend on a failed one
+                break
+            # a timeout keeps the wait interruptible
+            while True:
+                try:
+                    (name, returncode) = done.get(True, 1)
+                    break
+                except Queue.Empty:
+                    pass
+            running.remove(name)
+            if returncode == 0:
+                finished.append(name)
+                print "info: stage", name, "done"
+            else:
+                failed.append(name)
+                log_name = os.path.join(log_dir, name+".log")
+                print "error: stage", name, "failed, see", log_name
+                sys.stdout.write(log_tail(log_name))
+    except KeyboardInterrupt:
+        print "error: interrupted, stopping", " ".join(running)
+        for name in running:
+            if name in procs and procs[name].poll() is None:
+                procs[name].terminate()
+        failed.extend(running)
+
+    for name in pending:
+        print "info: stage", name, "not run"
+
+    return failed
+
+#==============================================================================
+# unmounts the root file system, as the tidy stage would have done had the
+#! build not failed
+def unmount_rootfs():
+
+    if os.path.ismount(ROOTFS_MOUNT):
+        print "info: unmounting", ROOTFS_MOUNT
+        if subprocess.call(["sudo", "umount", ROOTFS_MOUNT]) != 0:
+            print "error: failed to unmount", ROOTFS_MOUNT
+
+    return
+
+#==============================================================================
+# the chain of stages that set the length of the build: from the last
+#! stage to finish, back through the dependency that finished last
+def critical_path(records):
+
+    ends = {}
+    for record in records:
+        ends[record['stage']] = record
+    if not ends:
+        return []
+
+    name = max(ends.keys(), key=lambda n: ends[n]['start'] + ends[n]['wall'])
+    path = [name]
+    while True:
+        deps = [d for d in STAGES[name]['deps'] if d in ends]
+        if not deps:
+            break
+        name = max(deps, key=lambda n: ends[n]['start'] + ends[n]['wall'])
+        path.insert(0, name)
+
+    return path
+
+#==============================================================================
+# prints when each stage ran, and the critical path
+def report_graph(records, build_start):
+
+    print "%-12s %10s %10s" % ("stage", "start (s)", "wall (s)")
+    for record in sorted(records, key=lambda r: r['start']):
+        print "%-12s %10.1f %10.1f%s" % (record['stage'],
+                                        record['start'] - build_start,
+                                        record['wall'],
+                                        record['failed'] and "  failed" or "")
+    path = critical_path(records)
+    print "critical path:", " -> ".join(path), "(%.1f s)" % \
+          sum([r['wall'] for r in records if r['stage'] in path])
+
+    return
+
+#==============================================================================
+# main
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='''Builds the SD card image, running
+                                     the independent stages of
+                                     build_ubuntu_sdcard.sh concurrently''')
+    parser.add_argument('build_args', nargs='*',
+                        help='''the arguments of build_ubuntu_sdcard.sh: FPGA
+                                directory, Quartus project, Qsys project,
+                                payload directory, packages''')
+    parser.add_argument('-s', dest='stages', action='append', default=None,
+                        help='''runs only this stage (may be used multiple
+                                times): '''+", ".join(sorted(STAGES.keys())))
+    parser.add_argument('-j', dest='jobs', action='store', type=int,
+                        default=len(STAGES), help='number of stages run at once')
+    parser.add_argument('-f', dest='force', action='store_true',
+                        default=False, help='''runs the stages even when their
+                                inputs are unchanged''')
+    parser.add_argument('--log-dir', dest='log_dir', action='store',
+                        default="build-logs", help='where the stage logs go')
+    parser.add_argument('--report', dest='report', action='store',
+                        default=None, help='''writes the timing of every stage and
+                                the critical path to this JSON file''')
+    args = parser.parse_args()
+
+    order = select_stages(args.stages or sorted(STAGES.keys()))
+    try:
+        os.makedirs(args.log_dir)
+    except OSError:
+        pass
+
+    # the stages run without a terminal: ask for the password now
+    if os.geteuid() != 0 and [n for n in order if STAGES[n].get('sudo')]:
+        if subprocess.call(["sudo", "-v"]) != 0:
+            print "error: sudo is needed to build the image"
+            sys.exit(-1)
+
+    try:
+        fingerprints.update(json.load(open(FINGERPRINTS)))
+    except (IOError, ValueError):
+        pass
+
+    build_start = time.time()
+    failed = None
+    try:
+        failed = run_graph(order, args.build_args, args.log_dir,
+                           max(1, args.jobs), args.force)
+    finally:
+        # a mount left behind would be under the next ubuntu stage
+        if 'tidy' in order and failed != []:
+            unmount_rootfs()
+    with stage_records_lock:
+        records = list(stage_records)
+
+    report_stages()
+    report_graph(records, build_start)
+    if args.report:
+        report = {'wall': time.time() - build_start,
+                  'stages': records,
+                  'critical_path': critical_path(records),
+                  'skipped': skipped_stages,
+                  'failed': failed}
+        try:
+            json.dump(report, open(args.report, 'w'), indent=1,
+                      sort_keys=True)
+        except IOError as e:
+            print "error:", e, ": failed to write the report"
+
+    if failed:
+        sys.exit(-1)
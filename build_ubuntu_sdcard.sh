@@ -40,8 +40,6 @@ PAYLOAD=$4
 FPGA_HANDOFF_DIR=hps_isw_handoff
 FPGA_BITFILE_RBF=$FPGA_DIR/output_files/$FPGA_PROJECT.rbf
 SD_IMAGE=sdimage.img
-ROOT_SIZE_MIB=3270
-SD_SIZE_MIB=3810
 echo $SCRIPT_PATH
 shift
 shift
@@ -66,6 +64,10 @@ function ubuntu() {
 	fi
 }
 
+# mounts the root file system left by a previous ubuntu stage
+function rootfs() {
+	$SCRIPT_PATH/fetch_ubuntu.sh --mount
+}
 
 function kernel() {
 	$SCRIPT_PATH/build_linux.sh
@@ -91,25 +93,32 @@ function sdimage() {
 
 	echo "Building SD card image"
 	sudo rm -f $SD_IMAGE
+	# the partitions are laid out by sdcard_layout.json. The image is as
+	# small as its files allow, the root file system comes last so that it
+	# can grow to the size of the card
 	sudo $SCRIPT_PATH/make_sdimage.py -f	\
-		-P uboot_w_dtb-mkpimage.bin,num=3,format=raw,size=10M,type=A2 \
-		-P mnt/2/*,num=2,format=ext3,size=${ROOT_SIZE_MIB}M \
-		-P zImage,socfpga.rbf,socfpga_arria10_socdk_sdmmc.dtb,num=1,format=vfat,size=500M \
-		-s ${SD_SIZE_MIB}M \
+		--layout $SCRIPT_PATH/sdcard_layout.json \
 		-n $SD_IMAGE
 
 }
 
 
 function tidy() {
-	sudo umount mnt/1 mnt/2
+	sudo umount mnt/2
 }
 
-
-ubuntu
-kernel
-uboot
-devicetree
-bitfile
-sdimage
-tidy
+# the stages to run, in this order: all of them by default. build_sdcard.py
+# runs them one per invocation, the independent ones concurrently
+BUILD_STAGES=${BUILD_STAGES:-"ubuntu kernel uboot devicetree bitfile sdimage tidy"}
+
+for stage in $BUILD_STAGES ; do
+	case $stage in
+	ubuntu|rootfs|kernel|uboot|devicetree|bitfile|sdimage|tidy)
+		$stage
+		;;
+	*)
+		echo "Unknown stage $stage"
+		exit 1
+		;;
+	esac
+done
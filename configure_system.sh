@@ -50,3 +50,48 @@ echo "" | sudo tee -a $ISSUE
 echo "arria10" | sudo tee $INSTALL/etc/hostname
 # prevent sudo from complaining
 echo "127.0.1.1    arria10" | sudo tee -a $INSTALL/etc/hosts
+
+# grow the root file system to the size of the SD card on first boot, the
+# image only holds what its files need (GROW_ROOTFS=0 leaves it as it is)
+if [ "${GROW_ROOTFS:-1}" != "0" ] ; then
+	echo "Installing the first boot root file system grow service"
+	sudo tee $INSTALL/usr/local/sbin/grow-rootfs > /dev/null <<'GROW'
+#!/bin/sh -e
+# grows the partition of the root file system to the end of its disk, then
+# the file system itself, online. Run once, on first boot
+ROOT_DEV=$(findmnt -n -o SOURCE /)
+ROOT_NAME=$(basename $ROOT_DEV)
+PART_NUM=$(cat /sys/class/block/$ROOT_NAME/partition)
+DISK_NAME=$(basename $(readlink -f /sys/class/block/$ROOT_NAME/..))
+DISK_DEV=/dev/$DISK_NAME
+
+echo "grow-rootfs: growing partition $PART_NUM of $DISK_DEV"
+if command -v growpart > /dev/null ; then
+	# exits 1 when there is nothing to grow
+	growpart $DISK_DEV $PART_NUM || [ $? -eq 1 ]
+else
+	# ", +" keeps the start and takes all the space after it
+	echo ", +" | sfdisk --force --no-reread -N $PART_NUM $DISK_DEV
+	partx -u -n $PART_NUM $DISK_DEV
+fi
+resize2fs $ROOT_DEV
+GROW
+	sudo chmod 755 $INSTALL/usr/local/sbin/grow-rootfs
+	sudo tee $INSTALL/etc/systemd/system/grow-rootfs.service > /dev/null <<'GROW'
+[Unit]
+Description=Grow the root file system to the size of the SD card
+After=systemd-remount-fs.service
+
+[Service]
+Type=oneshot
+ExecStart=/usr/local/sbin/grow-rootfs
+ExecStartPost=/bin/systemctl disable grow-rootfs.service
+
+[Install]
+WantedBy=multi-user.target
+GROW
+	# enabled the way systemctl enable would, without running it
+	sudo mkdir -p $INSTALL/etc/systemd/system/multi-user.target.wants
+	sudo ln -sf /etc/systemd/system/grow-rootfs.service \
+		$INSTALL/etc/systemd/system/multi-user.target.wants/grow-rootfs.service
+fi
@@ -34,6 +34,10 @@
 
 UBUNTU_URL="http://cdimage.ubuntu.com/releases/16.04/release"
 UBUNTU_FILE="ubuntu-16.04.4-preinstalled-server-armhf+raspi2"
+# the expected sha256 of the image. When not set, it is taken from the
+# release's SHA256SUMS, which is itself kept in the artifact store: once
+# fetched, the checksum is pinned for every later build
+UBUNTU_SHA256=${UBUNTU_SHA256:-}
 
 # handy functions for driving losetup, based on
 # https://stackoverflow.com/a/39675265
@@ -63,8 +67,40 @@ losd() {
 }
 
 
-wget -c $UBUNTU_URL/$UBUNTU_FILE.img.xz
-unxz $UBUNTU_FILE.img.xz
-los $UBUNTU_FILE.img
-echo $loopdev
+SCRIPT_NAME=$(readlink -f "$0")
+SCRIPT_PATH=$(dirname "$SCRIPT_NAME")
+# only the root file system (partition 2) of the image is used: it is
+# streamed out of the .xz, the rest of the image never reaches the disk
+ROOTFS_IMAGE=$UBUNTU_FILE.rootfs.img
+
+# with --mount, the root file system built by a previous run is mounted
+# again as it is (build_sdcard.py does this when the ubuntu stage is
+# unchanged)
+if [ "$1" != "--mount" ] ; then
+	# the image comes from the shared artifact store (see artifact_cache.py)
+	if [ -z "$UBUNTU_SHA256" ] ; then
+		SUMS=$($SCRIPT_PATH/artifact_cache.py fetch $UBUNTU_URL/SHA256SUMS) || exit 1
+		UBUNTU_SHA256=$(awk -v f="$UBUNTU_FILE.img.xz" \
+			'$2 == f || $2 == "*" f { print $1 }' $SUMS)
+		if [ -z "$UBUNTU_SHA256" ] ; then
+			echo "No checksum for $UBUNTU_FILE.img.xz in $UBUNTU_URL/SHA256SUMS"
+			exit 1
+		fi
+	fi
+	UBUNTU_XZ=$($SCRIPT_PATH/artifact_cache.py fetch --sha256 $UBUNTU_SHA256 \
+		$UBUNTU_URL/$UBUNTU_FILE.img.xz) || exit 1
+	# left mounted by a failed build: the image is about to be rewritten,
+	# it must not be under a mount meanwhile
+	if mountpoint -q mnt/2 ; then
+		echo "Unmounting the previous root file system at mnt/2"
+		sudo umount mnt/2 || exit 1
+	fi
+	$SCRIPT_PATH/ingest_ubuntu.py -p 2 -o $ROOTFS_IMAGE $UBUNTU_XZ || exit 1
+fi
+mkdir -p mnt/2
+if ! mountpoint -q mnt/2 ; then
+	echo "Mounting the root file system at mnt/2"
+	sudo mount -o loop $ROOTFS_IMAGE mnt/2
+fi
+#los $UBUNTU_FILE.img
 #losd $loopdev
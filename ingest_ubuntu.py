@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+#-
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# Copyright (c) 2018 A. Theodore Markettos
+# All rights reserved.
+#
+# This software was developed by SRI International and the University of
+# Cambridge Computer Laboratory (Department of Computer Science and
+# Technology) under DARPA contract HR0011-18-C-0016 ("ECATS"), as part of the
+# DARPA SSITH research programme.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+# Extracts one partition of a (compressed) disk image without writing the
+# whole image out: the image is streamed through its decompressor, the MBR
+# is read from the first sector and only the byte range of the partition is
+# kept, as a sparse file.
+
+import os
+import sys
+import argparse
+import subprocess
+
+from make_sdimage import Popen, parse_mbr, write_at, Progress, \
+                         RAW_BLOCK_SIZE, ZERO_BLOCK
+
+# decompressors, by file name extension. xz and zstd decode with several
+#! threads when the stream was compressed in blocks
+DECOMPRESSORS = {'.xz': ["xz", "-T0", "-d", "-c"],
+                 '.zst': ["zstd", "-T0", "-q", "-d", "-c"],
+                 '.gz': ["gzip", "-d", "-c"]}
+# and by magic number, for files without one of these extensions
+MAGICS = {"\xfd7zXZ\x00": '.xz',
+          "\x28\xb5\x2f\xfd": '.zst',
+          "\x1f\x8b": '.gz'}
+
+# runs of zeros at least this long are left as holes in the output
+SPARSE_BLOCK_SIZE = 64*1024
+SPARSE_ZERO_BLOCK = "\0" * SPARSE_BLOCK_SIZE
+
+#==============================================================================
+# starts the decompressor for an image, "-" reads the image from stdin
+# returns the process, its stdout is the raw image
+def open_image(image_name):
+
+    ext = os.path.splitext(image_name)[1]
+    if image_name == "-":
+        stdin = sys.stdin
+    else:
+        try:
+            stdin = open(image_name, 'rb')
+        except IOError as e:
+            print "error:", image_name, ":", e
+            sys.exit(-1)
+        if ext not in DECOMPRESSORS:
+            magic = stdin.read(6)
+            stdin.seek(0)
+            for m in MAGICS:
+                if magic.startswith(m):
+                    ext = MAGICS[m]
+
+    if ext in DECOMPRESSORS:
+        cmd = DECOMPRESSORS[ext]
+    else:
+        cmd = ["cat"]
+    try:
+        return Popen(cmd, stdin=stdin, stdout=subprocess.PIPE,
+                     bufsize=RAW_BLOCK_SIZE)
+    except OSError as e:
+        print "error:", cmd[0], ":", e
+        sys.exit(-1)
+
+#==============================================================================
+# reads exactly 'length' bytes from a pipe, less only at its end
+def read_full(f, length):
+
+    data = []
+    left = length
+    while left > 0:
+        block = f.read(left)
+        if not block:
+            break
+        data.append(block)
+        left = left - len(block)
+
+    return "".join(data)
+
+#==============================================================================
+# writes a block at 'pos', skipping the runs of zeros
+# returns the number of bytes actually written
+def write_sparse(fd, block, pos):
+
+    written = 0
+    i = 0
+    while i < len(block):
+        # the data up to the next block of zeros goes in one write
+        j = i
+        while j < len(block) and \
+              block[j:j+SPARSE_BLOCK_SIZE] != SPARSE_ZERO_BLOCK[:len(block)-j]:
+            j = j + SPARSE_BLOCK_SIZE
+        if j > i:
+            write_at(fd, block[i:j], pos + i)
+            written = written + min(j, len(block)) - i
+        i = j + SPARSE_BLOCK_SIZE
+
+    return written
+
+#==============================================================================
+# extracts partition 'num' of the image to 'output'
+def ingest_partition(image_name, num, output):
+
+    p = open_image(image_name)
+    mbr = read_full(p.stdout, 512)
+    table = parse_mbr(mbr)
+    if table is None:
+        print "error:", image_name, ": no partition table"
+        p.kill()
+        sys.exit(-1)
+    if num not in table:
+        print "error:", image_name, ": no partition", num
+        p.kill()
+        sys.exit(-1)
+
+    start = table[num]['start'] * 512
+    size = table[num]['bsize'] * 512
+    print "info: partition", num, "of", image_name, "is", size/(1024*1024), \
+          "MiB at", start
+
+    # up to the partition: read and dropped
+    pos = len(mbr)
+    while pos < start:
+        block = p.stdout.read(min(RAW_BLOCK_SIZE, start - pos))
+        if not block:
+            break
+        pos = pos + len(block)
+
+    try:
+        fd = os.open(output, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+    except OSError as e:
+        print "error:", output, ":", e
+        p.kill()
+        sys.exit(-1)
+
+    progress = Progress("ingest "+output, size)
+    done = 0
+    try:
+        while done < size:
+            block = read_full(p.stdout, min(RAW_BLOCK_SIZE, size - done))
+            if not block:
+                break
+            if block != ZERO_BLOCK[:len(block)]:
+                write_sparse(fd, block, done)
+            done = done + len(block)
+            progress.update(len(block))
+        os.ftruncate(fd, size)
+    except (IOError, OSError) as e:
+        print "error:", e, ": failed to write", output
+        p.kill()
+        sys.exit(-1)
+    finally:
+        os.close(fd)
+
+    # the rest of the image is not needed
+    p.stdout.close()
+    p.kill()
+    p.wait()
+    if done < size:
+        print "error:", image_name, ": truncated, partition", num, \
+              "is incomplete"
+        sys.exit(-1)
+    progress.finish()
+
+    return
+
+#==============================================================================
+# main
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='''Extracts a partition of a disk
+                                     image (.img, .img.xz, .img.zst, .img.gz) to a
+                                     sparse file, without unpacking the image''')
+    parser.add_argument('image', help='the disk image, "-" for stdin')
+    parser.add_argument('-p', dest='num', action='store', type=int,
+                        default=2, help='the partition to extract (default: 2)')
+    parser.add_argument('-o', dest='output', action='store', required=True,
+                        help='the file to write the partition to')
+    args = parser.parse_args()
+
+    ingest_partition(args.image, args.num, args.output)
+    print "info: partition", args.num, "written to", args.output
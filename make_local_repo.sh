@@ -0,0 +1,97 @@
+#!/bin/sh
+#-
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# Copyright (c) 2019 A. Theodore Markettos
+# All rights reserved.
+#
+# This software was developed by SRI International and the University of
+# Cambridge Computer Laboratory (Department of Computer Science and
+# Technology) under DARPA contract HR0011-18-C-0016 ("ECATS"), as part of the
+# DARPA SSITH research programme.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+
+# Builds a local apt repository holding the packages (and their missing
+# dependencies) to install into a root file system, so that the install
+# needs no network. Dependencies are resolved by the host's apt against the
+# root file system's sources and dpkg status, and the .debs are fetched
+# natively, several at a time.
+#
+#   make_local_repo.sh <root file system> <repository directory> <packages>
+
+INSTALL=$1
+REPO=$2
+shift
+shift
+PACKAGES="$@"
+# parallel downloads
+JOBS=${JOBS:-8}
+ARCH=armhf
+
+if [ -z "$INSTALL" ] || [ -z "$REPO" ] ; then
+	echo "Usage: $0 <root file system> <repository directory> <packages>"
+	exit 1
+fi
+
+mkdir -p $REPO
+REPO=$(readlink -f "$REPO")
+# the host's apt, pointed at the target: its sources, keys and installed
+# packages, with state of its own
+APT_STATE=$REPO/.apt
+mkdir -p $APT_STATE/lists/partial $APT_STATE/cache/archives/partial
+APT_OPTS="-o APT::Architecture=$ARCH -o APT::Architectures=$ARCH \
+	-o Dir::Etc::SourceList=$INSTALL/etc/apt/sources.list \
+	-o Dir::Etc::SourceParts=$INSTALL/etc/apt/sources.list.d \
+	-o Dir::Etc::Trusted=$INSTALL/etc/apt/trusted.gpg \
+	-o Dir::Etc::TrustedParts=$INSTALL/etc/apt/trusted.gpg.d \
+	-o Dir::State::Status=$INSTALL/var/lib/dpkg/status \
+	-o Dir::State::Lists=$APT_STATE/lists \
+	-o Dir::Cache=$APT_STATE/cache \
+	-o Debug::NoLocking=1 -o APT::Sandbox::User=root"
+
+echo "Resolving dependencies..."
+apt-get $APT_OPTS -qq update || exit 1
+# lines of: 'URL' file size SHA256:hash
+apt-get $APT_OPTS -qq --print-uris install $PACKAGES > $APT_STATE/uris || exit 1
+
+# fetched under the names apt gives them
+sed -n "s/^'\([^']*\)' \([^ ]*\) .*/\1 \2/p" $APT_STATE/uris > $APT_STATE/urls
+sed -n "s/^'[^']*' \([^ ]*\) [0-9]* SHA256:\([0-9a-f]*\)$/\2  \1/p" \
+	$APT_STATE/uris > $APT_STATE/sha256sums
+
+# the packages already there and intact are not fetched again
+(cd $REPO && sha256sum -c $APT_STATE/sha256sums 2>/dev/null) | \
+	sed -n 's/: OK$//p' > $APT_STATE/present
+awk 'NR == FNR { present[$0] = 1; next } !($2 in present)' \
+	$APT_STATE/present $APT_STATE/urls > $APT_STATE/missing
+
+echo "Fetching $(wc -l < $APT_STATE/missing) packages..."
+(cd $REPO && xargs -r -n 2 -P $JOBS sh -c 'wget -nv -c -O "$1" "$0"' \
+	< $APT_STATE/missing) || exit 1
+(cd $REPO && sha256sum --quiet -c $APT_STATE/sha256sums) || exit 1
+
+echo "Indexing the repository..."
+(cd $REPO && dpkg-scanpackages -m . /dev/null > Packages 2>/dev/null) || exit 1
+gzip -9c $REPO/Packages > $REPO/Packages.gz
+echo "Local repository ready in $REPO"
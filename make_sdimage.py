@@ -34,12 +34,151 @@ import argparse
 import textwrap
 import subprocess
 import time
+import errno
+import fcntl
+import functools
+import platform
+import hashlib
+import json
+import mmap
+import stat
+import xml.etree.ElementTree
+import shutil
+import struct
+import tempfile
+import threading
+import traceback
+import Queue
+
+# the guestfs backend is optional
+try:
+    import guestfs
+except ImportError:
+    guestfs = None
 
 MAX_PARTITIONS = 4
 
+# partitions start on multiples of this many bytes, by default: the erase
+#! block size of most SD cards. The first one starts at 1MB at least
+DEFAULT_ALIGN = 4*1024*1024
+FIRST_PARTITION_MIN_START = 1024*1024
+# size units, as in size expressions
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024*1024, 'G': 1024*1024*1024,
+              'T': 1024*1024*1024*1024}
+# size=auto: what the file systems are sized for. ext[2-4] as laid out by
+#! mke2fs: 4K blocks, 256 bytes inodes, 32768 blocks per group, 11 inodes
+#! reserved, 5% of the blocks reserved for root, and the journal it picks by
+#! file system size (blocks)
+EXT_BLOCK_SIZE = 4096
+EXT_INODE_SIZE = 256
+EXT_BLOCKS_PER_GROUP = 32768
+EXT_RESERVED_INODES = 11
+EXT_RESERVED_RATIO = 0.05
+EXT_JOURNAL_BLOCKS = [(32768, 1024), (256*1024, 4096), (512*1024, 8192),
+                      (4096*1024, 16384), (8192*1024, 32768),
+                      (16384*1024, 65536), (32768*1024, 131072),
+                      (None, 262144)]
+# FAT: the cluster size by file system size (bytes), and the FAT16 root
+#! directory (512 entries)
+FAT_CLUSTER_SIZES = {'vfat': [(256*1024*1024, 4096), (512*1024*1024, 8192),
+                              (1024*1024*1024, 16384), (None, 32768)],
+                     'fat32': [(8*1024*1024*1024, 4096),
+                               (16*1024*1024*1024, 8192), (None, 16384)]}
+FAT16_ROOT_DIR_SIZE = 512*32
+# xfs: mkfs.xfs refuses less than 300MB, and its log
+XFS_MIN_SIZE = 300*1024*1024
+XFS_LOG_SIZE = 64*1024*1024
+# headroom on the estimates: inodes, and the whole size
+AUTO_INODE_SLACK = 1.1
+AUTO_SIZE_MARGIN = 0.02
+# keys of a partition in a layout file
+LAYOUT_PARTITION_KEYS = ['num', 'format', 'type', 'size', 'files']
+
+# raw copies are done in chunks of this size (bytes)
+RAW_BLOCK_SIZE = 4*1024*1024
+ZERO_BLOCK = '\0' * RAW_BLOCK_SIZE
+
+# lseek() whence values and ioctl number not exported by Python 2 (Linux)
+SEEK_DATA = 3
+SEEK_HOLE = 4
+FICLONERANGE = 0x4020940d
+
+# MBR layout: the disk signature starts the part we write, followed by the
+#! partition entries and the boot signature. CHS addresses in the entries
+#! use the usual 255 heads / 63 sectors geometry
+MBR_TABLE_OFFSET = 440
+MBR_HEADS = 255
+MBR_SECTORS = 63
+
+# mke2fs -d appeared in e2fsprogs 1.43, tarballs (and "-" for stdin) are
+#! accepted since 1.47.1
+MKE2FS_DIR_VERSION = (1, 43)
+MKE2FS_TAR_VERSION = (1, 47, 1)
+TARBALL_RE = r"\.(tar|tar\.gz|tgz|tar\.bz2|tbz2|tar\.xz|txz|tar\.zst)$"
+# and how to decompress them, for the appliance which takes plain tar
+TAR_DECOMPRESSORS = [(r"\.(tar\.gz|tgz)$", ["gzip", "-d", "-c"]),
+                     (r"\.(tar\.bz2|tbz2)$", ["bzip2", "-d", "-c"]),
+                     (r"\.(tar\.xz|txz)$", ["xz", "-T0", "-d", "-c"]),
+                     (r"\.tar\.zst$", ["zstd", "-q", "-d", "-c"])]
+
+# threads copying files into mounted partitions, by default
+COPY_THREADS = 8
+
+# O_DIRECT writes must be aligned on the logical block size of the device
+DIRECT_IO_ALIGN = 512
+
+# block map files follow the bmaptool 2.0 format
+BMAP_BLOCK_SIZE = 4096
+BMAP_ZERO_CHECKSUM = "0" * 64
+# ioctl to drop the buffer cache of a block device
+BLKFLSBUF = 0x1261
+# and to clear a range of it: BLKZEROOUT always reads back as zeros,
+#! BLKDISCARD only when the device says discarded blocks do
+BLKDISCARD = 0x1277
+BLKZEROOUT = 0x127f
+
+# compressors for streamed outputs, by file name extension
+COMPRESSORS = {'.xz': ["xz", "-T0", "-c"],
+               '.zst': ["zstd", "-T0", "-q", "-c"]}
+
+# bump when the way partitions are built changes, to invalidate the cache
+CACHE_VERSION = 1
+
+# waiting for devices to settle: polled with an exponential backoff from
+#! SETTLE_MIN_DELAY to SETTLE_MAX_DELAY, giving up after SETTLE_TIMEOUT (s)
+SETTLE_MIN_DELAY = 0.001
+SETTLE_MAX_DELAY = 0.5
+SETTLE_TIMEOUT = 30
+
+#==============================================================================
+# loopback devices, mount points and temporary files in use by one thread.
+#! Every thread building partitions gets its own, so that whatever it leaves
+#! behind can be released even when several partitions fail at once
+class Resources(object):
+
+    def __init__(self):
+        self.loopback_devs = []
+        self.mounts = []
+        self.temp_files = []
+
 # Globals
-loopback_dev_used = []
-mounted_fs = []
+thread_data = threading.local()
+all_resources = []
+all_resources_lock = threading.Lock()
+# set when a partition worker failed, the others stop as soon as they can
+abort_build = threading.Event()
+# (what, seconds) for every wait on a device
+settle_times = []
+settle_times_lock = threading.Lock()
+# threads copying files into a partition (-t)
+copy_threads = COPY_THREADS
+# traces the calls to the appliance (--guestfs-trace)
+guestfs_trace = False
+# version of mke2fs, as a tuple, once known
+mke2fs_version = []
+# one record per stage run, see StageTimer
+stage_records = []
+stage_records_lock = threading.Lock()
 
 #
 #  ######  #    #  #    #   ####    ####
@@ -58,7 +197,7 @@ def check_output(*popenargs, **kwargs):
     >>> check_output(['/usr/bin/python', '--version'])
     Python 2.6.2
     """
-    process = subprocess.Popen(stdout=subprocess.PIPE, *popenargs, **kwargs)
+    process = Popen(stdout=subprocess.PIPE, *popenargs, **kwargs)
     output, unused_err = process.communicate()
     retcode = process.poll()
     if retcode:
@@ -70,34 +209,223 @@ def check_output(*popenargs, **kwargs):
         raise error
     return output
 
+#==============================================================================
+# subprocess.Popen, counting the processes started for the build report
+class Popen(subprocess.Popen):
+
+    def __init__(self, *args, **kwargs):
+        for timer in get_stage_stack():
+            timer.subprocesses = timer.subprocesses + 1
+        subprocess.Popen.__init__(self, *args, **kwargs)
+
+#==============================================================================
+# subprocess.call, with the process counted
+def call(*popenargs, **kwargs):
+
+    return Popen(*popenargs, **kwargs).wait()
+
+#==============================================================================
+# the stages being timed by the calling thread, innermost last
+def get_stage_stack():
+
+    stack = getattr(thread_data, 'stages', None)
+    if stack is None:
+        stack = []
+        thread_data.stages = stack
+
+    return stack
+
+#==============================================================================
+# bytes written by this process, counted in every stage being timed
+def count_bytes_written(nbytes):
+
+    for timer in get_stage_stack():
+        timer.bytes_written = timer.bytes_written + nbytes
+
+    return
+
+#==============================================================================
+# blocks allocated to a file, in bytes
+def get_allocated(path):
+
+    try:
+        return os.stat(path).st_blocks * 512
+    except OSError:
+        return 0
+
+#==============================================================================
+# times a stage of the build: wall and CPU time (ours and our children's,
+#! process wide, so stages running in parallel see each other's), bytes we
+#! wrote, processes we started, and the growth of 'path' on disk
+class StageTimer(object):
+
+    def __init__(self, name, path=None):
+        self.name = name
+        self.path = path
+        self.bytes_written = 0
+        self.subprocesses = 0
+
+    def __enter__(self):
+        self.start = time.time()
+        self.times = os.times()
+        if self.path:
+            self.allocated = get_allocated(self.path)
+        get_stage_stack().append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        get_stage_stack().remove(self)
+        times = os.times()
+        record = {'stage': self.name,
+                  'partition': getattr(thread_data, 'partition', None),
+                  'start': self.start,
+                  'wall': time.time() - self.start,
+                  'cpu': sum(times[:4]) - sum(self.times[:4]),
+                  'bytes_written': self.bytes_written,
+                  'subprocesses': self.subprocesses,
+                  'failed': exc_type is not None}
+        if self.path:
+            record['allocated'] = get_allocated(self.path) - self.allocated
+        with stage_records_lock:
+            stage_records.append(record)
+        return False
+
+#==============================================================================
+# decorator: times every call of a function as a stage
+def timed_stage(name):
+
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with StageTimer(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorate
+
+#==============================================================================
+# prints a table of the time spent per stage
+def report_stages():
+
+    with stage_records_lock:
+        records = list(stage_records)
+
+    summary = {}
+    for record in records:
+        s = summary.setdefault(record['stage'], [0, 0.0, 0.0, 0, 0])
+        s[0] = s[0] + 1
+        s[1] = s[1] + record['wall']
+        s[2] = s[2] + record['cpu']
+        s[3] = s[3] + record['bytes_written']
+        s[4] = s[4] + record['subprocesses']
+
+    print "%-26s %6s %10s %10s %12s %6s" % ("stage", "runs", "wall (s)",
+                                             "cpu (s)", "written (MB)", "procs")
+    for name in sorted(summary.keys(), key=lambda n: -summary[n][1]):
+        s = summary[name]
+        print "%-26s %6d %10.3f %10.3f %12.1f %6d" % (name, s[0], s[1], s[2],
+                                                       s[3] / (1024.0*1024),
+                                                       s[4])
+
+    return
+
+#==============================================================================
+# writes every stage record, and a bit about the host, as JSON
+def write_report(report_name, image_name, total_wall):
+
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    try:
+        p = Popen(["git", "-C", script_dir, "describe", "--always", "--dirty"],
+                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        commit = p.communicate()[0].strip()
+    except OSError:
+        commit = ""
+
+    with stage_records_lock:
+        records = list(stage_records)
+    with settle_times_lock:
+        waits = list(settle_times)
+
+    report = {'image': image_name,
+              'image_size': os.stat(image_name).st_size,
+              'image_allocated': get_allocated(image_name),
+              'date': time.strftime("%Y-%m-%dT%H:%M:%S"),
+              'commit': commit,
+              'host': platform.node(),
+              'platform': platform.platform(),
+              'cpus': os.sysconf("SC_NPROCESSORS_ONLN"),
+              'argv': sys.argv,
+              'wall': total_wall,
+              'stages': records,
+              'waits': [{'what': what, 'wall': t} for (what, t) in waits]}
+
+    try:
+        json.dump(report, open(report_name, 'w'), indent=1, sort_keys=True)
+    except IOError as e:
+        print "error:", e, ": failed to write the report"
+
+    return
+
 #==============================================================================
 # Convert to bytes
+#! sizes are expressions: numbers with an optional unit (K|M|G|T, powers of
+#! 1024), + - * / and parentheses, e.g. "1G+512M" or "(3810M-10M)/2"
 def convert_size_from_unit(unit_size):
 
-    factor = 1
-
-    m = re.match("^[0-9]+[KMG]?$", unit_size, re.I)
-    if m == None:
+    tokens = re.findall(r"\s*([0-9]+(?:\.[0-9]+)?[KMGT]?|[-+*/()]|\S)",
+                        unit_size, re.I)
+    try:
+        (size, pos) = parse_size_sum(tokens, 0)
+        if pos != len(tokens):
+            raise ValueError
+    except (ValueError, IndexError, ZeroDivisionError):
         print "error: "+unit_size+": malformed expression"
         sys.exit(-1)
-    else:
-        munit = re.search("[KMG]+$", m.group(0), re.I)
-        msize = re.search("^[0-9]+", m.group(0), re.I)
 
-        if munit :
-            unit = munit.group(0).upper()
+    return int(size)
+
+# sum := product (('+'|'-') product)*
+def parse_size_sum(tokens, pos):
 
-            if unit == 'K':
-                factor = 1024
-            elif unit == 'M':
-                factor = 1024*1024
-            elif unit == 'G':
-                factor = 1024*1024*1024
+    (size, pos) = parse_size_product(tokens, pos)
+    while pos < len(tokens) and tokens[pos] in "+-":
+        (term, next_pos) = parse_size_product(tokens, pos + 1)
+        if tokens[pos] == "+":
+            size = size + term
+        else:
+            size = size - term
+        pos = next_pos
+
+    return (size, pos)
+
+# product := value (('*'|'/') value)*
+def parse_size_product(tokens, pos):
+
+    (size, pos) = parse_size_value(tokens, pos)
+    while pos < len(tokens) and tokens[pos] in "*/":
+        (factor, next_pos) = parse_size_value(tokens, pos + 1)
+        if tokens[pos] == "*":
+            size = size * factor
+        else:
+            size = size / factor
+        pos = next_pos
+
+    return (size, pos)
+
+# value := number[unit] | '(' sum ')'
+def parse_size_value(tokens, pos):
+
+    if tokens[pos] == "(":
+        (size, pos) = parse_size_sum(tokens, pos + 1)
+        if tokens[pos] != ")":
+            raise ValueError
+        return (size, pos + 1)
 
-    # convert_str_to_int() takes care of handling exceptions
-    size = convert_str_to_int(msize.group(0))*factor
+    m = re.match(r"^([0-9]+(?:\.[0-9]+)?)([KMGT]?)$", tokens[pos], re.I)
+    if m is None:
+        raise ValueError
 
-    return size
+    return (float(m.group(1)) * SIZE_UNITS[m.group(2).upper()], pos + 1)
 
 #==============================================================================
 # converts a string to int, with exception handling
@@ -146,8 +474,7 @@ def parse_single_part_args(part):
             if key == 'num':
                 part_entries[key] = convert_str_to_int(value)
             elif key == 'size':
-                size = convert_size_from_unit(value)
-                part_entries[key] = size
+                set_part_size(part_entries, value)
             elif key == 'format':
                 if validate_format(value):
                     part_entries[key] = value
@@ -164,27 +491,150 @@ def parse_single_part_args(part):
 
     return part_entries
 
+#==============================================================================
+# sets the size of a partition: a size expression, "fill" for the space the
+#! other partitions leave in the image, or "auto[+slack]" for the size of its
+#! files (see size_auto_partition())
+def set_part_size(part_entry, value):
+
+    if value == "fill":
+        part_entry['fill'] = True
+        part_entry['size'] = 0
+    elif re.match("^auto(\+|$)", value):
+        # the slack is added once the partition is sized, it is checked now
+        slack = value[5:]
+        if slack.endswith("%") or value == "auto+":
+            if not re.match(r"^[0-9]+(\.[0-9]+)?%$", slack):
+                print "error: "+value+": malformed expression"
+                sys.exit(-1)
+        elif slack:
+            convert_size_from_unit(slack)
+        part_entry['auto'] = slack
+        part_entry['size'] = 0
+    else:
+        part_entry['size'] = convert_size_from_unit(value)
+
+    return
+
 #==============================================================================
 # Parse all the arguments provided with all the '-P' switches
 def parse_all_parts_args(part_args):
 
+    return check_all_part_entries([parse_single_part_args(part)
+                                   for part in part_args])
+
+#==============================================================================
+# checks the partitions given, as parsed from -P or a layout file
+# returns them in a dictionary, by number
+def check_all_part_entries(part_list):
+
     part_entries = {}
 
-    num_args = len(part_args)
+    num_args = len(part_list)
     if num_args > MAX_PARTITIONS:
         print "error: up to "+str(MAX_PARTITIONS)+" allowed"
         sys.exit(-1)
 
-    for part in part_args:
-        part_entry = parse_single_part_args(part)
+    stdin_used = False
+    for part_entry in part_list:
+        if 'num' not in part_entry:
+            print "error:", part_entry['files'], ": partition number missing"
+            sys.exit(-1)
+        if part_entry['num'] < 1 or part_entry['num'] > MAX_PARTITIONS:
+            print "error:", part_entry['num'], ": partition number must be 1 to", \
+                  MAX_PARTITIONS
+            sys.exit(-1)
         if part_entry['num'] in part_entries.keys():
             print "error:"+str(part_entry['num'])+": partition already used"
             sys.exit(-1)
 
+        # a tarball (or a tar stream on stdin, "-") must come alone, and
+        #! can only populate an ext[2-4] partition
+        tarball = get_tarball(part_entry)
+        if tarball or "-" in part_entry['files']:
+            if not tarball or \
+               not re.search("^ext[2-4]$", part_entry.get('format', "")):
+                print "error:", part_entry['num'], \
+                      ": a tarball must be the only input of an ext partition"
+                sys.exit(-1)
+            if tarball == "-":
+                if stdin_used:
+                    print "error: only one partition can be read from stdin"
+                    sys.exit(-1)
+                stdin_used = True
+
         part_entries[part_entry['num']] = part_entry
 
     return part_entries
 
+#==============================================================================
+# reads a layout file (JSON), the declarative form of -s, --align and -P:
+#!   {"size": "3810M", "align": "4M",
+#!    "partitions": [{"num": 1, "format": "vfat", "size": "500M",
+#!                    "files": ["zImage", "socfpga.rbf"]},
+#!                   {"num": 2, "format": "ext3", "size": "fill",
+#!                    "files": ["mnt/2/*"]}]}
+#! Partitions are laid out in the order they are listed. "size" and "align"
+#! are optional, and every size is a size expression (or "fill" for one
+#! partition). Strings may refer to environment variables ($VAR)
+# returns the partitions, the image size (None if not given), the alignment
+#! (None if not given) and the order of the partitions
+def read_layout(layout_name):
+
+    try:
+        layout = json.load(open(layout_name))
+    except (IOError, ValueError) as e:
+        print "error:", layout_name, ":", e
+        sys.exit(-1)
+
+    if not isinstance(layout, dict) or \
+       not isinstance(layout.get('partitions'), list):
+        print "error:", layout_name, ": no list of partitions"
+        sys.exit(-1)
+    for key in layout.keys():
+        if key not in ['size', 'align', 'partitions']:
+            print "error:", layout_name, ":", key, ": unknown key"
+            sys.exit(-1)
+
+    part_list = []
+    for partition in layout['partitions']:
+        if not isinstance(partition, dict):
+            print "error:", layout_name, ": a partition is not an object"
+            sys.exit(-1)
+        part_entry = {'files': []}
+        for (key, value) in partition.items():
+            if key not in LAYOUT_PARTITION_KEYS:
+                print "error:", layout_name, ":", key, ": unknown option"
+                sys.exit(-1)
+            if key == 'files':
+                if not isinstance(value, list):
+                    value = [value]
+                part_entry['files'] = [os.path.expandvars(str(f))
+                                       for f in value]
+            elif key == 'num':
+                part_entry['num'] = convert_str_to_int(str(value))
+            elif key == 'size':
+                set_part_size(part_entry, os.path.expandvars(str(value)))
+            elif key == 'format':
+                if not validate_format(str(value)):
+                    print "error:", value, "unknown format"
+                    sys.exit(-1)
+                part_entry['format'] = str(value)
+            else:
+                part_entry[key] = str(value)
+        part_list.append(part_entry)
+
+    part_entries = check_all_part_entries(part_list)
+    image_size = None
+    if 'size' in layout:
+        image_size = convert_size_from_unit(os.path.expandvars(str(layout['size'])))
+    align = None
+    if 'align' in layout:
+        align = convert_size_from_unit(os.path.expandvars(str(layout['align'])))
+
+    return (part_entries, image_size, align,
+            [part_entry['num'] for part_entry in part_list])
+
 #==============================================================================
 # in some cases, a partition type (fdisk) can be inferred from the file system
 # format, e.g. ext[2-4], type=83
@@ -192,10 +642,13 @@ def derive_fdisk_type_from_format(pformat):
 
     ptype = ""
 
-    if re.match('^ext[2-4]|xfs$', pformat):
+    if re.match('^(ext[2-4]|xfs)$', pformat):
         ptype = '83'
-    elif re.match('^vfat|fat|fat32$', pformat):
+    elif re.match('^(vfat|fat|fat32)$', pformat):
         ptype = 'b'
+    elif re.match('^(raw|none)$', pformat):
+        # the type the SoCFPGA boot ROM looks for
+        ptype = 'A2'
     else:
         print "error:", pformat,": unknown format"
         sys.exit(-1)
@@ -204,15 +657,16 @@ def derive_fdisk_type_from_format(pformat):
 
 #==============================================================================
 # The partition type provided by the user is not in the format that fdisk
-# expects. This function translates to fdisk type defs
+# expects. This function translates to fdisk type defs, a hex type is kept
 def derive_fdisk_type_from_ptype(ptype):
 
-    ptype = ""
-
-    if re.match('^raw|none$', ptype):
+    if re.match('^(0x)?[0-9a-f]{1,2}$', ptype, re.I) and \
+       int(ptype, 16) != 0:
+        fdisk_type = re.sub('^0x', '', ptype, flags=re.I)
+    elif re.match('^(raw|none)$', ptype):
         fdisk_type = 'A2'
     elif ptype == 'swap':
-        fdisk_type = '84'
+        fdisk_type = '82'
     else:
         print "error:", ptype,": unknown type"
         sys.exit(-1)
@@ -220,16 +674,260 @@ def derive_fdisk_type_from_ptype(ptype):
     return fdisk_type
 
 #==============================================================================
-# This function checks the partition definitions and calculates the
-# partition offsets
-def check_and_update_part_entries(part_entries, image_size):
+# lists what a partition will hold, for sizing it: the size of every file
+#! (hardlinks once), the length of every symlink target, the name lengths of
+#! the entries of every directory, and the number of inodes
+def scan_sources(partition_data):
+
+    scan = {'files': [], 'symlinks': [], 'dirs': [], 'inodes': 0}
+
+    tarball = get_tarball(partition_data)
+    if tarball == "-":
+        print "error: partition", partition_data['num'], \
+              ": a stream can't be sized, give its size"
+        sys.exit(-1)
+    if tarball:
+        return scan_tarball(tarball, scan)
+
+    sources = expand_sources(partition_data)
+    # the root directory
+    scan['dirs'].append([len(os.path.basename(s)) for s in sources])
+    seen = set()
+    for stuff in sources:
+        scan_entry(stuff, scan, seen)
+        if os.path.isdir(stuff) and not os.path.islink(stuff):
+            for (root, dirs, files) in os.walk(stuff):
+                for name in dirs + files:
+                    scan_entry(os.path.join(root, name), scan, seen)
+
+    return scan
+
+# adds one file, directory or symlink to a scan
+def scan_entry(path, scan, seen):
+
+    st = os.lstat(path)
+    if stat.S_ISDIR(st.st_mode):
+        scan['dirs'].append([len(name) for name in os.listdir(path)])
+    elif stat.S_ISLNK(st.st_mode):
+        scan['symlinks'].append(len(os.readlink(path)))
+    elif st.st_nlink > 1:
+        if (st.st_dev, st.st_ino) in seen:
+            return
+        seen.add((st.st_dev, st.st_ino))
+        scan['files'].append(st.st_size)
+    else:
+        scan['files'].append(st.st_size)
+    scan['inodes'] = scan['inodes'] + 1
 
-    entry = {}
-    offset = 2048   # in blocks of 512 bytes
-    total_size = 0
+    return
+
+# same as scan_sources(), from the listing of a tarball
+def scan_tarball(tarball, scan):
+
+    output = run_cmd(["tar", "-t", "-v", "--numeric-owner", "-f", tarball],
+                     "failed to list "+tarball)
+    entries = {}
+    for line in output.splitlines():
+        # mode owner size date time name [-> target]
+        fields = line.split(None, 5)
+        if len(fields) < 6:
+            continue
+        name = fields[5].split(" -> ")[0].split(" link to ")[0].strip("/")
+        parent = os.path.dirname(name)
+        entries[parent] = entries.get(parent, []) + \
+                          [len(os.path.basename(name))]
+        if fields[0][0] == "d":
+            entries.setdefault(name, [])
+        elif fields[0][0] == "l":
+            scan['symlinks'].append(len(fields[5].split(" -> ", 1)[-1]))
+        elif fields[0][0] == "h":
+            continue
+        elif fields[0][0] in "cbp":
+            # device nodes and FIFOs hold no data
+            pass
+        else:
+            scan['files'].append(convert_str_to_int(fields[2]))
+        scan['inodes'] = scan['inodes'] + 1
+    entries.setdefault("", [])
+    scan['dirs'] = entries.values()
+
+    return scan
+
+#==============================================================================
+# the size of an ext[2-4] file system that holds a scan, in bytes, and the
+#! inodes to give it. Mirrors what mke2fs lays out with 4K blocks, 256 bytes
+#! inodes and its defaults: block groups (bitmaps, inode tables), superblock
+#! and descriptor backups (sparse_super) with the descriptors reserved to
+#! grow the file system 1024 times (resize_inode), the journal, 5% reserved
+def estimate_ext_size(scan, pformat):
+
+    bsize = EXT_BLOCK_SIZE
+    data = 0
+    for size in scan['files']:
+        blocks = (size + bsize - 1) / bsize
+        data = data + blocks
+        if pformat != "ext4" and blocks > 12:
+            # indirect blocks, 1024 pointers each
+            data = data + (blocks - 12 + 1023) / 1024 + (blocks > 1036)
+    # symlinks up to 60 bytes fit in their inode
+    data = data + len([n for n in scan['symlinks'] if n >= 60])
+    for entries in scan['dirs']:
+        dir_bytes = sum([(8 + n + 3) / 4 * 4 for n in entries]) + 24
+        data = data + (dir_bytes + bsize - 1) / bsize
+    inodes = int((scan['inodes'] + EXT_RESERVED_INODES) * AUTO_INODE_SLACK) + 64
+    inode_blocks = (inodes * EXT_INODE_SIZE + bsize - 1) / bsize
+    desc_size = 64 if pformat == "ext4" else 32
+
+    blocks = data + inode_blocks
+    for i in range(8):
+        groups = (blocks + EXT_BLOCKS_PER_GROUP - 1) / EXT_BLOCKS_PER_GROUP
+        gdt = (groups * desc_size + bsize - 1) / bsize
+        rsv = min(bsize / 4, (groups * 1024 * desc_size + bsize - 1) / bsize)
+        backups = len([g for g in range(groups) if g < 2 or is_sparse_group(g)])
+        meta = inode_blocks + 2 * groups + backups * (1 + max(gdt, rsv))
+        if pformat != "ext2":
+            meta = meta + get_journal_blocks(blocks)
+        needed = int((data + meta) / (1 - EXT_RESERVED_RATIO)) + 1
+        if needed <= blocks:
+            break
+        blocks = needed
+
+    return (blocks * bsize, inodes)
+
+# true for the block groups holding a backup of the superblock: powers of
+#! 3, 5 and 7
+def is_sparse_group(group):
+
+    for base in [3, 5, 7]:
+        n = base
+        while n < group:
+            n = n * base
+        if n == group:
+            return True
+
+    return False
+
+# the journal mke2fs creates for a file system of 'blocks' 4K blocks
+def get_journal_blocks(blocks):
+
+    for (limit, journal) in EXT_JOURNAL_BLOCKS:
+        if limit is None or blocks < limit:
+            return journal
+
+#==============================================================================
+# the size of a FAT file system that holds a scan, in bytes. Directories
+#! take a 32 bytes entry per file, plus one per 13 characters of long name,
+#! and FAT16 has a fixed root directory
+def estimate_fat_size(scan, pformat):
+
+    total = 0
+    for (limit, cluster) in FAT_CLUSTER_SIZES[pformat]:
+        data = 0
+        for size in scan['files']:
+            data = data + (size + cluster - 1) / cluster
+        for entries in scan['dirs']:
+            dir_bytes = sum([32 * (2 + (n + 12) / 13) for n in entries]) + 64
+            data = data + (dir_bytes + cluster - 1) / cluster
+        if pformat == "fat32":
+            # 4 bytes per cluster in each of the 2 FATs, 32 reserved sectors
+            total = data * (cluster + 8) + 32 * 512
+        else:
+            total = data * (cluster + 4) + 4 * 512 + FAT16_ROOT_DIR_SIZE
+        if limit is None or total <= limit:
+            break
+
+    return total
+
+#==============================================================================
+# the size of an xfs file system that holds a scan, in bytes: 4K blocks,
+#! 512 bytes inodes, and the log
+def estimate_xfs_size(scan):
+
+    data = 0
+    for size in scan['files']:
+        data = data + (size + 4095) / 4096 * 4096
+    for entries in scan['dirs']:
+        data = data + (sum([n + 12 for n in entries]) + 4095) / 4096 * 4096
+    inodes = scan['inodes'] * 512
+
+    return max(XFS_MIN_SIZE, int((data + inodes) * 1.05) + XFS_LOG_SIZE)
+
+#==============================================================================
+# computes the size of a "size=auto[+slack]" partition: the smallest one its
+#! files fit in, given the overhead of its file system, plus the slack (a
+#! size, or a percentage of that size). ext partitions also get the number of
+#! inodes they were sized for
+def size_auto_partition(part_entry):
+
+    pformat = part_entry['format']
+    scan = scan_sources(part_entry)
+    if re.search("raw|none", pformat):
+        size = sum(scan['files'])
+    elif re.search("^ext[2-4]$", pformat):
+        (size, inodes) = estimate_ext_size(scan, pformat)
+        part_entry['mkfs'] = {'blocksize': EXT_BLOCK_SIZE, 'inodes': inodes,
+                              'inode_size': EXT_INODE_SIZE}
+    elif pformat == "xfs":
+        size = estimate_xfs_size(scan)
+    else:
+        if pformat != "fat32":
+            pformat = "vfat"
+        size = estimate_fat_size(scan, pformat)
+
+    size = int(size * (1 + AUTO_SIZE_MARGIN))
+    slack = part_entry['auto']
+    if slack.endswith("%"):
+        size = size + int(size * float(slack[:-1]) / 100)
+    elif slack:
+        size = size + convert_size_from_unit(slack)
+    if pformat == "fat32":
+        size = max(size, 33554432)
+    size = align_up(size, 1024*1024)
+
+    print "info: partition", part_entry['num'], ":", size / (1024*1024), \
+          "MiB for", sum(scan['files']) / (1024*1024), "MiB in", \
+          scan['inodes'], "files"
+    part_entry['size'] = size
+
+    return
+
+#==============================================================================
+# the mkfs options an ext partition was sized for (see size_auto_partition())
+def get_mkfs_options(partition_data):
+
+    mkfs = partition_data.get('mkfs')
+    if not mkfs:
+        return []
+
+    return ["-b", str(mkfs['blocksize']), "-N", str(mkfs['inodes']),
+            "-I", str(mkfs['inode_size'])]
+
+#==============================================================================
+# rounds a number up to a multiple of 'align'
+def align_up(value, align):
+
+    return (value + align - 1) / align * align
 
+#==============================================================================
+# This function checks the partition definitions and calculates the
+# partition offsets
+#! the partitions are laid out in 'order' (by number by default), each one
+#! starting on a multiple of 'align' bytes. A "fill" partition gets what the
+#! others leave, down to a multiple of 'align'. Without an image size, the
+#! image ends with the last partition
+# returns the partitions and the image size
+def check_and_update_part_entries(part_entries, image_size,
+                                  align=DEFAULT_ALIGN, order=None):
+
+    if align < 512 or align % 512 != 0:
+        print "error:", align, ": the alignment must be a multiple of 512"
+        sys.exit(-1)
+    align_sectors = align / 512
+    if order is None:
+        order = sorted(part_entries.keys())
 
-    for part in part_entries.keys():
+    fill = None
+    for part in order:
 
         entry = part_entries[part]
 
@@ -239,37 +937,83 @@ def check_and_update_part_entries(part_entries, image_size):
         if 'size' not in entry:
             print "error:", part, ": size must be specified"
             sys.exit(-1)
-        if entry['size'] == 0:
+        if entry.get('fill'):
+            if fill is not None:
+                print "error:", part, ": only one partition can fill the image"
+                sys.exit(-1)
+            if image_size is None:
+                print "error:", part, ": the image size is needed to fill it"
+                sys.exit(-1)
+            fill = part
+        elif entry['size'] <= 0 and 'auto' not in entry:
             print "error:", part, ": size is 0"
             sys.exit(-1)
-        total_size = total_size + entry['size']
-
-        if 'format' not in entry:
-            if 'type' not in entry:
-                print "error:", part,": specify at least format or type"
-                sys.exit(-1)
 
+        if 'type' in entry:
             part_entries[part]['fdisk_type'] = derive_fdisk_type_from_ptype(entry['type'])
+        elif 'format' in entry:
+            part_entries[part]['fdisk_type'] = derive_fdisk_type_from_format(entry['format'])
+        else:
+            print "error:", part,": specify at least format or type"
+            sys.exit(-1)
+        if 'format' not in entry:
+            part_entries[part]['format'] = "none"
+        if 'auto' in entry:
+            size_auto_partition(entry)
+
+    # the space left for the fill partition, once the others are placed
+    if fill is not None:
+        used = align_up(FIRST_PARTITION_MIN_START, align)
+        for part in order:
+            if part != fill:
+                used = used + align_up(part_entries[part]['size'], align)
+        fill_size = (image_size - used) / align * align
+        if fill_size <= 0:
+            print "error: no space left in the image for partition", fill
+            sys.exit(-1)
+        part_entries[fill]['size'] = fill_size
 
-        else: # format in  entry
-            if 'type' not in entry:
-                part_entries[part]['fdisk_type'] = derive_fdisk_type_from_format(entry['format'])
-            else:
-                part_entries[part]['fdisk_type'] = entry['type']
+    offset = align_up(FIRST_PARTITION_MIN_START / 512, align_sectors)
+    for part in order:
+        entry = part_entries[part]
 
         # update offset
         part_entries[part]['start'] = offset # in sectors
         bsize = ( entry['size'] / 512 + ((entry['size'] % 512) != 0)*1)  # because size is in bytes
-        offset = offset + bsize + 1
+        offset = align_up(offset + bsize, align_sectors)
 
         # it is handy to save the size in blocks, as this is what fdisk needs
         part_entries[part]['bsize'] = bsize
 
-    if total_size > image_size:
-        print "error: partitions are too big to fit in image"
+    end = max([part_entries[part]['start'] + part_entries[part]['bsize']
+               for part in order]) * 512
+    if image_size is None:
+        image_size = align_up(end, align)
+    elif end > image_size:
+        print "error: partitions are too big to fit in image (%d MiB needed)" \
+              % (align_up(end, 1024*1024) / (1024*1024))
         sys.exit(-1)
 
-    return part_entries
+    return (part_entries, image_size)
+
+#==============================================================================
+# checks what goes into the partitions, before anything is built: the files
+#! exist, raw files fit, FAT32 partitions are big enough
+def check_part_inputs(part_entries):
+
+    for part in sorted(part_entries.keys()):
+        entry = part_entries[part]
+        for stuff in entry['files']:
+            if stuff != "-" and not glob.glob(stuff):
+                print "error: partition", part, ":", stuff, ": no such file"
+                sys.exit(-1)
+        if re.search("raw|none", entry['format']):
+            check_raw_files(entry)
+        if entry['format'] == "fat32" and entry['size'] < 33554432:
+            print "error: Unable to create a fat32 partition size < 32MB"
+            sys.exit(-1)
+
+    return
 
 #==============================================================================
 # this script can only be run by the zuper user
@@ -285,6 +1029,7 @@ def check_file_exists(filename):
 
 #==============================================================================
 # this function creates an empty image
+@timed_stage("create_empty_image")
 def create_empty_image(image_name, image_size, force_erase_image):
 
     # first check if the image exists...
@@ -322,6 +1067,7 @@ def create_empty_image(image_name, image_size, force_erase_image):
 # this function creates a loopback device
 # it is assumed the file exists
 # offset in bytes
+@timed_stage("loopback setup")
 def create_loopback(image_name, size, offset=0):
 
     try:
@@ -341,107 +1087,270 @@ def create_loopback(image_name, size, offset=0):
     # strip trailing \n
     device = str.rstrip(device)
     # keep track of the devices used
-    loopback_dev_used.append(device)
+    get_resources().loopback_devs.append(device)
 
     return device
 
 #==============================================================================
-# this function deletes a loopback device
-def delete_loopback(device):
+# polls condition() with an exponential backoff until it returns True or
+#! the timeout expires. The time spent is recorded under 'what'
+# returns the last value of condition()
+def wait_until(what, condition, timeout=SETTLE_TIMEOUT):
+
+    start = time.time()
+    delay = SETTLE_MIN_DELAY
+    while True:
+        done = condition()
+        if done or time.time() - start >= timeout:
+            break
+        time.sleep(delay)
+        delay = min(delay * 2, SETTLE_MAX_DELAY)
+
+    with settle_times_lock:
+        settle_times.append((what, time.time() - start))
+
+    return done
+
+#==============================================================================
+# waits for udev to process the events of our devices (mkfs, mount...),
+#! as long as it needs but not longer
+def settle_udev():
 
+    start = time.time()
     try:
-        check_output(["losetup", "-d", str(device)], stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError:
+        call(["udevadm", "settle",
+              "--timeout="+str(SETTLE_TIMEOUT)],
+             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        # no udev, nobody else opens our devices
+        pass
+
+    with settle_times_lock:
+        settle_times.append(("udevadm settle", time.time() - start))
+
+    return
+
+#==============================================================================
+# flushes a mounted file system
+def sync_fs(mp):
+
+    try:
+        if call(["sync", "-f", mp],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE):
+            # coreutils < 8.24
+            call(["sync"])
+    except OSError:
+        pass
+
+    return
+
+#==============================================================================
+# true when the kernel still has a backing file for the loopback device
+def loopback_attached(device):
+
+    return os.path.exists("/sys/block/"+os.path.basename(device)+
+                          "/loop/backing_file")
+
+#==============================================================================
+# this function deletes a loopback device
+@timed_stage("loopback teardown")
+def delete_loopback(device, res=None):
+
+    if res is None:
+        res = get_resources()
+
+    settle_udev()
+
+    # retry for as long as the device is busy, any other failure is final
+    result = {}
+    def detach():
+        try:
+            check_output(["losetup", "-d", str(device)],
+                         stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError as e:
+            result['output'] = e.output
+            return "busy" not in e.output
+        result['output'] = None
+        return True
+
+    wait_until("losetup -d "+device, detach)
+    if result['output'] is not None:
+        print "error: losetup -d", device, ":", result['output'].rstrip()
         return False
 
+    # a busy device is only marked for auto clear, wait for it to go
+    if not wait_until("detach "+device,
+                      lambda: not loopback_attached(device)):
+        print "warning:", device, ": still attached"
+
     # remove the device from the list
-    loopback_dev_used.remove(device)
+    res.loopback_devs.remove(device)
 
     return True
 
 #==============================================================================
-# clean up
-def clean_up():
+# returns the resources of the calling thread
+def get_resources():
 
-    for mp in mounted_fs:
-        umount_fs(mp)
+    res = getattr(thread_data, 'resources', None)
+    if res is None:
+        res = Resources()
+        thread_data.resources = res
+        with all_resources_lock:
+            all_resources.append(res)
+
+    return res
+
+#==============================================================================
+# clean up, by default what the calling thread holds
+def clean_up(res=None):
+
+    if res is None:
+        res = get_resources()
 
-    for device in loopback_dev_used:
-        if not delete_loopback(device):
+    for mp in list(res.mounts):
+        umount_fs(mp, res)
+
+    for device in list(res.loopback_devs):
+        if not delete_loopback(device, res):
             print "error: could not delete loopback device", device
 
+    for path in list(res.temp_files):
+        remove_temp(path, res)
 
     return 0
 
 #==============================================================================
-# this function creates the partition table
-def create_partition_table(loopback, partition_entries):
+# clean up what every thread holds, once the workers are done
+def clean_up_all():
 
-    # our command list for fdisk
-    cmd = ""
-    # the number of questions asked bby fdisk, for one partition depebds
-    #!on the number of partitions defined
-    first_part = True
+    with all_resources_lock:
+        resources = list(all_resources)
+
+    for res in resources:
+        clean_up(res)
+
+    return 0
+
+#==============================================================================
+# called by partition workers between steps: if another worker failed, stop
+def check_abort():
+
+    if abort_build.is_set():
+        clean_up()
+        sys.exit(-1)
+
+    return
+
+#==============================================================================
+# runs a command, on failure prints errmsg (and what the command said),
+#! cleans up and exits
+def run_cmd(cmd, errmsg, env=None, stdin=None):
 
-    # open up a pipe to fdisk
     try:
-        p = subprocess.Popen(["fdisk", loopback, "-u"],
-                             stdin=subprocess.PIPE,
-                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    except OSError:
-        print "error: fdisk: system error"
+        p = Popen(cmd, stdin=stdin, env=env,
+                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        [output, stderr] = p.communicate()
+    except OSError as e:
+        print "error:", cmd[0]+":", e
         clean_up()
         sys.exit(-1)
-    except ValueError:
-        print "error: Popen: invalid args"
+
+    if p.returncode != 0:
+        print "error:", errmsg
+        if stderr:
+            print stderr.rstrip()
         clean_up()
         sys.exit(-1)
 
+    return output
+
+#==============================================================================
+# removes a temporary file or directory created by this script
+def remove_temp(path, res=None):
+
+    if res is None:
+        res = get_resources()
+
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+    if path in res.temp_files:
+        res.temp_files.remove(path)
+
+    return
+
+#==============================================================================
+# converts a sector number to the 3 bytes CHS address of an MBR entry, using
+#! the usual 255 heads/63 sectors geometry. Addresses beyond CHS reach are
+#! given as 1023/254/63, the LBA fields are what is used anyway
+def lba_to_chs(lba):
+
+    cylinder = lba / (MBR_HEADS * MBR_SECTORS)
+    head = (lba / MBR_SECTORS) % MBR_HEADS
+    sector = lba % MBR_SECTORS + 1
+    if cylinder > 1023:
+        (cylinder, head, sector) = (1023, 254, 63)
+
+    return struct.pack("<BBB", head,
+                       ((cylinder >> 2) & 0xc0) | sector, cylinder & 0xff)
+
+#==============================================================================
+# builds one 16 bytes MBR partition entry
+def mbr_entry(start, bsize, fdisk_type):
+
+    return struct.pack("<B3sB3sII", 0, lba_to_chs(start), fdisk_type,
+                       lba_to_chs(start + bsize - 1), start, bsize)
+
+#==============================================================================
+# this function creates the partition table
+#! the MBR is written straight into the image (disk signature, 4 entries and
+#! boot signature, in one write), the boot code area is left alone
+@timed_stage("create_partition_table")
+def create_partition_table(image_name, partition_entries):
+
+    image_sectors = os.stat(image_name).st_size / 512
+    entries = [struct.pack("16x")] * MAX_PARTITIONS
+
     for part in partition_entries.keys():
         pentry = partition_entries[part]
-        # first we create the partition
-        cmd = """\
-n
-p
-"""+str(pentry['num'])+"""
-"""+str(pentry['start'])+"""
-+"""+str(pentry['bsize'])+"""
-"""
-        p.stdin.write(cmd)
-
-        # second we set the type
-        if first_part:
-            cmd = """\
-t
-"""+pentry['fdisk_type']+"""
-"""
-            first_part = False
-        else:
-            cmd = """\
-t
-"""+str(pentry['num'])+"""
-"""+pentry['fdisk_type']+"""
-"""
-        p.stdin.write(cmd)
-
 
+        if pentry['num'] < 1 or pentry['num'] > MAX_PARTITIONS:
+            print "error:", pentry['num'], ": partition number must be 1 to", \
+                  MAX_PARTITIONS
+            sys.exit(-1)
 
-    # we need to write and quit
-    cmd = """
-w
-q
-"""
-    p.stdin.write(cmd)
-    p.communicate()
+        try:
+            fdisk_type = int(pentry['fdisk_type'], 16)
+        except ValueError:
+            fdisk_type = -1
+        if fdisk_type <= 0 or fdisk_type > 0xff:
+            print "error:", pentry['fdisk_type'], ": not a valid partition type"
+            sys.exit(-1)
 
-    # sometimes the kernel does not reload the pattition table
-    #!a little help is needed
-    if p.returncode != 0:
-        pp = subprocess.Popen(["partprobe", loopback])
-        pp.communicate()
-        if pp.returncode != 0:
-            print "error: could not reload the partition table from image"
+        if pentry['start'] + pentry['bsize'] > image_sectors:
+            print "error: partition", pentry['num'], "ends beyond the image"
             sys.exit(-1)
+
+        entries[pentry['num'] - 1] = mbr_entry(pentry['start'],
+                                               pentry['bsize'], fdisk_type)
+
+    disk_id = struct.unpack("<I", os.urandom(4))[0]
+    mbr = struct.pack("<IH", disk_id, 0) + ''.join(entries) + "\x55\xaa"
+
+    try:
+        fd = os.open(image_name, os.O_WRONLY)
+        try:
+            write_at(fd, mbr, MBR_TABLE_OFFSET)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        print "error:", e, ": failed to write the partition table"
+        sys.exit(-1)
+
     return
 
 #==============================================================================
@@ -470,23 +1379,82 @@ def get_mkfs_params_from_format(pformat):
 
     return params
 
+#==============================================================================
+# returns the version of mke2fs as a tuple, (0,) if unknown
+def get_mke2fs_version():
+
+    if not mke2fs_version:
+        version = (0,)
+        try:
+            p = Popen(["mke2fs", "-V"],
+                      stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            [output, stderr] = p.communicate()
+            m = re.search("mke2fs ([0-9.]+)", output + stderr)
+            if m:
+                version = tuple([int(n) for n in m.group(1).split(".") if n])
+        except OSError:
+            pass
+        mke2fs_version.append(version)
+
+    return mke2fs_version[0]
+
+#==============================================================================
+# the tarball a partition is populated from: a file ending in .tar[.*], or
+#! "-" for a tar stream on stdin. None if the inputs are files and trees
+def get_tarball(partition_data):
+
+    files = partition_data['files']
+    if len(files) != 1:
+        return None
+    if files[0] == "-":
+        return "-"
+    if re.search(TARBALL_RE, files[0]) and os.path.isfile(files[0]):
+        return files[0]
+
+    return None
+
+#==============================================================================
+# true when the partition can be created already populated by mke2fs -d,
+#! rather than formatted, mounted and copied to
+def can_populate_at_format(partition_data):
+
+    if not re.search("^ext[2-4]$", partition_data['format']):
+        return False
+    if get_tarball(partition_data):
+        return get_mke2fs_version() >= MKE2FS_TAR_VERSION
+
+    return get_mke2fs_version() >= MKE2FS_DIR_VERSION
+
+#==============================================================================
+# what to give to mke2fs -d: the tarball, or a directory holding the files,
+#! None if there is nothing to copy
+def get_populate_source(partition_data, image_name):
+
+    tarball = get_tarball(partition_data)
+    if tarball:
+        return tarball
+
+    return get_populate_dir(partition_data, image_name)
+
 #==============================================================================
 # formats a vlock device
-def format_partition(loopback, fs_format):
+#! ext[2-4] file systems can be populated at the same time from 'populate'
+#! (see get_populate_source()), stdin is passed through for "-"
+@timed_stage("format_partition")
+def format_partition(loopback, fs_format, populate=None, options=None):
 
     cmd = get_mkfs_from_format(fs_format)
-    params = get_mkfs_params_from_format(fs_format)
+    params = get_mkfs_params_from_format(fs_format).split() + (options or [])
     if cmd:
-        if params:
-            p = subprocess.Popen([cmd, loopback, params],
-                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        else:
-            p = subprocess.Popen([cmd, loopback],
-                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if populate:
+            params = params + ["-d", populate]
+        p = Popen([cmd] + params + [loopback],
+                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         #RODO: add timeout?
-        p.communicate()
+        [output, stderr] = p.communicate()
         if p.returncode != 0:
             print "error: format: failed"
+            print stderr.rstrip()
             clean_up()
             sys.exit(-1)
 
@@ -502,20 +1470,21 @@ def get_mountfs_from_format(pformat):
 #==============================================================================
 # mount a file system
 #! returns the mnt point
+@timed_stage("mount")
 def mount_fs(loopback, fs_format):
 
-    mp = "/tmp/"+str(int(time.time()))+"_"+str(os.getpid())
+    # partitions may be mounted concurrently, each needs a unique mount point
     try:
-        os.mkdir(mp)
+        mp = tempfile.mkdtemp(prefix="sdimage_"+str(os.getpid())+"_")
     except OSError:
-        print "error: failed to create mount point (", mp,")"
+        print "error: failed to create mount point"
         clean_up()
         sys.exit(-1)
 
     format = get_mountfs_from_format(fs_format)
 
-    p = subprocess.Popen(["mount", "-t", format, loopback, mp],
-                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    p = Popen(["mount", "-t", format, loopback, mp],
+              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     p.wait()
     if p.returncode != 0:
         print "error: mount: failed (", loopback, mp,")"
@@ -523,88 +1492,472 @@ def mount_fs(loopback, fs_format):
         sys.exit(-1)
 
     # keep track of the mount points
-    mounted_fs.append(mp)
+    get_resources().mounts.append(mp)
 
     return mp
 
 #==============================================================================
-# unmount fs
-def umount_fs(mp):
+# prints the processes that keep a mount point busy
+def report_blockers(mp):
 
-    time.sleep(3)
-    p = subprocess.Popen(["umount", mp],
-                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    p.wait()
-    if p.returncode != 0:
+    for cmd in [["fuser", "-vm", mp], ["lsof", "+f", "--", mp]]:
+        try:
+            p = Popen(cmd, stdout=subprocess.PIPE,
+                      stderr=subprocess.STDOUT)
+        except OSError:
+            continue
+        [output, stderr] = p.communicate()
+        print "error:", mp, "is in use by:"
+        print output.rstrip()
+        return
+
+    return
+
+#==============================================================================
+# prints how long we waited for devices
+def report_settle_times():
+
+    with settle_times_lock:
+        times = list(settle_times)
+
+    total = sum([t for (what, t) in times])
+    longest = max([(t, what) for (what, t) in times] or [(0, "")])
+    print "info: waited %.3f s for devices (%d waits, longest %.3f s: %s)" % \
+          (total, len(times), longest[0], longest[1])
+
+    return
+
+#==============================================================================
+# unmount fs
+@timed_stage("umount")
+def umount_fs(mp, res=None):
+
+    if res is None:
+        res = get_resources()
+
+    sync_fs(mp)
+
+    # retry for as long as the mount point is busy, and only then
+    result = {}
+    def try_umount():
+        p = Popen(["umount", mp],
+                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        [output, stderr] = p.communicate()
+        result['returncode'] = p.returncode
+        result['stderr'] = stderr
+        return p.returncode == 0 or "busy" not in stderr
+
+    wait_until("umount "+mp, try_umount)
+    if result['returncode'] != 0:
         print "error: failed to umount", mp
+        print result['stderr'].rstrip()
+        if "busy" in result['stderr']:
+            report_blockers(mp)
         sys.exit(-1)
 
     # update the list
-    mounted_fs.remove(mp)
+    res.mounts.remove(mp)
+    try:
+        os.rmdir(mp)
+    except OSError:
+        pass
 
     return
 
 #==============================================================================
-#do a raw copy of files to a partition
-def do_raw_copy(loopback, partition_data):
+# write a whole buffer at a given position, os.write() may be partial
+def write_at(fd, data, pos):
+
+    os.lseek(fd, pos, os.SEEK_SET)
+    written = 0
+    while written < len(data):
+        written = written + os.write(fd, data[written:])
+    count_bytes_written(written)
+
+    return
+
+#==============================================================================
+# copy a file into an open device/file, starting at 'offset'
+#! the copy is done in RAW_BLOCK_SIZE chunks, all-zero chunks are skipped when
+#! skip_zeros is set: the target must then already read back as zeros (which
+#! is the case for a freshly created image), and the result stays sparse
+# returns the number of bytes actually written
+def write_raw_file(fd, filename, offset, skip_zeros=True):
+
+    written = 0
+    pos = offset
+
+    f = open(filename, 'rb')
+    try:
+        while True:
+            block = f.read(RAW_BLOCK_SIZE)
+            if not block:
+                break
+            if skip_zeros and block == ZERO_BLOCK[:len(block)]:
+                pos = pos + len(block)
+                continue
+            write_at(fd, block, pos)
+            pos = pos + len(block)
+            written = written + len(block)
+    finally:
+        f.close()
+
+    return written
+
+#==============================================================================
+# read 'size' bytes at a given position
+def read_at(fd, pos, size):
+
+    os.lseek(fd, pos, os.SEEK_SET)
+    chunks = []
+    while size > 0:
+        data = os.read(fd, size)
+        if not data:
+            break
+        chunks.append(data)
+        size = size - len(data)
+
+    return ''.join(chunks)
+
+#==============================================================================
+# copies 'length' bytes between two open files, at the given positions
+#! see write_raw_file() regarding skip_zeros
+# returns the number of bytes actually written
+def copy_range(src_fd, src_pos, length, dst_fd, dst_pos, skip_zeros=True):
+
+    written = 0
+    while length > 0:
+        block = read_at(src_fd, src_pos, min(length, RAW_BLOCK_SIZE))
+        if not block:
+            break
+        if not (skip_zeros and block == ZERO_BLOCK[:len(block)]):
+            write_at(dst_fd, block, dst_pos)
+            written = written + len(block)
+        src_pos = src_pos + len(block)
+        dst_pos = dst_pos + len(block)
+        length = length - len(block)
+
+    return written
+
+#==============================================================================
+# lists the (offset, length) ranges of a file that hold data, between 'first'
+#! and 'first + size'. Holes are found with SEEK_DATA/SEEK_HOLE, when the
+#! file system (or device) can't tell, everything is data
+def get_data_ranges(fd, size, first=0):
+
+    ranges = []
+    pos = first
+    last = first + size
+    try:
+        while pos < last:
+            start = os.lseek(fd, pos, SEEK_DATA)
+            if start >= last:
+                break
+            end = min(os.lseek(fd, start, SEEK_HOLE), last)
+            ranges.append((start, end - start))
+            pos = end
+    except OSError as e:
+        if e.errno == errno.ENXIO:
+            # no data past pos
+            return ranges
+        if e.errno == errno.EINVAL:
+            return [(first, size)]
+        raise
+
+    return ranges
+
+#==============================================================================
+# shares a range of blocks between two files (FICLONERANGE), no data is
+#! copied. Only works on file systems with reflinks (btrfs, xfs) and for
+#! block aligned offsets, returns False when it could not be done
+def reflink_range(src_fd, src_pos, length, dst_fd, dst_pos):
+
+    arg = struct.pack("=qQQQ", src_fd, src_pos, length, dst_pos)
+    try:
+        fcntl.ioctl(dst_fd, FICLONERANGE, arg)
+    except IOError:
+        return False
+
+    return True
+
+#==============================================================================
+# prints the throughput of a copy
+def report_throughput(what, nbytes, elapsed):
+
+    if elapsed > 0:
+        rate = nbytes / elapsed / (1024*1024)
+    else:
+        rate = 0.0
+    print "info: %s: %d bytes in %.2f s (%.1f MB/s)" % (what, nbytes,
+                                                        elapsed, rate)
+
+    return
+
+#==============================================================================
+# checks the files of a raw partition, returns their total size
+def check_raw_files(partition_data):
 
     offset = 0  # offset in bytes
 
-    # below, stuff is just a file...
+    # we do accept FILES only, no directories please, and they must fit
     for stuff in partition_data['files']:
-        # we do accept FILES only, no directories please
         if os.path.isdir(stuff):
             print "error:", stuff, ": can't copy dirs to raw partitions"
             clean_up()
             sys.exit(-1)
-
-        # now dd the file:
-        #! dd if=file of=loopback bs=1 seek=offset
-        p = subprocess.Popen(["dd", "if="+stuff, "of="+loopback, "bs=1",
-                             "seek="+str(offset)],
-                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        p.wait()
-        if p.returncode != 0:
-            print "error:", stuff, ": failed to do raw copy"
+        if not check_file_exists(stuff):
+            print "error:", stuff, ": no such file"
             clean_up()
             sys.exit(-1)
-
-        # handle offset
         offset = offset + os.stat(stuff).st_size
 
+    if offset > partition_data['size']:
+        print "error: raw files do not fit in partition", partition_data['num']
+        clean_up()
+        sys.exit(-1)
+
+    return offset
+
+#==============================================================================
+#do a raw copy of files to a partition
+def do_raw_copy(loopback, partition_data):
+
+    check_raw_files(partition_data)
+
+    # the files are concatenated, no GAP, each one starting where the
+    #! previous one ended
+    start = time.time()
+    offset = 0
+    written = 0
+    try:
+        fd = os.open(loopback, os.O_WRONLY)
+        try:
+            for stuff in partition_data['files']:
+                written = written + write_raw_file(fd, stuff, offset)
+                offset = offset + os.stat(stuff).st_size
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except (IOError, OSError) as e:
+        print "error:", e, ": failed to do raw copy"
+        clean_up()
+        sys.exit(-1)
+
+    report_throughput("raw copy", written, time.time() - start)
+
     return
 
+#==============================================================================
+# copies trees into a mounted file system: the tree is walked by the calling
+#! thread, which creates directories, symlinks, device nodes and hardlinks,
+#! while regular files are copied by a pool of threads (sparse, like the raw
+#! copies). Ownership, permissions, times and xattrs are kept, unless the
+#! file system is FAT where, like cp -r, only names and data are copied
+class TreeCopier(object):
+
+    def __init__(self, fat=False, threads=COPY_THREADS):
+        self.fat = fat
+        self.threads = threads
+        self.queue = Queue.Queue(maxsize=threads * 64)
+        self.inodes = {}
+        self.hardlinks = []
+        self.symlinks = {}
+        self.dirs = []
+        self.errors = []
+        self.files = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    # copies each source into dest, as dest/basename(source)
+    def copy(self, sources, dest):
+        start = time.time()
+        workers = []
+        for i in range(self.threads):
+            t = threading.Thread(target=self.worker)
+            t.daemon = True
+            t.start()
+            workers.append(t)
+
+        try:
+            for stuff in sources:
+                self.copy_entry(stuff,
+                                os.path.join(dest, os.path.basename(stuff)))
+        except (IOError, OSError) as e:
+            self.errors.append(e)
+        finally:
+            for t in workers:
+                self.queue.put(None)
+            for t in workers:
+                t.join()
+
+        if not self.errors:
+            try:
+                for (path, target) in self.hardlinks:
+                    os.link(target, path)
+                self.set_symlink_times()
+                # deepest first, so that creating entries does not touch
+                #! the times of the parent again
+                for (path, st) in reversed(self.dirs):
+                    self.set_metadata(path, st)
+            except (IOError, OSError) as e:
+                self.errors.append(e)
+
+        if not self.errors and not self.fat:
+            for stuff in sources:
+                if not self.copy_xattrs(stuff, dest):
+                    break
+
+        elapsed = max(time.time() - start, 0.001)
+        print "info: copied %d files, %d bytes in %.2f s " \
+              "(%.0f files/s, %.1f MB/s)" % (self.files, self.bytes, elapsed,
+                                             self.files / elapsed,
+                                             self.bytes / elapsed / (1024*1024))
+
+        return not self.errors
+
+    def copy_entry(self, path, dst):
+        if self.fat:
+            # FAT has no links nor special files, what links point to is
+            #! copied instead
+            st = os.stat(path)
+        else:
+            st = os.lstat(path)
+
+        if stat.S_ISDIR(st.st_mode):
+            try:
+                os.mkdir(dst)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            self.dirs.append((dst, st))
+            for name in sorted(os.listdir(path)):
+                self.copy_entry(os.path.join(path, name),
+                                os.path.join(dst, name))
+        elif stat.S_ISREG(st.st_mode):
+            if st.st_nlink > 1 and not self.fat:
+                inode = (st.st_dev, st.st_ino)
+                if inode in self.inodes:
+                    self.hardlinks.append((dst, self.inodes[inode]))
+                    return
+                self.inodes[inode] = dst
+            self.queue.put((path, dst, st))
+        elif self.fat:
+            print "warning:", path, ": special file not copied to FAT"
+        elif stat.S_ISLNK(st.st_mode):
+            os.symlink(os.readlink(path), dst)
+            os.lchown(dst, st.st_uid, st.st_gid)
+            self.symlinks.setdefault(st.st_mtime, []).append(dst)
+        elif stat.S_ISFIFO(st.st_mode):
+            os.mkfifo(dst)
+            self.set_metadata(dst, st)
+        else:
+            # devices and sockets
+            os.mknod(dst, st.st_mode, st.st_rdev)
+            self.set_metadata(dst, st)
+
+    def worker(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            if self.errors:
+                continue
+            try:
+                self.copy_file(*job)
+            except Exception as e:
+                # a dead worker would leave copy_entry() blocked on the queue
+                self.errors.append(e)
+
+    def copy_file(self, path, dst, st):
+        src_fd = os.open(path, os.O_RDONLY)
+        try:
+            dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+            try:
+                for (pos, length) in get_data_ranges(src_fd, st.st_size):
+                    copy_range(src_fd, pos, length, dst_fd, pos)
+                # holes at the end
+                os.ftruncate(dst_fd, st.st_size)
+                if not self.fat:
+                    # chown first, it drops the setuid/setgid bits
+                    os.fchown(dst_fd, st.st_uid, st.st_gid)
+                    os.fchmod(dst_fd, stat.S_IMODE(st.st_mode))
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+        if not self.fat:
+            os.utime(dst, (st.st_atime, st.st_mtime))
+
+        with self.lock:
+            self.files = self.files + 1
+            self.bytes = self.bytes + st.st_size
+
+    # os.utime() follows links and Python 2 has no lutimes(): the times of
+    #! the links are set by touch -h, one call for all the links of a time
+    def set_symlink_times(self):
+        for mtime in sorted(self.symlinks.keys()):
+            paths = self.symlinks[mtime]
+            for i in range(0, len(paths), 512):
+                if call(["touch", "-h", "-d", "@%.9f" % mtime] +
+                        paths[i:i+512]) != 0:
+                    print "warning: failed to set the times of some links"
+                    return
+
+    def set_metadata(self, path, st):
+        if self.fat:
+            return
+        os.lchown(path, st.st_uid, st.st_gid)
+        os.chmod(path, stat.S_IMODE(st.st_mode))
+        os.utime(path, (st.st_atime, st.st_mtime))
+
+    # xattrs (and ACLs, and file capabilities) of a whole tree in one go:
+    #! dumped by getfattr, restored by setfattr once ownership is final.
+    #! Returns False when the attr tools are missing
+    def copy_xattrs(self, stuff, dest):
+        parent = os.path.dirname(os.path.abspath(stuff))
+        try:
+            p = Popen(["getfattr", "-R", "-P", "-h", "-d", "-m", "-",
+                       "-e", "hex", os.path.basename(stuff)], cwd=parent,
+                      stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            dump = p.communicate()[0]
+        except OSError:
+            print "warning: getfattr not found, xattrs not copied"
+            return False
+        if not dump.strip():
+            return True
+
+        p = Popen(["setfattr", "-h", "--restore=-"], cwd=dest,
+                  stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                  stderr=subprocess.PIPE)
+        [output, stderr] = p.communicate(dump)
+        if p.returncode != 0:
+            print "warning: failed to copy some xattrs:", stderr.rstrip()
+        return True
+
 #==============================================================================
 # copy files over a file system
 def do_copy(loopback, partition_data):
 
     mp = mount_fs(loopback, partition_data['format'])
-    for stuff in partition_data['files']:
-        if os.path.isdir(stuff):
-            stuff = stuff+"/*"
 
-        # some file systems have limited flags like FAT
-        if re.search("^fat|vfat|fat32$", partition_data['format']):
-            cp_opt = "-rt"
-        else:
-            cp_opt = "-at"
-
-        # as we need to do UNIX path expansion, we'll use the class glob,
-        #! so we need to call cp with the option -t, such that the destination
-        #! directory can be specified first. The list returned by glob can then
-        #! be added to the list of args passed to Popen
-        print mp
-        print glob.glob(stuff)
-        try:
-            p = subprocess.Popen(["cp", cp_opt, mp ] + glob.glob(stuff),
-                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            [output,stderr] = p.communicate()
-            if p.returncode:
-                raise Exception([])
-        except Exception:
-            print "error: failed to copy", stuff
-            clean_up()
-            sys.exit(-1)
+    # an old mke2fs could not take the tarball, extract it straight into the
+    #! partition
+    tarball = get_tarball(partition_data)
+    if tarball:
+        run_cmd(["tar", "-x", "-p", "--numeric-owner", "--xattrs",
+                 "--xattrs-include=*", "--acls", "-C", mp, "-f", tarball],
+                "failed to extract "+tarball)
+        umount_fs(mp)
+        return
+
+    # some file systems have limited flags like FAT
+    fat = re.search("^fat|vfat|fat32$", partition_data['format']) is not None
+
+    copier = TreeCopier(fat, copy_threads)
+    if not copier.copy(expand_sources(partition_data), mp):
+        print "error: failed to copy files:", copier.errors[0]
+        clean_up()
+        sys.exit(-1)
 
     umount_fs(mp)
 
@@ -613,6 +1966,7 @@ def do_copy(loopback, partition_data):
 #==============================================================================
 # copy files to  a partition
 #! takes care of the format, if raw|none use dd
+@timed_stage("copy_files_to_partition")
 def copy_files_to_partition(loopback, partition_data):
 
     if re.search("raw|none", partition_data['format']):
@@ -637,9 +1991,16 @@ def do_partition(partition, image_name):
         sys.exit(-1)
 
     loopback = create_loopback(image_name, partition['size'], offset_bytes)
-    format_partition(loopback, partition['format'])
-    copy_files_to_partition(loopback, partition)
-    time.sleep(3)
+    if can_populate_at_format(partition):
+        # no mount, no copy
+        format_partition(loopback, partition['format'],
+                         get_populate_source(partition, image_name),
+                         get_mkfs_options(partition))
+    else:
+        format_partition(loopback, partition['format'],
+                         options=get_mkfs_options(partition))
+        check_abort()
+        copy_files_to_partition(loopback, partition)
     if not delete_loopback(loopback):
         clean_up()
         sys.exit(-1)
@@ -647,7 +2008,1063 @@ def do_partition(partition, image_name):
     return
 
 #==============================================================================
-def create_image(image_name, image_size, partition_entries, force_erase_image):
+# expands the files of a partition like do_copy() does: a directory stands
+#! for its contents, anything else is a glob pattern
+def expand_sources(partition_data):
+
+    sources = []
+    for stuff in partition_data['files']:
+        if os.path.isdir(stuff):
+            stuff = stuff+"/*"
+        sources = sources + glob.glob(stuff)
+
+    return sources
+
+#==============================================================================
+# mke2fs -d takes a single directory. When the sources are exactly the
+#! contents of one directory (the usual 'mnt/2/*') that directory is used as
+#! it is, otherwise the sources are hardlinked (or copied) into a staging
+#! directory next to the image
+# returns None when there is nothing to copy
+def get_populate_dir(partition_data, image_name):
+
+    sources = expand_sources(partition_data)
+    if len(sources) == 0:
+        return None
+
+    parents = set([os.path.dirname(s) for s in sources])
+    if len(parents) == 1:
+        parent = parents.pop() or "."
+        # note: unlike cp, mke2fs also picks up the top level dot files
+        if sorted(sources) == sorted(glob.glob(os.path.join(parent, "*"))):
+            return parent
+
+    staging = tempfile.mkdtemp(prefix="sdimage_",
+                               dir=os.path.dirname(os.path.abspath(image_name)))
+    get_resources().temp_files.append(staging)
+    for stuff in sources:
+        p = Popen(["cp", "-al", stuff, staging],
+                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        p.communicate()
+        if p.returncode != 0:
+            run_cmd(["cp", "-a", stuff, staging],
+                    "failed to stage "+stuff)
+
+    return staging
+
+#==============================================================================
+# creates an ext[2-4] file system inside a file, populated at format time
+def build_ext_file(part_file, partition_data, image_name):
+
+    if not can_populate_at_format(partition_data):
+        print "error: mke2fs", ".".join([str(n) for n in get_mke2fs_version()]), \
+              "can't populate", partition_data['files'], \
+              "(-d needs e2fsprogs 1.43, tarballs 1.47.1)"
+        clean_up()
+        sys.exit(-1)
+
+    src = get_populate_source(partition_data, image_name)
+    cmd = ["mke2fs", "-q", "-F", "-t", partition_data['format']] + \
+          get_mkfs_options(partition_data)
+    if src:
+        cmd = cmd + ["-d", src]
+    run_cmd(cmd + [part_file], "format: failed")
+
+    return
+
+#==============================================================================
+# creates a FAT file system inside a file and copies the files with mtools
+def build_fat_file(part_file, partition_data):
+
+    cmd = get_mkfs_from_format(partition_data['format'])
+    params = get_mkfs_params_from_format(partition_data['format']).split()
+    run_cmd([cmd] + params + [part_file], "format: failed")
+
+    sources = expand_sources(partition_data)
+    if sources:
+        env = dict(os.environ)
+        env['MTOOLS_SKIP_CHECK'] = '1'
+        run_cmd(["mcopy", "-i", part_file, "-s", "-Q"] + sources + ["::/"],
+                "failed to copy files with mcopy", env=env)
+
+    return
+
+#==============================================================================
+# builds a partition as a standalone (sparse) file, without loopback devices
+#! or mounts, so no root needed
+# returns the name of the file
+@timed_stage("build_partition_file")
+def build_partition_file(partition, image_name):
+
+    part_file = image_name+".part"+str(partition['num'])
+    get_resources().temp_files.append(part_file)
+    try:
+        f = open(part_file, 'wb')
+        f.truncate(partition['size'])
+        f.close()
+    except IOError as e:
+        print "error:", part_file, ":", e
+        clean_up()
+        sys.exit(-1)
+
+    pformat = partition['format']
+    if re.search("raw|none", pformat):
+        do_raw_copy(part_file, partition)
+    elif re.search("^ext[2-4]$", pformat):
+        build_ext_file(part_file, partition, image_name)
+    elif re.search("^fat|vfat|fat32$", pformat):
+        build_fat_file(part_file, partition)
+    else:
+        print "error:", pformat, ": not supported without loopback devices"
+        clean_up()
+        sys.exit(-1)
+
+    return part_file
+
+#==============================================================================
+# puts a partition file into the image at offset (bytes). Only the data
+#! ranges of the file are considered, they are reflinked when the file system
+#! allows it and copied otherwise
+@timed_stage("splice_partition_file")
+def splice_partition_file(part_file, image_name, offset):
+
+    start = time.time()
+    copied = 0
+    cloned = 0
+    try:
+        src = os.open(part_file, os.O_RDONLY)
+        dst = os.open(image_name, os.O_WRONLY)
+        try:
+            for (pos, length) in get_data_ranges(src, os.fstat(src).st_size):
+                if reflink_range(src, pos, length, dst, offset + pos):
+                    cloned = cloned + length
+                else:
+                    copied = copied + copy_range(src, pos, length,
+                                                 dst, offset + pos)
+            os.fsync(dst)
+        finally:
+            os.close(src)
+            os.close(dst)
+    except (IOError, OSError) as e:
+        print "error:", e, ": failed to splice", part_file
+        clean_up()
+        sys.exit(-1)
+
+    report_throughput("splice ("+str(cloned)+" bytes reflinked)",
+                      copied + cloned, time.time() - start)
+
+    return
+
+#==============================================================================
+# copies 'size' bytes of the image, from 'offset', to a new sparse file
+def extract_partition_file(image_name, offset, size, part_file):
+
+    try:
+        src = os.open(image_name, os.O_RDONLY)
+        dst = os.open(part_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+        try:
+            os.ftruncate(dst, size)
+            for (pos, length) in get_data_ranges(src, size, offset):
+                copy_range(src, pos, length, dst, pos - offset)
+            os.fsync(dst)
+        finally:
+            os.close(src)
+            os.close(dst)
+    except (IOError, OSError) as e:
+        print "error:", e, ": failed to extract", part_file
+        clean_up()
+        sys.exit(-1)
+
+    return
+
+#==============================================================================
+# adds one file system entry to a manifest hash: name, type, permissions,
+#! owner, size and time. Regular files can also have their content hashed
+def hash_manifest_entry(h, path, hash_content):
+
+    st = os.lstat(path)
+    h.update("%s %o %d %d %d %r\n" % (path, st.st_mode, st.st_uid, st.st_gid,
+                                      st.st_size, st.st_mtime))
+    if os.path.islink(path):
+        h.update(os.readlink(path)+"\n")
+    elif os.path.isfile(path):
+        if hash_content:
+            f = open(path, 'rb')
+            try:
+                while True:
+                    block = f.read(RAW_BLOCK_SIZE)
+                    if not block:
+                        break
+                    h.update(block)
+            finally:
+                f.close()
+    elif not os.path.isdir(path):
+        h.update("%x\n" % st.st_rdev)
+
+    return
+
+#==============================================================================
+# adds a source (file or whole tree) to a manifest hash
+def hash_manifest(h, path, hash_content):
+
+    hash_manifest_entry(h, path, hash_content)
+    if os.path.isdir(path) and not os.path.islink(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in dirs + sorted(files):
+                hash_manifest_entry(h, os.path.join(root, name), hash_content)
+
+    return
+
+#==============================================================================
+# hash of a partition spec and of the manifest of its inputs: two partitions
+#! with the same key have the same content
+def partition_key(partition, hash_content=False):
+
+    # a stream can't be hashed beforehand
+    if get_tarball(partition) == "-":
+        return None
+
+    h = hashlib.sha256()
+    h.update("%d %s %d %s %s\n" % (CACHE_VERSION, partition['format'],
+                                   partition['size'], partition['fdisk_type'],
+                                   " ".join(get_mkfs_options(partition))))
+    for stuff in expand_sources(partition):
+        hash_manifest(h, stuff, hash_content)
+
+    return h.hexdigest()
+
+#==============================================================================
+# directory of built partitions, named after a hash of the partition spec
+#! and of the manifest of its inputs, least recently used evicted first
+class PartitionCache(object):
+
+    def __init__(self, path, max_size, hash_content=False):
+        self.path = path
+        self.max_size = max_size
+        self.hash_content = hash_content
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                print "error: failed to create cache directory", path
+                sys.exit(-1)
+
+    # the key of a partition
+    def key(self, partition):
+        return partition_key(partition, self.hash_content)
+
+    def blob(self, key):
+        return os.path.join(self.path, key+".img")
+
+    # returns the cached partition file, or None
+    def lookup(self, key):
+        if key is None:
+            return None
+        blob = self.blob(key)
+        with self.lock:
+            if os.path.exists(blob):
+                # mtime is our LRU clock
+                os.utime(blob, None)
+                self.hits = self.hits + 1
+                return blob
+            self.misses = self.misses + 1
+        return None
+
+    # adds a partition file to the cache, hardlinked or reflinked if possible
+    def store(self, key, part_file):
+        if key is None:
+            return
+        tmp = self.blob(key)+".tmp"+str(os.getpid())+"_"+ \
+              str(threading.current_thread().ident)
+        try:
+            os.link(part_file, tmp)
+        except OSError:
+            p = Popen(["cp", "--reflink=auto", "--sparse=always",
+                       part_file, tmp],
+                      stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            p.communicate()
+            if p.returncode != 0:
+                print "warning: could not add", part_file, "to the cache"
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                return
+        os.rename(tmp, self.blob(key))
+        self.evict()
+
+    # same, for a partition built in place in the image
+    def store_range(self, key, image_name, offset, size):
+        if key is None:
+            return
+        tmp = self.blob(key)+".tmp"+str(os.getpid())+"_"+ \
+              str(threading.current_thread().ident)
+        extract_partition_file(image_name, offset, size, tmp)
+        os.rename(tmp, self.blob(key))
+        self.evict()
+
+    # removes the least recently used blobs until the cache fits
+    def evict(self):
+        with self.lock:
+            blobs = []
+            total = 0
+            for name in os.listdir(self.path):
+                if not name.endswith(".img"):
+                    continue
+                path = os.path.join(self.path, name)
+                st = os.stat(path)
+                blobs.append((st.st_mtime, st.st_blocks * 512, path))
+                total = total + st.st_blocks * 512
+            blobs.sort()
+            while total > self.max_size and blobs:
+                (mtime, used, path) = blobs.pop(0)
+                os.remove(path)
+                total = total - used
+
+    # prints (and keeps a running total of) hits and misses
+    def report(self):
+        stats_file = os.path.join(self.path, "stats.json")
+        stats = {'hits': 0, 'misses': 0}
+        try:
+            stats.update(json.load(open(stats_file)))
+        except (IOError, ValueError):
+            pass
+        stats['hits'] = stats['hits'] + self.hits
+        stats['misses'] = stats['misses'] + self.misses
+        try:
+            json.dump(stats, open(stats_file, 'w'))
+        except IOError:
+            pass
+        print "info: partition cache: %d hits, %d misses (%d/%d overall)" % \
+              (self.hits, self.misses, stats['hits'],
+               stats['hits'] + stats['misses'])
+
+#==============================================================================
+# userspace version of do_partition(): build the partition in its own file
+#! and splice it into the image
+def do_partition_userspace(partition, image_name, cache=None, key=None):
+
+    offset_bytes = partition['start'] * 512
+
+    if partition['format'] == "fat32" and partition['size'] < 33554432:
+        print "error: Unable to create a fat32 partition size < 32MB"
+        sys.exit(-1)
+
+    part_file = build_partition_file(partition, image_name)
+    check_abort()
+    if cache is not None:
+        cache.store(key, part_file)
+    splice_partition_file(part_file, image_name, offset_bytes)
+    remove_temp(part_file)
+
+    return
+
+#==============================================================================
+# true when a program can be found in the PATH
+def find_program(name):
+
+    for d in os.environ.get('PATH', "").split(os.pathsep):
+        if os.access(os.path.join(d, name), os.X_OK):
+            return True
+
+    return False
+
+#==============================================================================
+# the ways of building partitions. A backend formats and fills the partitions
+#! of an image whose partition table is written already:
+#!   name                  as given to --backend
+#!   max_jobs              partitions it can build at once, None if no limit
+#!   available()           None when it can be used here, otherwise why not
+#!   supports(partition)   whether it can build that partition
+#!   why_not(partition)    when it can't, why, if there is more to say than
+#!                         the format (None otherwise)
+#!   start(image_name)     before the first partition
+#!   build(partition, image_name, cache, key)
+#!                         builds one partition, and stores it in the cache
+#!   finish(image_name)    once every partition is built
+#!   clean_up()            after a failure
+class Backend(object):
+
+    name = None
+    max_jobs = None
+
+    def available(self):
+        return None
+
+    def supports(self, partition):
+        return True
+
+    def why_not(self, partition):
+        return None
+
+    def start(self, image_name):
+        return
+
+    def finish(self, image_name):
+        return
+
+    def clean_up(self):
+        return
+
+#==============================================================================
+# loopback devices and mounts, the partitions are built in place: needs root
+class LoopBackend(Backend):
+
+    name = "loop"
+
+    def available(self):
+        if not is_user_root():
+            return "only root can set up loopback devices"
+        if not find_program("losetup"):
+            return "no losetup"
+        return None
+
+    def supports(self, partition):
+        if re.search("raw|none", partition['format']):
+            return True
+        return find_program(get_mkfs_from_format(partition['format']))
+
+    def build(self, partition, image_name, cache, key):
+        do_partition(partition, image_name)
+        if cache is not None:
+            cache.store_range(key, image_name, partition['start'] * 512,
+                              partition['size'])
+
+    def finish(self, image_name):
+        report_settle_times()
+
+#==============================================================================
+# each partition is built in its own file (mke2fs -d, mkfs.vfat + mcopy) and
+#! spliced into the image: no loopback devices, no mounts, no root
+class UserspaceBackend(Backend):
+
+    name = "userspace"
+
+    def supports(self, partition):
+        pformat = partition['format']
+        if re.search("raw|none", pformat):
+            return True
+        if re.search("^ext[2-4]$", pformat):
+            return can_populate_at_format(partition)
+        if re.search("^fat|vfat|fat32$", pformat):
+            return find_program("mkfs.vfat") and find_program("mcopy")
+        return False
+
+    def build(self, partition, image_name, cache, key):
+        do_partition_userspace(partition, image_name, cache, key)
+
+#==============================================================================
+# a libguestfs appliance, launched once with the image as its disk, formats
+#! and fills the partitions: no root, every format but fat32 (mkfs can't be
+#! told the FAT size, small partitions would come out as FAT16). The
+#! appliance serves one call at a time, so partitions are built one after
+#! another
+class GuestfsBackend(Backend):
+
+    name = "guestfs"
+    max_jobs = 1
+
+    def __init__(self):
+        self.guest = None
+        self.devices = {}
+
+    def available(self):
+        if guestfs is None:
+            return "no guestfs Python module"
+        return None
+
+    def supports(self, partition):
+        return partition['format'] != "fat32"
+
+    def why_not(self, partition):
+        if partition['format'] == "fat32":
+            return "the FAT size can't be forced to 32 bits"
+        return None
+
+    def start(self, image_name):
+        try:
+            self.guest = guestfs.GuestFS(python_return_dict=True)
+            if guestfs_trace:
+                self.guest.set_trace(1)
+            self.guest.add_drive_opts(image_name, format="raw", readonly=0)
+            self.guest.launch()
+            for device in self.guest.list_partitions():
+                self.devices[self.guest.part_to_partnum(device)] = device
+        except RuntimeError as e:
+            print "error: failed to launch the appliance:", e
+            self.clean_up()
+            sys.exit(-1)
+
+    def build(self, partition, image_name, cache, key):
+        device = self.devices[partition['num']]
+        try:
+            if re.search("raw|none", partition['format']):
+                guestfs_raw_copy(self.guest, device, partition)
+            else:
+                with StageTimer("format_partition"):
+                    mkfs = partition.get('mkfs')
+                    if mkfs:
+                        self.guest.mke2fs(device, fstype=partition['format'],
+                                          blocksize=mkfs['blocksize'],
+                                          numberofinodes=mkfs['inodes'],
+                                          inodesize=mkfs['inode_size'])
+                    else:
+                        self.guest.mkfs(get_mountfs_from_format(partition['format']),
+                                        device)
+                check_abort()
+                with StageTimer("copy_files_to_partition"):
+                    self.guest.mount(device, "/")
+                    guestfs_copy(self.guest, partition)
+                    self.guest.umount("/")
+            # the appliance writes back to the image on sync only
+            self.guest.sync()
+        except RuntimeError as e:
+            print "error: partition", partition['num'], ":", e
+            self.clean_up()
+            sys.exit(-1)
+
+        if cache is not None:
+            cache.store_range(key, image_name, partition['start'] * 512,
+                              partition['size'])
+
+    def finish(self, image_name):
+        try:
+            self.guest.shutdown()
+        except RuntimeError as e:
+            print "error: failed to close the image:", e
+            sys.exit(-1)
+        self.guest.close()
+        self.guest = None
+
+    def clean_up(self):
+        if self.guest is None:
+            return
+        try:
+            self.guest.umount_all()
+            self.guest.shutdown()
+        except RuntimeError:
+            pass
+        self.guest.close()
+        self.guest = None
+
+# by --backend name, and the order they are tried in by default: root keeps
+#! the loopback devices, otherwise userspace tools go first as they start
+#! no appliance
+BACKENDS = {'loop': LoopBackend, 'userspace': UserspaceBackend,
+            'guestfs': GuestfsBackend}
+AUTO_BACKENDS = ["loop", "userspace", "guestfs"]
+
+#==============================================================================
+# writes the files of a raw partition through the appliance, one after
+#! another, each streamed to its offset in the partition
+@timed_stage("copy_files_to_partition")
+def guestfs_raw_copy(guest, device, partition_data):
+
+    check_raw_files(partition_data)
+    offset = 0
+    for stuff in partition_data['files']:
+        guest.upload_offset(stuff, device, offset)
+        offset = offset + os.stat(stuff).st_size
+
+    return
+
+#==============================================================================
+# copies a file or a tree into the appliance, one upload per file
+def guestfs_upload_tree(guest, local, remote):
+
+    if os.path.isdir(local):
+        guest.mkdir_p(remote)
+        for name in sorted(os.listdir(local)):
+            guestfs_upload_tree(guest, os.path.join(local, name),
+                                remote+"/"+name)
+    else:
+        guest.upload(local, remote)
+
+    return
+
+#==============================================================================
+# fills the file system mounted at / in the appliance. Everything goes in
+#! one tar_in, streamed through a FIFO from tar (or from the decompressor of a
+#! tarball), except on FAT where tar_in could not set the owners: the few
+#! files there are uploaded one by one
+def guestfs_copy(guest, partition_data):
+
+    tarball = get_tarball(partition_data)
+    if tarball == "-":
+        guest.tar_in("/dev/stdin", "/", xattrs=True, acls=True)
+        return
+    if tarball:
+        cmd = ["cat", tarball]
+        for (ext, decompressor) in TAR_DECOMPRESSORS:
+            if re.search(ext, tarball):
+                cmd = decompressor + [tarball]
+    else:
+        sources = expand_sources(partition_data)
+        if not sources:
+            return
+        if re.search("^fat|vfat|fat32$", partition_data['format']):
+            for stuff in sources:
+                guestfs_upload_tree(guest, stuff, "/"+os.path.basename(stuff))
+            return
+        cmd = ["tar", "-c", "-f", "-", "--numeric-owner", "--xattrs",
+               "--xattrs-include=*", "--acls"]
+        for stuff in sources:
+            stuff = os.path.abspath(stuff)
+            cmd = cmd + ["-C", os.path.dirname(stuff), os.path.basename(stuff)]
+
+    fifo_dir = tempfile.mkdtemp(prefix="sdimage_")
+    get_resources().temp_files.append(fifo_dir)
+    fifo = os.path.join(fifo_dir, "tar")
+    os.mkfifo(fifo)
+    try:
+        # the shell blocks opening the FIFO until tar_in opens it
+        p = Popen(["sh", "-c", 'exec "$@" > "$0"', fifo] + cmd,
+                  stderr=subprocess.PIPE)
+        try:
+            guest.tar_in(fifo, "/", xattrs=True, acls=True)
+        except RuntimeError:
+            p.kill()
+            p.wait()
+            raise
+        stderr = p.communicate()[1]
+        if p.returncode != 0:
+            print "error:", cmd[0], "failed:", stderr.rstrip()
+            clean_up()
+            sys.exit(-1)
+    finally:
+        remove_temp(fifo_dir)
+
+    return
+
+#==============================================================================
+# picks the backend: the one named, or the first one that can build every
+#! partition here
+def select_backend(name, partition_entries):
+
+    if name == "auto":
+        names = AUTO_BACKENDS
+    else:
+        names = [name]
+
+    reasons = []
+    for n in names:
+        backend = BACKENDS[n]()
+        why = backend.available()
+        if why is None:
+            for part in sorted(partition_entries.keys()):
+                if not backend.supports(partition_entries[part]):
+                    why = "can't build partition " + str(part) + " (" + \
+                          partition_entries[part]['format'] + ")"
+                    more = backend.why_not(partition_entries[part])
+                    if more:
+                        why = why + ": " + more
+                    break
+        if why is None:
+            print "info: building the partitions with the", n, "backend"
+            return backend
+        reasons.append(n + ": " + why)
+
+    print "error: no backend can build this image"
+    for reason in reasons:
+        print "      ", reason
+    sys.exit(-1)
+
+#==============================================================================
+# reads the MBR of an image
+# returns a dictionary num -> {'start', 'bsize', 'fdisk_type'} (type as an
+#! int), None if there is no partition table
+def read_partition_table(image_name):
+
+    try:
+        f = open(image_name, 'rb')
+        try:
+            mbr = f.read(512)
+        finally:
+            f.close()
+    except IOError:
+        return None
+
+    return parse_mbr(mbr)
+
+#==============================================================================
+# same as read_partition_table(), from the first sector of a disk
+def parse_mbr(mbr):
+
+    if len(mbr) < 512 or mbr[510:512] != "\x55\xaa":
+        return None
+
+    table = {}
+    for i in range(MAX_PARTITIONS):
+        pos = MBR_TABLE_OFFSET + 6 + 16*i
+        (status, chs_start, fdisk_type, chs_end, start, bsize) = \
+            struct.unpack("<B3sB3sII", mbr[pos:pos+16])
+        if fdisk_type != 0 and bsize != 0:
+            table[i+1] = {'start': start, 'bsize': bsize,
+                          'fdisk_type': fdisk_type}
+
+    return table
+
+#==============================================================================
+# the name of the file that records what went into an image
+def get_manifest_name(image_name):
+
+    return image_name+".manifest"
+
+#==============================================================================
+# lists what a FAT partition holds: directories, files with their size and
+#! time, and where each file comes from. Paths are relative to the root of
+#! the partition, the way cp -rt / mcopy -s lay them out
+def get_fat_listing(partition_data):
+
+    dirs = set()
+    files = {}
+    sources = {}
+
+    for stuff in expand_sources(partition_data):
+        name = os.path.basename(stuff.rstrip("/"))
+        if not os.path.isdir(stuff):
+            st = os.stat(stuff)
+            files[name] = [st.st_size, st.st_mtime]
+            sources[name] = stuff
+            continue
+
+        dirs.add(name)
+        for root, dnames, fnames in os.walk(stuff, followlinks=True):
+            rel = os.path.relpath(root, stuff)
+            if rel == ".":
+                base = name
+            else:
+                base = name+"/"+rel
+            for d in dnames:
+                dirs.add(base+"/"+d)
+            for f in fnames:
+                path = os.path.join(root, f)
+                st = os.stat(path)
+                files[base+"/"+f] = [st.st_size, st.st_mtime]
+                sources[base+"/"+f] = path
+
+    return (dirs, files, sources)
+
+#==============================================================================
+# records the key of every partition (and the files of FAT partitions) next
+#! to the image, this is what --update compares against
+def write_image_manifest(image_name, partition_entries, hash_content=False,
+                         keys=None):
+
+    if keys is None:
+        keys = {}
+
+    manifest = {}
+    for part in partition_entries.keys():
+        pentry = partition_entries[part]
+        entry = {}
+        entry['key'] = keys.get(part) or partition_key(pentry, hash_content)
+        if re.search("^fat|vfat|fat32$", pentry['format']):
+            (dirs, files, sources) = get_fat_listing(pentry)
+            entry['fat_dirs'] = sorted(dirs)
+            entry['fat_files'] = files
+        manifest[str(part)] = entry
+
+    try:
+        json.dump(manifest, open(get_manifest_name(image_name), 'w'))
+    except IOError:
+        print "warning: failed to write", get_manifest_name(image_name)
+
+    return
+
+#==============================================================================
+# reads what write_image_manifest() recorded, {} if nothing
+def read_image_manifest(image_name):
+
+    try:
+        return json.load(open(get_manifest_name(image_name)))
+    except (IOError, ValueError):
+        return {}
+
+#==============================================================================
+# rewrites the blocks of a raw partition that differ from its files, the
+#! rest of the partition is zeroed (again, only where needed)
+@timed_stage("update_raw_partition")
+def update_raw_partition(image_name, partition_data):
+
+    check_raw_files(partition_data)
+
+    offset = partition_data['start'] * 512
+    pos = 0
+    changed = 0
+    try:
+        fd = os.open(image_name, os.O_RDWR)
+        try:
+            for stuff in partition_data['files']:
+                f = open(stuff, 'rb')
+                try:
+                    while True:
+                        block = f.read(RAW_BLOCK_SIZE)
+                        if not block:
+                            break
+                        if read_at(fd, offset + pos, len(block)) != block:
+                            write_at(fd, block, offset + pos)
+                            changed = changed + len(block)
+                        pos = pos + len(block)
+                finally:
+                    f.close()
+
+            # whatever was left by a longer payload
+            while pos < partition_data['size']:
+                length = min(RAW_BLOCK_SIZE, partition_data['size'] - pos)
+                if read_at(fd, offset + pos, length) != ZERO_BLOCK[:length]:
+                    write_at(fd, ZERO_BLOCK[:length], offset + pos)
+                    changed = changed + length
+                pos = pos + length
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except (IOError, OSError) as e:
+        print "error:", e, ": failed to update partition", partition_data['num']
+        sys.exit(-1)
+
+    print "info: partition #%d: %d bytes rewritten" % (partition_data['num'],
+                                                     changed)
+
+    return
+
+#==============================================================================
+# brings the files of a FAT partition in line with its inputs, in place,
+#! with mtools: only new, changed and removed files are touched
+@timed_stage("update_fat_partition")
+def update_fat_partition(image_name, partition_data, old_entry):
+
+    img = image_name+"@@"+str(partition_data['start'] * 512)
+    env = dict(os.environ)
+    env['MTOOLS_SKIP_CHECK'] = '1'
+
+    (dirs, files, sources) = get_fat_listing(partition_data)
+    old_dirs = set(old_entry['fat_dirs'])
+    old_files = old_entry['fat_files']
+
+    changed = 0
+    for path in sorted(set(old_files.keys()) - set(files.keys())):
+        run_cmd(["mdel", "-i", img, "::/"+path], "failed to delete "+path,
+                env=env)
+        changed = changed + 1
+    for path in sorted(old_dirs - dirs, reverse=True):
+        run_cmd(["mrd", "-i", img, "::/"+path], "failed to delete "+path,
+                env=env)
+    for path in sorted(dirs - old_dirs):
+        run_cmd(["mmd", "-i", img, "::/"+path], "failed to create "+path,
+                env=env)
+    for path in sorted(files.keys()):
+        if old_files.get(path) != files[path]:
+            run_cmd(["mcopy", "-o", "-Q", "-i", img, sources[path],
+                     "::/"+path], "failed to copy "+path, env=env)
+            changed = changed + 1
+
+    print "info: partition #%d: %d files updated" % (partition_data['num'],
+                                                    changed)
+
+    return
+
+#==============================================================================
+# empties a byte range of the image, so a partition can be rebuilt on clean
+#! ground (mkfs assumes unwritten blocks of a sparse file read as zeros)
+def clear_range(image_name, offset, size):
+
+    p = Popen(["fallocate", "--punch-hole", "--keep-size",
+               "-o", str(offset), "-l", str(size), image_name],
+              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    p.communicate()
+    if p.returncode == 0:
+        return
+
+    fd = os.open(image_name, os.O_RDWR)
+    try:
+        for (pos, length) in get_data_ranges(fd, size, offset):
+            while length > 0:
+                n = min(length, RAW_BLOCK_SIZE)
+                if read_at(fd, pos, n) != ZERO_BLOCK[:n]:
+                    write_at(fd, ZERO_BLOCK[:n], pos)
+                pos = pos + n
+                length = length - n
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+    return
+
+#==============================================================================
+# updates an existing image: the partition table must match the requested
+#! partitions, and only the partitions whose inputs changed are rewritten
+def update_image(image_name, image_size, partition_entries, backend, jobs=1,
+                 cache=None, hash_content=False):
+
+    print "info: updating the image "+image_name
+    if not check_file_exists(image_name):
+        print "error:", image_name, ": no such image"
+        sys.exit(-1)
+    if os.stat(image_name).st_size != image_size:
+        print "error:", image_name, ": image size differs, rebuild it"
+        sys.exit(-1)
+
+    table = read_partition_table(image_name)
+    if table is None or sorted(table.keys()) != sorted(partition_entries.keys()):
+        print "error:", image_name, ": partitions differ, rebuild the image"
+        sys.exit(-1)
+    for part in partition_entries.keys():
+        pentry = partition_entries[part]
+        if table[part]['start'] != pentry['start'] or \
+           table[part]['bsize'] != pentry['bsize'] or \
+           table[part]['fdisk_type'] != int(pentry['fdisk_type'], 16):
+            print "error: partition", part, "differs, rebuild the image"
+            sys.exit(-1)
+
+    manifest = read_image_manifest(image_name)
+    keys = {}
+    to_build = {}
+    for part in sorted(partition_entries.keys()):
+        pentry = partition_entries[part]
+        keys[part] = partition_key(pentry, hash_content)
+        old_entry = manifest.get(str(part), {})
+        if keys[part] is not None and old_entry.get('key') == keys[part]:
+            print "     partition #"+str(part)+": unchanged"
+        elif re.search("raw|none", pentry['format']):
+            update_raw_partition(image_name, pentry)
+        elif re.search("^fat|vfat|fat32$", pentry['format']) and \
+             'fat_files' in old_entry:
+            update_fat_partition(image_name, pentry, old_entry)
+        else:
+            clear_range(image_name, pentry['start'] * 512, pentry['size'])
+            to_build[part] = pentry
+
+    if to_build:
+        print "info: rebuilding partitions..."
+        build_partitions(image_name, to_build, backend, jobs, cache, keys)
+        if cache is not None:
+            cache.report()
+
+    write_image_manifest(image_name, partition_entries, hash_content, keys)
+
+    return
+
+#==============================================================================
+# builds a partition, or takes it from the cache. The key of the partition
+#! is taken from, or recorded in, 'keys'
+def make_partition(partition, image_name, backend, cache, keys):
+
+    with StageTimer("partition", image_name):
+        make_partition_untimed(partition, image_name, backend, cache, keys)
+
+    return
+
+#==============================================================================
+# see make_partition()
+def make_partition_untimed(partition, image_name, backend, cache, keys):
+
+    offset_bytes = partition['start'] * 512
+
+    key = keys.get(partition['num'])
+    if cache is not None:
+        with StageTimer("cache lookup"):
+            if key is None:
+                key = cache.key(partition)
+                keys[partition['num']] = key
+            blob = cache.lookup(key)
+        if blob:
+            print "info: partition #"+str(partition['num'])+": cached"
+            splice_partition_file(blob, image_name, offset_bytes)
+            return
+
+    backend.build(partition, image_name, cache, key)
+
+    return
+
+#==============================================================================
+# partition worker: builds partitions taken from the queue until it is empty
+#! or some partition failed
+def partition_worker(queue, partition_entries, image_name, backend, cache,
+                     keys, failed):
+
+    while not abort_build.is_set():
+        try:
+            part = queue.get_nowait()
+        except Queue.Empty:
+            break
+
+        print "     partition #"+str(part)+"..."
+        thread_data.partition = part
+        try:
+            make_partition(partition_entries[part], image_name, backend,
+                           cache, keys)
+        except SystemExit:
+            # the error has been reported already
+            failed.append(part)
+            abort_build.set()
+        except Exception:
+            traceback.print_exc()
+            clean_up()
+            failed.append(part)
+            abort_build.set()
+
+    return
+
+#==============================================================================
+# builds the partitions, 'jobs' of them at a time. Partitions never overlap
+#! so each one can be formatted and populated independently
+#! returns the keys of the partitions, those already known can be passed in
+def build_partitions(image_name, partition_entries, backend, jobs,
+                     cache=None, keys=None):
+
+    if keys is None:
+        keys = {}
+
+    # biggest first, so that the longest job does not start last
+    parts = sorted(partition_entries.keys(),
+                   key=lambda part: partition_entries[part]['size'],
+                   reverse=True)
+
+    queue = Queue.Queue()
+    for part in parts:
+        queue.put(part)
+    if backend.max_jobs is not None:
+        jobs = min(jobs, backend.max_jobs)
+
+    backend.start(image_name)
+
+    failed = []
+    workers = []
+    for i in range(max(1, min(jobs, len(parts)))):
+        t = threading.Thread(target=partition_worker,
+                             args=(queue, partition_entries, image_name,
+                                   backend, cache, keys, failed))
+        t.daemon = True
+        t.start()
+        workers.append(t)
+
+    try:
+        for t in workers:
+            # join() with a timeout, so that ctrl-c still gets through
+            while t.is_alive():
+                t.join(0.5)
+    except KeyboardInterrupt:
+        print "error: interrupted, waiting for the workers to stop"
+        abort_build.set()
+        for t in workers:
+            t.join()
+        failed.append(None)
+
+    if failed:
+        clean_up_all()
+        backend.clean_up()
+        print "error: failed to build the partitions"
+        sys.exit(-1)
+    backend.finish(image_name)
+
+    return keys
+
+#==============================================================================
+def create_image(image_name, image_size, partition_entries, force_erase_image,
+                 backend, jobs=1, cache=None, hash_content=False):
 
     print "info: creating the image "+image_name
     # first we need an empty image
@@ -657,15 +3074,449 @@ def create_image(image_name, image_size, partition_entries, force_erase_image):
 
     # second, we'll create the partition table
     print "info: creating the partition table"
-    loopback = create_loopback(image_name, image_size)
-    create_partition_table(loopback, partition_entries)
-    delete_loopback(loopback)
+    create_partition_table(image_name, partition_entries)
 
     # now we iterate over the partitions
     print "info: processing partitions..."
-    for part in partition_entries.keys():
-        print "     partition #"+str(part)+"..."
-        do_partition(partition_entries[part], image_name)
+    keys = build_partitions(image_name, partition_entries, backend, jobs,
+                            cache)
+    if cache is not None:
+        cache.report()
+
+    write_image_manifest(image_name, partition_entries, hash_content, keys)
+
+    return
+
+#==============================================================================
+# progress and throughput meter, printed on stderr
+class Progress(object):
+
+    def __init__(self, what, total):
+        self.what = what
+        self.total = total
+        self.done = 0
+        self.start = time.time()
+        self.last = 0
+
+    def update(self, nbytes):
+        self.done = self.done + nbytes
+        now = time.time()
+        if now - self.last >= 0.5:
+            self.last = now
+            self.show(now)
+
+    def show(self, now):
+        elapsed = max(now - self.start, 0.001)
+        sys.stderr.write("\r%s: %3d%% %8.1f MB/s" % (self.what,
+                         100 * self.done / max(self.total, 1),
+                         self.done / elapsed / (1024*1024)))
+        sys.stderr.flush()
+
+    def finish(self):
+        self.show(time.time())
+        sys.stderr.write("\n")
+        report_throughput(self.what, self.done, time.time() - self.start)
+
+#==============================================================================
+# true when the device (or one of its partitions) is mounted
+def is_device_mounted(device):
+
+    device = os.path.realpath(device)
+    try:
+        for line in open("/proc/mounts"):
+            mounted = os.path.realpath(line.split()[0])
+            if mounted == device or re.match(re.escape(device)+"p?[0-9]+$",
+                                             mounted):
+                return True
+    except IOError:
+        pass
+
+    return False
+
+#==============================================================================
+# lists the ranges between 0 and 'size' that are not covered by 'ranges'
+def get_hole_ranges(ranges, size):
+
+    holes = []
+    pos = 0
+    for (start, length) in sorted(ranges):
+        if start > pos:
+            holes.append((pos, start - pos))
+        pos = max(pos, start + length)
+    if pos < size:
+        holes.append((pos, size - pos))
+
+    return holes
+
+#==============================================================================
+# true when the discarded blocks of a device read back as zeros
+def discard_zeroes_data(device):
+
+    name = os.path.basename(os.path.realpath(device))
+    # partitions have no queue of their own, it is the disk's
+    for queue in ["/sys/class/block/"+name+"/queue",
+                  "/sys/class/block/"+name+"/../queue"]:
+        try:
+            return open(queue+"/discard_zeroes_data").read().strip() == "1"
+        except IOError:
+            pass
+
+    return False
+
+#==============================================================================
+# makes the holes of the image read back as zeros on the device. mke2fs
+#! leaves the inode tables unwritten in a sparse image, so whatever a reused
+#! card held there would show through the file system. Uses BLKDISCARD when
+#! it zeroes, BLKZEROOUT, or writes zeros when the device supports neither
+def zero_device_ranges(fd, device, ranges):
+
+    if discard_zeroes_data(device):
+        requests = [BLKDISCARD, BLKZEROOUT]
+    else:
+        requests = [BLKZEROOUT]
+    buf = mmap.mmap(-1, RAW_BLOCK_SIZE)
+    try:
+        for (pos, length) in ranges:
+            # the data is written afterwards, widening the range is harmless
+            end = (pos + length + DIRECT_IO_ALIGN - 1) & ~(DIRECT_IO_ALIGN - 1)
+            pos = pos & ~(DIRECT_IO_ALIGN - 1)
+            length = end - pos
+            for request in requests:
+                try:
+                    fcntl.ioctl(fd, request, struct.pack("=QQ", pos, length))
+                    break
+                except IOError:
+                    pass
+            else:
+                os.lseek(fd, pos, os.SEEK_SET)
+                while length > 0:
+                    n = os.write(fd, buffer(buf, 0, min(length, RAW_BLOCK_SIZE)))
+                    count_bytes_written(n)
+                    length = length - n
+    finally:
+        buf.close()
+
+    return
+
+#==============================================================================
+# writes the data ranges of the image to a block device, with O_DIRECT and
+#! page aligned buffers. Holes are cleared on the device first, then only the
+#! data is written, like bmaptool does
+def write_image_to_device(image_name, device, ranges=None):
+
+    if is_device_mounted(device):
+        print "error:", device, ": is mounted"
+        sys.exit(-1)
+
+    size = os.stat(image_name).st_size
+    buf = mmap.mmap(-1, RAW_BLOCK_SIZE)
+    f = open(image_name, 'rb')
+    try:
+        fd = os.open(device, os.O_WRONLY | os.O_DIRECT)
+    except OSError as e:
+        print "error:", device, ":", e
+        sys.exit(-1)
+
+    try:
+        if os.lseek(fd, 0, os.SEEK_END) < size:
+            print "error:", device, ": too small for", image_name
+            sys.exit(-1)
+        if ranges is None:
+            ranges = get_data_ranges(f.fileno(), size)
+        zero_device_ranges(fd, device, get_hole_ranges(ranges, size))
+        progress = Progress("write "+device, sum([l for (p, l) in ranges]))
+        for (pos, length) in ranges:
+            while length > 0:
+                f.seek(pos)
+                n = f.readinto(buf)
+                n = min(n, length)
+                # O_DIRECT: the tail of the image is padded to a full sector
+                aligned = (n + DIRECT_IO_ALIGN - 1) & ~(DIRECT_IO_ALIGN - 1)
+                if aligned != n:
+                    buf[n:aligned] = ZERO_BLOCK[:aligned - n]
+                os.lseek(fd, pos, os.SEEK_SET)
+                written = os.write(fd, buffer(buf, 0, aligned))
+                if written != aligned:
+                    raise OSError(errno.EIO, "short write")
+                count_bytes_written(written)
+                pos = pos + n
+                length = length - n
+                progress.update(n)
+        os.fsync(fd)
+        progress.finish()
+    except (IOError, OSError) as e:
+        print "error:", e, ": failed to write", device
+        sys.exit(-1)
+    finally:
+        os.close(fd)
+        f.close()
+        buf.close()
+
+    return
+
+#==============================================================================
+# streams the image through a multi-threaded compressor. Holes are not read
+#! from disk, zeros are fed instead
+def write_image_compressed(image_name, output, compressor):
+
+    size = os.stat(image_name).st_size
+    try:
+        out = open(output, 'wb')
+        p = Popen(compressor, stdin=subprocess.PIPE, stdout=out)
+    except (IOError, OSError) as e:
+        print "error:", output, ":", e
+        sys.exit(-1)
+
+    progress = Progress("compress "+output, size)
+    try:
+        fd = os.open(image_name, os.O_RDONLY)
+        try:
+            pos = 0
+            for (start, length) in get_data_ranges(fd, size) + [(size, 0)]:
+                # the hole before this range
+                while pos < start:
+                    n = min(RAW_BLOCK_SIZE, start - pos)
+                    p.stdin.write(ZERO_BLOCK[:n])
+                    pos = pos + n
+                    progress.update(n)
+                while length > 0:
+                    block = read_at(fd, pos, min(RAW_BLOCK_SIZE, length))
+                    p.stdin.write(block)
+                    pos = pos + len(block)
+                    length = length - len(block)
+                    progress.update(len(block))
+        finally:
+            os.close(fd)
+        p.stdin.close()
+    except (IOError, OSError) as e:
+        print "error:", e, ": failed to compress the image"
+        p.kill()
+        sys.exit(-1)
+
+    if p.wait() != 0:
+        print "error:", compressor[0], ": failed"
+        sys.exit(-1)
+    out.close()
+    progress.finish()
+
+    return
+
+#==============================================================================
+# copies the image to another file, keeping it sparse
+def write_image_sparse(image_name, output):
+
+    size = os.stat(image_name).st_size
+    try:
+        src = os.open(image_name, os.O_RDONLY)
+        dst = os.open(output, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+        try:
+            os.ftruncate(dst, size)
+            ranges = get_data_ranges(src, size)
+            progress = Progress("copy "+output, sum([l for (p, l) in ranges]))
+            for (pos, length) in ranges:
+                if not reflink_range(src, pos, length, dst, pos):
+                    copy_range(src, pos, length, dst, pos)
+                progress.update(length)
+            os.fsync(dst)
+        finally:
+            os.close(src)
+            os.close(dst)
+    except (IOError, OSError) as e:
+        print "error:", e, ": failed to write", output
+        sys.exit(-1)
+    progress.finish()
+
+    return
+
+#==============================================================================
+# the name of the block map of an image
+def get_bmap_name(image_name):
+
+    return image_name+".bmap"
+
+#==============================================================================
+# sha256 of a byte range of an open file
+def hash_range(fd, pos, length):
+
+    h = hashlib.sha256()
+    while length > 0:
+        block = read_at(fd, pos, min(RAW_BLOCK_SIZE, length))
+        if not block:
+            break
+        h.update(block)
+        pos = pos + len(block)
+        length = length - len(block)
+
+    return h.hexdigest()
+
+#==============================================================================
+# lists the mapped block ranges of an image as (first, last) block numbers,
+#! adjacent ranges merged
+def get_mapped_blocks(fd, size):
+
+    blocks = []
+    for (pos, length) in get_data_ranges(fd, size):
+        first = pos / BMAP_BLOCK_SIZE
+        last = (pos + length - 1) / BMAP_BLOCK_SIZE
+        if blocks and blocks[-1][1] >= first - 1:
+            blocks[-1] = (blocks[-1][0], max(blocks[-1][1], last))
+        else:
+            blocks.append((first, last))
+
+    return blocks
+
+#==============================================================================
+# writes the block map of an image: the ranges that hold data, each with its
+#! sha256. The file can also be used by bmaptool
+@timed_stage("write_bmap")
+def write_bmap(image_name):
+
+    size = os.stat(image_name).st_size
+    lines = []
+    mapped = 0
+    fd = os.open(image_name, os.O_RDONLY)
+    try:
+        for (first, last) in get_mapped_blocks(fd, size):
+            pos = first * BMAP_BLOCK_SIZE
+            length = min((last + 1) * BMAP_BLOCK_SIZE, size) - pos
+            if first == last:
+                blocks = str(first)
+            else:
+                blocks = "%d-%d" % (first, last)
+            lines.append('        <Range chksum="%s"> %s </Range>\n' %
+                         (hash_range(fd, pos, length), blocks))
+            mapped = mapped + last - first + 1
+    finally:
+        os.close(fd)
+
+    bmap = ('<?xml version="1.0" ?>\n'
+            '<bmap version="2.0">\n'
+            '    <ImageSize> %d </ImageSize>\n'
+            '    <BlockSize> %d </BlockSize>\n'
+            '    <BlocksCount> %d </BlocksCount>\n'
+            '    <MappedBlocksCount> %d </MappedBlocksCount>\n'
+            '    <ChecksumType> sha256 </ChecksumType>\n'
+            '    <BmapFileChecksum> %%s </BmapFileChecksum>\n'
+            '    <BlockMap>\n'
+            '%s'
+            '    </BlockMap>\n'
+            '</bmap>\n') % (size, BMAP_BLOCK_SIZE,
+                            (size + BMAP_BLOCK_SIZE - 1) / BMAP_BLOCK_SIZE,
+                            mapped, ''.join(lines))
+
+    # the checksum of the file is computed with the checksum field zeroed
+    checksum = hashlib.sha256(bmap % BMAP_ZERO_CHECKSUM).hexdigest()
+    try:
+        f = open(get_bmap_name(image_name), 'w')
+        f.write(bmap % checksum)
+        f.close()
+    except IOError as e:
+        print "error:", e, ": failed to write the block map"
+        sys.exit(-1)
+
+    print "info: block map: %d of %d MiB mapped" % \
+          (mapped * BMAP_BLOCK_SIZE / (1024*1024), size / (1024*1024))
+
+    return
+
+#==============================================================================
+# reads a block map written by write_bmap() (or bmaptool)
+# returns the image size and a list of (pos, length, sha256) byte ranges
+def read_bmap(bmap_name):
+
+    try:
+        text = open(bmap_name).read()
+        root = xml.etree.ElementTree.fromstring(text)
+    except (IOError, xml.etree.ElementTree.ParseError) as e:
+        print "error:", bmap_name, ":", e
+        sys.exit(-1)
+
+    if root.findtext("ChecksumType").strip() != "sha256":
+        print "error:", bmap_name, ": only sha256 block maps are supported"
+        sys.exit(-1)
+
+    checksum = root.findtext("BmapFileChecksum").strip()
+    if hashlib.sha256(text.replace(checksum, BMAP_ZERO_CHECKSUM, 1)).hexdigest() \
+       != checksum:
+        print "error:", bmap_name, ": corrupted block map"
+        sys.exit(-1)
+
+    size = int(root.findtext("ImageSize"))
+    block_size = int(root.findtext("BlockSize"))
+    ranges = []
+    for r in root.find("BlockMap").findall("Range"):
+        blocks = r.text.strip().split("-")
+        first = int(blocks[0])
+        last = int(blocks[-1])
+        pos = first * block_size
+        length = min((last + 1) * block_size, size) - pos
+        ranges.append((pos, length, r.get("chksum")))
+
+    return (size, ranges)
+
+#==============================================================================
+# flashes an image to a device following its block map: the unmapped ranges
+#! are cleared and only the mapped ones are written, then they are read back
+#! from the device and checked. The first block of every unmapped range is
+#! read back too, it must be zeros for the file systems to be consistent
+def flash_image(image_name, device, bmap_name=None):
+
+    if bmap_name is None:
+        bmap_name = get_bmap_name(image_name)
+    (size, ranges) = read_bmap(bmap_name)
+    if os.stat(image_name).st_size != size:
+        print "error:", bmap_name, ": does not match", image_name
+        sys.exit(-1)
+
+    mapped = [(pos, length) for (pos, length, sha) in ranges]
+    write_image_to_device(image_name, device, mapped)
+
+    # make sure what we read back comes from the card, not from the cache
+    progress = Progress("verify "+device, sum([l for (p, l, s) in ranges]))
+    try:
+        fd = os.open(device, os.O_RDONLY)
+        try:
+            try:
+                fcntl.ioctl(fd, BLKFLSBUF, 0)
+            except IOError:
+                print "warning:", device, ": could not drop cached data"
+            for (pos, length, sha) in ranges:
+                if hash_range(fd, pos, length) != sha:
+                    print
+                    print "error:", device, ": checksum mismatch at offset", pos
+                    sys.exit(-1)
+                progress.update(length)
+            for (pos, length) in get_hole_ranges(mapped, size):
+                length = min(length, BMAP_BLOCK_SIZE)
+                if read_at(fd, pos, length) != ZERO_BLOCK[:length]:
+                    print
+                    print "error:", device, ": not cleared at offset", pos
+                    sys.exit(-1)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        print "error:", device, ":", e
+        sys.exit(-1)
+    progress.finish()
+
+    return
+
+#==============================================================================
+# writes the image to its final target: a block device, a compressed stream
+#! (.xz, .zst) or a sparse file
+@timed_stage("write_output")
+def write_output(image_name, output):
+
+    if os.path.exists(output) and stat.S_ISBLK(os.stat(output).st_mode):
+        write_image_to_device(image_name, output)
+        return
+
+    for ext in COMPRESSORS.keys():
+        if output.endswith(ext):
+            write_image_compressed(image_name, output, COMPRESSORS[ext])
+            return
+
+    write_image_sparse(image_name, output)
 
     return
 
@@ -681,36 +3532,145 @@ def create_image(image_name, image_size, partition_entries, force_erase_image):
 #
 part_entries = []
 
-# arguments
-parser = argparse.ArgumentParser(description='Creates an SD card image for Altera\'s SoCFPGA SoC\'s',
-                                 epilog = textwrap.dedent('''\
-Usage: PROG [-h] -P <partition info> [-P ...]
--P
-'''
-))
-parser.add_argument('-P', dest='part_args', action='append',
-                    help='''specifies a partition. May be used multiple times.
-                            file[,file,...],num=<part_num>,format=<vfat|fat32|ext[2-4]|xfs|raw>,
-                            size=<num[K|M|G]>[,type=ID]''')
-parser.add_argument('-s', dest='size', action='store',
-                    default='8G', help='specifies the size of the image. Units K|M|G can be used.')
-parser.add_argument('-n', dest='image_name', action='store',
-                    default='somename.img', help='specifies the name of the image.')
-parser.add_argument('-f', dest='force_erase_image', action='store_true',
-                    default=False, help='deletes the image file if exists')
-args = parser.parse_args()
-
-# Only root can do this
-if not is_user_root():
-    print "error: only root can do this..."
-    sys.exit(-1)
+if __name__ == "__main__":
+    # arguments
+    parser = argparse.ArgumentParser(description='Creates an SD card image for Altera\'s SoCFPGA SoC\'s',
+                                     epilog = textwrap.dedent('''\
+    Usage: PROG [-h] -P <partition info> [-P ...]
+    -P
+    '''
+    ))
+    parser.add_argument('-P', dest='part_args', action='append',
+                        help='''specifies a partition. May be used multiple times.
+                                file[,file,...],num=<part_num>,format=<vfat|fat32|ext[2-4]|xfs|raw>,
+                                size=<num[K|M|G]|fill|auto[+slack]>[,type=ID]. An ext partition can
+                                also be populated from a single tarball, or from a
+                                tar stream on stdin with "-" (-P-,num=...)''')
+    parser.add_argument('--layout', dest='layout', action='store',
+                        default=None, help='''reads the image size, the alignment and
+                                the partitions from this JSON file instead of -s,
+                                --align and -P''')
+    parser.add_argument('-s', dest='size', action='store',
+                        default=None, help='''specifies the size of the image (default:
+                                8G, or up to the last partition when some are
+                                sized auto). Units K|M|G can be used, and + - * /''')
+    parser.add_argument('--align', dest='align', action='store',
+                        default=None, help='''partitions start on multiples of this
+                                size (default: 4M, the erase block of most SD
+                                cards)''')
+    parser.add_argument('-n', dest='image_name', action='store',
+                        default='somename.img', help='specifies the name of the image.')
+    parser.add_argument('-f', dest='force_erase_image', action='store_true',
+                        default=False, help='deletes the image file if exists')
+    parser.add_argument('--backend', dest='backend', action='store',
+                        choices=['auto'] + sorted(BACKENDS.keys()), default='auto',
+                        help='''how the partitions are built. loop: loopback
+                                devices and mounts, needs root. userspace: each
+                                partition in its own file (mke2fs -d, mkfs.vfat +
+                                mcopy) spliced into the image. guestfs: a libguestfs
+                                appliance, any format, no root. auto (default):
+                                loop for root, otherwise the first of userspace and
+                                guestfs that can build every partition''')
+    parser.add_argument('--userspace', dest='backend', action='store_const',
+                        const='userspace', help='same as --backend userspace')
+    parser.add_argument('--guestfs-trace', dest='guestfs_trace',
+                        action='store_true', default=False,
+                        help='traces the calls to the libguestfs appliance')
+    parser.add_argument('-j', dest='jobs', action='store', type=int,
+                        default=1, help='number of partitions to build in parallel')
+    parser.add_argument('--cache-dir', dest='cache_dir', action='store',
+                        default=None, help='''keeps built partitions in this directory
+                                and reuses them when their spec and inputs are
+                                unchanged''')
+    parser.add_argument('--cache-size', dest='cache_size', action='store',
+                        default='16G', help='maximum size of the partition cache. Units K|M|G can be used.')
+    parser.add_argument('--cache-hash-content', dest='cache_hash_content',
+                        action='store_true', default=False,
+                        help='''hash the content of the input files, not only their
+                                names, sizes and times''')
+    parser.add_argument('--update', dest='update', action='store_true',
+                        default=False, help='''updates an existing image in place:
+                                only the partitions whose inputs changed are
+                                rewritten''')
+    parser.add_argument('-o', dest='output', action='store',
+                        default=None, help='''also writes the image to this target once
+                                built: a block device (/dev/sdX), a compressed
+                                stream (.img.xz, .img.zst) or a sparse file''')
+    parser.add_argument('--no-bmap', dest='bmap', action='store_false',
+                        default=True, help='does not write the block map (<image>.bmap)')
+    parser.add_argument('--flash', dest='flash', action='store',
+                        default=None, help='''flashes the image (-n) to this device
+                                following its block map, and verifies it. The
+                                unmapped blocks are zeroed. No image is built''')
+    parser.add_argument('--bmap', dest='bmap_name', action='store',
+                        default=None, help='block map to use with --flash (default: <image>.bmap)')
+    parser.add_argument('--report', dest='report', action='store',
+                        default=None, help='''writes the timing of every stage (wall and
+                                cpu time, bytes written, processes) to this
+                                JSON file''')
+    parser.add_argument('-t', dest='copy_threads', action='store', type=int,
+                        default=COPY_THREADS, help='number of threads copying files into a partition')
+    args = parser.parse_args()
+    build_start = time.time()
+    copy_threads = max(1, args.copy_threads)
+    guestfs_trace = args.guestfs_trace
+
+    if args.flash:
+        flash_image(args.image_name, args.flash, args.bmap_name)
+        print "info: image", args.image_name, "flashed to", args.flash
+        sys.exit(0)
+
+    # A few checks, all of them before anything is built
+    order = None
+    align = None
+    image_size = None
+    if args.layout:
+        if args.part_args:
+            print "error: partitions come from either -P or --layout"
+            sys.exit(-1)
+        (part_entries, image_size, align, order) = read_layout(args.layout)
+    elif args.part_args:
+        part_entries = parse_all_parts_args(args.part_args)
+        # auto sized partitions make the image as small as they are
+        if not [p for p in part_entries.values() if 'auto' in p]:
+            image_size = convert_size_from_unit('8G')
+    else:
+        print "error: no partitions, give -P or --layout"
+        sys.exit(-1)
+    if args.size:
+        image_size = convert_size_from_unit(args.size)
+    if args.align:
+        align = convert_size_from_unit(args.align)
+    (part_entries, image_size) = check_and_update_part_entries(part_entries,
+                                       image_size, align or DEFAULT_ALIGN, order)
+    check_part_inputs(part_entries)
+    # only root can use loopback devices: the backend depends on who we are
+    backend = select_backend(args.backend, part_entries)
+
+    cache = None
+    if args.cache_dir:
+        cache = PartitionCache(args.cache_dir, convert_size_from_unit(args.cache_size),
+                               args.cache_hash_content)
+
+    # we now have what we need
+    if args.update:
+        update_image(args.image_name, image_size, part_entries, backend,
+                     args.jobs, cache, args.cache_hash_content)
+        print "info: image updated, file name is ", args.image_name
+    else:
+        create_image(args.image_name, image_size, part_entries,
+                     args.force_erase_image, backend, args.jobs, cache,
+                     args.cache_hash_content)
+        print "info: image created, file name is ", args.image_name
+
+    if args.bmap:
+        write_bmap(args.image_name)
 
-# A few checks
-part_entries = parse_all_parts_args(args.part_args)
-image_size = convert_size_from_unit(args.size)
-part_entries = check_and_update_part_entries(part_entries, image_size)
+    if args.output:
+        write_output(args.image_name, args.output)
+        print "info: image written to", args.output
 
-# we now have what we need
-create_image(args.image_name, image_size, part_entries, args.force_erase_image)
-print "info: image created, file name is ", args.image_name
+    report_stages()
+    if args.report:
+        write_report(args.report, args.image_name, time.time() - build_start)
 
@@ -0,0 +1,116 @@
+#!/bin/sh
+#-
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# Copyright (c) 2019 A. Theodore Markettos
+# All rights reserved.
+#
+# This software was developed by SRI International and the University of
+# Cambridge Computer Laboratory (Department of Computer Science and
+# Technology) under DARPA contract HR0011-18-C-0016 ("ECATS"), as part of the
+# DARPA SSITH research programme.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+
+# Installs packages into a root file system of another architecture in two
+# phases, so that as little as possible runs under emulation:
+#  1. natively: the host's apt picks the .debs to install from a local
+#     repository (see make_local_repo.sh), and the host's dpkg unpacks them
+#     into the root file system (only preinst scripts run in the chroot)
+#  2. emulated: maintainer scripts and dpkg --configure, in a single chroot
+#     session
+#
+#   native_install.sh <root file system> <repository directory> <packages>
+
+ROOT=$1
+REPO=$2
+shift
+shift
+PACKAGES="$@"
+ARCH=armhf
+
+if [ -z "$ROOT" ] || [ -z "$REPO" ] ; then
+	echo "Usage: $0 <root file system> <repository directory> <packages>"
+	exit 1
+fi
+
+REPO=$(readlink -f "$REPO")
+WORK=$(mktemp -d)
+QEMU=""
+POLICY=""
+
+# undoes what was set up in the root file system, whatever the exit path
+clean_up() {
+	[ -z "$POLICY" ] || sudo rm -f $POLICY
+	[ -z "$QEMU" ] || sudo rm -f $QEMU
+	rm -rf $WORK
+}
+trap clean_up EXIT
+trap "exit 1" INT TERM
+
+mkdir -p $WORK/lists/partial $WORK/cache/archives/partial $WORK/sources.list.d
+echo "deb [trusted=yes] file:$REPO ./" > $WORK/sources.list
+APT_OPTS="-o APT::Architecture=$ARCH -o APT::Architectures=$ARCH \
+	-o Dir::Etc::SourceList=$WORK/sources.list \
+	-o Dir::Etc::SourceParts=$WORK/sources.list.d \
+	-o Dir::State::Status=$ROOT/var/lib/dpkg/status \
+	-o Dir::State::Lists=$WORK/lists \
+	-o Dir::Cache=$WORK/cache \
+	-o Debug::NoLocking=1 -o APT::Sandbox::User=root"
+
+# phase 1, native: what to install, in apt's order, and unpacking it
+apt-get $APT_OPTS -qq update || exit 1
+apt-get $APT_OPTS -qq --print-uris install $PACKAGES > $WORK/uris || exit 1
+sed -n "s%^'file:\([^']*\)' .*%\1%p" $WORK/uris > $WORK/debs
+if [ ! -s $WORK/debs ] ; then
+	echo "Nothing to install"
+	exit 0
+fi
+
+# the preinst scripts run in a chroot of the root file system, the emulator
+# must be in there already, and no service may be started from now on
+if [ ! -e $ROOT/usr/bin/qemu-arm-static ] ; then
+	QEMU=$ROOT/usr/bin/qemu-arm-static
+	sudo cp /usr/bin/qemu-arm-static $QEMU || exit 1
+fi
+if [ ! -e $ROOT/usr/sbin/policy-rc.d ] ; then
+	POLICY=$ROOT/usr/sbin/policy-rc.d
+	printf '#!/bin/sh\nexit 101\n' | sudo tee $POLICY > /dev/null
+	sudo chmod 755 $POLICY
+fi
+
+echo "Unpacking $(wc -l < $WORK/debs) packages..."
+xargs sudo dpkg --root=$ROOT --force-architecture --force-depends \
+	--unpack < $WORK/debs || exit 1
+
+# the dependencies pulled in are marked as such, as apt would have done
+for deb in $(cat $WORK/debs) ; do
+	dpkg-deb -f $deb Package
+done | grep -v -x -F "$(echo $PACKAGES | tr ' ' '\n')" > $WORK/auto
+
+# phase 2, emulated: configuration, still with no service started
+CONFIGURE="dpkg --configure -a"
+if [ -s $WORK/auto ] ; then
+	CONFIGURE="$CONFIGURE && apt-mark auto $(tr '\n' ' ' < $WORK/auto) > /dev/null"
+fi
+sudo chroot $ROOT /usr/bin/qemu-arm-static /bin/sh -c "$CONFIGURE"
@@ -35,21 +35,159 @@
 INSTALL=$1
 shift
 PACKAGES="$@"
+# installed packages are kept as layers: the files apt added or changed,
+# and a list of what it deleted, keyed on the state of the root file system
+# before the install and the package list. Downloaded .debs are kept too
+PACKAGE_CACHE=${PACKAGE_CACHE:-$HOME/.cache/socfpga-packages}
+# with LOCAL_REPO set, packages are installed from that directory only,
+# without any network in the chroot. If it holds no repository yet, one is
+# built with make_local_repo.sh (remove its Packages.gz to rebuild it)
+LOCAL_REPO=${LOCAL_REPO:-}
+# packages are unpacked natively by the host's dpkg and only configured
+# under emulation (see native_install.sh), from LOCAL_REPO or else from a
+# repository of our own refreshed at every install. NATIVE_UNPACK=0 runs
+# all of apt-get in the chroot instead
+NATIVE_UNPACK=${NATIVE_UNPACK:-1}
+SCRIPT_NAME=$(readlink -f "$0")
+SCRIPT_PATH=$(dirname "$SCRIPT_NAME")
 
-# make sure we have a qemu binary
-sudo apt-get install -y qemu-user-static qemu-user-binfmt
+mkdir -p $PACKAGE_CACHE/layers $PACKAGE_CACHE/archives/partial
 
-# put it inside the chroot
-sudo cp /usr/bin/qemu-arm-static $INSTALL/usr/bin/qemu-arm-static
+# the key: installed packages, apt sources, sorted package list, how they
+# are installed (this script, the ones it runs and their settings)
+SORTED_PACKAGES=$(echo $PACKAGES | tr ' ' '\n' | sort -u | tr '\n' ' ')
+KEY=$( (sudo cat $INSTALL/var/lib/dpkg/status ; \
+	cat $INSTALL/etc/apt/sources.list $INSTALL/etc/apt/sources.list.d/* 2>/dev/null ; \
+	echo "$SORTED_PACKAGES" ; cat "$SCRIPT_NAME" ; \
+	cat $SCRIPT_PATH/native_install.sh $SCRIPT_PATH/make_local_repo.sh ; \
+	echo "NATIVE_UNPACK=$NATIVE_UNPACK LOCAL_REPO=$LOCAL_REPO") | \
+	sha256sum | cut -d' ' -f1)
+LAYER=$PACKAGE_CACHE/layers/$KEY
 
-# ensure DNS is functional
-sudo mkdir -p $INSTALL/run/resolvconf
-echo "nameserver 8.8.8.8" | sudo tee $INSTALL/run/resolvconf/resolv.conf
+# applies a layer to the root file system: deletions first (a path ending
+# in / is a directory whose previous content was dropped), then the files
+apply_layer() {
+	while read -r path ; do
+		case "$path" in
+		*/)
+			sudo find "$INSTALL/$path" -mindepth 1 -maxdepth 1 -exec rm -rf {} +
+			;;
+		*)
+			sudo rm -rf "$INSTALL/$path"
+			;;
+		esac
+	done < $LAYER.deleted
+	sudo tar -x -p --numeric-owner --xattrs --xattrs-include='*' \
+		-f $LAYER.tar -C $INSTALL
+}
 
-sudo chroot $INSTALL /usr/bin/qemu-arm-static /usr/bin/apt-get -y update
-# apt-get upgrade doesn't work so well via qemu emulation
-#sudo chroot $INSTALL /usr/bin/qemu-arm-static /usr/bin/apt-get -y upgrade
-sudo chroot $INSTALL /usr/bin/qemu-arm-static /usr/bin/apt-get -y install $PACKAGES
+# the original install: all of apt-get in the chroot, under emulation
+chroot_install_packages() {
+	# put it inside the chroot
+	sudo cp /usr/bin/qemu-arm-static $ROOT/usr/bin/qemu-arm-static
 
-sudo rm $INSTALL/usr/bin/qemu-arm-static
-sudo rm $INSTALL/run/resolvconf/resolv.conf
+	APT_OPTS=""
+	if [ -n "$REPO" ] ; then
+		# the repository as the only source, its lists kept apart
+		sudo mkdir -p $ROOT/var/local-repo $ROOT/tmp/local-repo/lists/partial \
+			$ROOT/tmp/local-repo/sources.list.d
+		sudo mount --bind $REPO $ROOT/var/local-repo
+		echo "deb [trusted=yes] file:/var/local-repo ./" | \
+			sudo tee $ROOT/tmp/local-repo/sources.list
+		APT_OPTS="-o Dir::Etc::SourceList=/tmp/local-repo/sources.list \
+			-o Dir::Etc::SourceParts=/tmp/local-repo/sources.list.d \
+			-o Dir::State::Lists=/tmp/local-repo/lists"
+	fi
+
+	# ensure DNS is functional
+	sudo mkdir -p $ROOT/run/resolvconf
+	echo "nameserver 8.8.8.8" | sudo tee $ROOT/run/resolvconf/resolv.conf
+
+	# .debs downloaded by previous builds
+	sudo mount --bind $PACKAGE_CACHE/archives $ROOT/var/cache/apt/archives
+
+	sudo chroot $ROOT /usr/bin/qemu-arm-static /usr/bin/apt-get $APT_OPTS -y update
+	# apt-get upgrade doesn't work so well via qemu emulation
+	#sudo chroot $ROOT /usr/bin/qemu-arm-static /usr/bin/apt-get -y upgrade
+	sudo chroot $ROOT /usr/bin/qemu-arm-static /usr/bin/apt-get $APT_OPTS -y install $PACKAGES
+	STATUS=$?
+
+	sudo umount $ROOT/var/cache/apt/archives
+	if [ -n "$REPO" ] ; then
+		sudo umount $ROOT/var/local-repo
+		sudo rmdir $ROOT/var/local-repo
+		sudo rm -rf $ROOT/tmp/local-repo
+	fi
+	sudo rm $ROOT/usr/bin/qemu-arm-static
+	sudo rm $ROOT/run/resolvconf/resolv.conf
+}
+
+# installs the packages: in an overlay on top of the root file system,
+# whose upper directory becomes the layer, or straight in the root file
+# system if overlays are not available
+install_packages() {
+	REPO=$LOCAL_REPO
+	if [ "$NATIVE_UNPACK" = "1" ] && [ -z "$REPO" ] ; then
+		REPO=$PACKAGE_CACHE/repo
+		rm -f $REPO/Packages.gz
+	fi
+	if [ -n "$REPO" ] && [ ! -f $REPO/Packages.gz ] ; then
+		$SCRIPT_PATH/make_local_repo.sh $INSTALL $REPO $PACKAGES || return 1
+	fi
+
+	WORK=$(mktemp -d $PACKAGE_CACHE/work.XXXXXX)
+	mkdir -p $WORK/upper $WORK/work $WORK/merged
+	if sudo mount -t overlay overlay \
+		-o lowerdir=$INSTALL,upperdir=$WORK/upper,workdir=$WORK/work $WORK/merged ; then
+		ROOT=$WORK/merged
+	else
+		echo "No overlay file system, the packages will not be cached"
+		ROOT=$INSTALL
+	fi
+
+	# make sure we have a qemu binary
+	# (attr: getfattr, to find the directories replaced in the overlay)
+	sudo apt-get install -y qemu-user-static qemu-user-binfmt attr
+
+	if [ "$NATIVE_UNPACK" = "1" ] ; then
+		$SCRIPT_PATH/native_install.sh $ROOT $REPO $PACKAGES
+		STATUS=$?
+	else
+		chroot_install_packages
+	fi
+
+	if [ "$ROOT" = "$WORK/merged" ] ; then
+		sudo umount $ROOT
+		if [ $STATUS -eq 0 ] ; then
+			# whiteouts (0:0 character devices) are deleted files,
+			# opaque directories replaced a directory
+			UPPER=$WORK/upper
+			sudo find $UPPER -type c -exec stat -c '%t:%T %n' {} + | \
+				sed -n "s%^0:0 $UPPER/%%p" > $WORK/deleted
+			if command -v getfattr > /dev/null ; then
+				sudo getfattr -R -h --absolute-names -n trusted.overlay.opaque \
+					$UPPER 2>/dev/null | \
+					sed -n "s%^# file: $UPPER/\\(.*\\)\$%\\1/%p" >> $WORK/deleted
+			fi
+			grep -v '/$' $WORK/deleted > $WORK/whiteouts
+			(cd $UPPER && ls -A) > $WORK/top
+			sudo tar -c --numeric-owner --xattrs --xattrs-include='*' \
+				--xattrs-exclude='trusted.overlay.*' \
+				--no-wildcards --exclude-from=$WORK/whiteouts \
+				-f $WORK/layer.tar -C $UPPER -T $WORK/top
+			mv $WORK/deleted $LAYER.deleted
+			mv $WORK/layer.tar $LAYER.tar
+			echo "Saved package layer $KEY"
+			apply_layer
+		fi
+	fi
+	sudo rm -rf $WORK
+	return $STATUS
+}
+
+if [ -f $LAYER.tar ] && [ -f $LAYER.deleted ] ; then
+	echo "Reusing package layer $KEY"
+	apply_layer
+else
+	install_packages
+fi